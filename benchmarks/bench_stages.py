@@ -0,0 +1,351 @@
+"""
+pytest-benchmark suite timing each stage of interaction_with_SQL.py and data_transformation.py.
+
+Every stage runs on a copy of a database prepared from a synthetic catalog of BENCH_ROWS shows
+(10000 by default). Save the results to compare two commits:
+
+    BENCH_ROWS=100000 pytest benchmarks/bench_stages.py --benchmark-autosave --benchmark-storage=benchmarks/results
+    pytest-benchmark --storage benchmarks/results compare 0001 0002
+"""
+import base64
+import functools
+import hashlib
+import os
+import shutil
+from pathlib import Path
+
+import pytest
+
+pytest.importorskip('pytest_benchmark')
+pytest.importorskip('pandas')
+
+from benchmarks.synthetic_catalog import generate_catalog
+from program.helper_functions import set_diagnostics_level
+from program.sql_session import open_connection
+from program.interaction_with_SQL import create_sql_tables, insert_data_into_tables, join_tables, create_view, \
+    clean_and_create_table, clean_and_filter_kids_friendly_in_sql, stream_netflix_shows_into_table, \
+    load_netflix_shows_with_pandas, build_bridge_tables
+from program.data_transformation import filter_kids_friendly_movies_from_sql, create_shows_for_kids_recommendation_table, \
+    create_shows_for_kids_recommendation_table_in_batches
+from program.sharded_execution import clean_and_recommend_in_shards
+
+REPOSITORY_ROOT = Path(__file__).resolve().parents[1]
+BENCH_ROWS = int(os.environ.get('BENCH_ROWS', '10000'))
+BENCH_ROUNDS = int(os.environ.get('BENCH_ROUNDS', '3'))
+# Rows per batch of the stages of the batch execution mode
+BENCH_BATCH_SIZE = int(os.environ.get('BENCH_BATCH_SIZE', '1000'))
+VIEW = 'VIEW_NETFLIX_SHOWS_WITH_RATING'
+
+
+@pytest.fixture(scope='module')
+def catalog_dir(tmp_path_factory):
+    # The stages read their sources from program/data_sources relative to the working directory
+    workdir = tmp_path_factory.mktemp(f'catalog_{BENCH_ROWS}')
+    generate_catalog(str(workdir / 'program' / 'data_sources'), BENCH_ROWS,
+                     source_dir=str(REPOSITORY_ROOT / 'program' / 'data_sources'))
+    (workdir / 'program' / 'data_export').mkdir(parents=True)
+
+    previous_dir = os.getcwd()
+    os.chdir(workdir)
+    set_diagnostics_level('off')
+    yield workdir
+    os.chdir(previous_dir)
+
+
+@pytest.fixture(scope='module')
+def base_database(catalog_dir):
+    # Run every stage once, so each benchmark finds the tables it reads
+    database_path = str(catalog_dir / 'base.db')
+    connection = open_connection(database_path)
+    create_sql_tables(connection)
+    insert_data_into_tables(connection)
+    join_tables(connection, new_table='NETFLIX_META_WITH_RATING')
+    create_view(connection, new_view=VIEW)
+    clean_and_create_table(connection, view=VIEW)
+    connection.commit()
+    connection.close()
+    return database_path
+
+
+def run_stage(benchmark, base_database, tmp_path, stage, prepare=None):
+    database_path = str(tmp_path / 'bench.db')
+
+    def setup():
+        shutil.copyfile(base_database, database_path)
+        connection = open_connection(database_path)
+        arguments = prepare(connection) if prepare else ()
+        return (connection, *arguments), {}
+
+    def target(connection, *arguments):
+        result = stage(connection, *arguments)
+        connection.commit()
+        connection.close()
+        return result
+
+    benchmark.pedantic(target, setup=setup, rounds=BENCH_ROUNDS)
+
+
+def test_stream_netflix_shows_into_table(benchmark, base_database, tmp_path):
+    run_stage(benchmark, base_database, tmp_path,
+              lambda connection: stream_netflix_shows_into_table(connection, 'program/data_sources/netflix_shows.csv'))
+
+
+def test_load_netflix_shows_with_pandas(benchmark, base_database, tmp_path):
+    run_stage(benchmark, base_database, tmp_path,
+              lambda connection: load_netflix_shows_with_pandas(connection, 'program/data_sources/netflix_shows.csv'))
+
+
+def test_build_bridge_tables(benchmark, base_database, tmp_path):
+    run_stage(benchmark, base_database, tmp_path, build_bridge_tables)
+
+
+def test_insert_data_into_tables(benchmark, base_database, tmp_path):
+    run_stage(benchmark, base_database, tmp_path, insert_data_into_tables)
+
+
+def test_join_tables(benchmark, base_database, tmp_path):
+    run_stage(benchmark, base_database, tmp_path,
+              lambda connection: join_tables(connection, new_table='NETFLIX_META_WITH_RATING'))
+
+
+def test_join_tables_in_batches(benchmark, base_database, tmp_path):
+    run_stage(benchmark, base_database, tmp_path,
+              lambda connection: join_tables(connection, new_table='NETFLIX_META_WITH_RATING',
+                                             batch_size=BENCH_BATCH_SIZE))
+
+
+def test_clean_and_create_table(benchmark, base_database, tmp_path):
+    run_stage(benchmark, base_database, tmp_path, lambda connection: clean_and_create_table(connection, view=VIEW))
+
+
+def test_clean_and_create_table_in_batches(benchmark, base_database, tmp_path):
+    run_stage(benchmark, base_database, tmp_path,
+              lambda connection: clean_and_create_table(connection, view=VIEW, batch_size=BENCH_BATCH_SIZE))
+
+
+def test_clean_and_filter_kids_friendly_in_sql(benchmark, base_database, tmp_path):
+    run_stage(benchmark, base_database, tmp_path,
+              lambda connection: clean_and_filter_kids_friendly_in_sql(connection, view=VIEW))
+
+
+def test_filter_kids_friendly_movies_from_sql(benchmark, base_database, tmp_path):
+    run_stage(benchmark, base_database, tmp_path, filter_kids_friendly_movies_from_sql)
+
+
+@pytest.mark.parametrize('sentiment_mode', ['cached', 'serial'])
+def test_create_shows_for_kids_recommendation_table(benchmark, base_database, tmp_path, sentiment_mode):
+    pytest.importorskip('nltk')
+    run_stage(benchmark, base_database, tmp_path,
+              lambda connection, netflix_data: create_shows_for_kids_recommendation_table(
+                  netflix_data, connection, sentiment_mode=sentiment_mode),
+              prepare=lambda connection: (filter_kids_friendly_movies_from_sql(connection),))
+
+
+@pytest.mark.parametrize('sentiment_mode', ['cached', 'serial'])
+def test_create_shows_for_kids_recommendation_table_in_batches(benchmark, base_database, tmp_path, sentiment_mode):
+    pytest.importorskip('nltk')
+    # Reads NETFLIX_COMBINED_CLEANED itself, so the batches include the kids-friendly filter
+    run_stage(benchmark, base_database, tmp_path,
+              lambda connection: create_shows_for_kids_recommendation_table_in_batches(
+                  connection, batch_size=BENCH_BATCH_SIZE, sentiment_mode=sentiment_mode))
+
+
+@pytest.mark.parametrize('shards', [1, 4])
+def test_clean_and_recommend_in_shards(benchmark, base_database, tmp_path, shards):
+    pytest.importorskip('nltk')
+    # The workers open the copy of the database the stage runs on
+    run_stage(benchmark, base_database, tmp_path,
+              lambda connection: clean_and_recommend_in_shards(connection, str(tmp_path / 'bench.db'), view=VIEW,
+                                                               shards=shards, batch_size=BENCH_BATCH_SIZE))
+
+
+@pytest.mark.parametrize('max_workers', [1, 4])
+def test_download_blob(benchmark, catalog_dir, tmp_path, max_workers):
+    pytest.importorskip('google.cloud.storage')
+    from benchmarks.fake_gcs import FakeStorageClient
+    from program.interaction_with_GCP import DOWNLOAD_STATE_SUFFIX, download_blob
+
+    # 20 ms per request, about a round trip to Cloud Storage, and small chunks so the catalog spans several
+    client = FakeStorageClient(latency=0.02)
+    with open('program/data_sources/netflix_shows.csv', 'rb') as shows_file:
+        client.upload('bucket', 'netflix_shows.csv', shows_file.read())
+    destination_file_name = str(tmp_path / 'netflix_shows.csv')
+
+    def setup():
+        # Without the recorded generation every round downloads the blob again
+        for file_name in [destination_file_name, destination_file_name + DOWNLOAD_STATE_SUFFIX]:
+            if os.path.exists(file_name):
+                os.remove(file_name)
+
+    benchmark.pedantic(download_blob, args=('bucket', 'netflix_shows.csv', destination_file_name, None, None),
+                       kwargs={'chunk_size': 256 * 1024, 'max_workers': max_workers, 'client': client},
+                       setup=setup, rounds=BENCH_ROUNDS)
+
+
+
+def upload_shows_in_chunks(client, chunks=8):
+    # The catalog as a storage object, and the byte ranges of `chunks` chunks covering it
+    with open('program/data_sources/netflix_shows.csv', 'rb') as shows_file:
+        data = shows_file.read()
+    client.upload('bucket', 'netflix_shows.csv', data)
+    chunk_size = -(-len(data) // chunks)
+    ranges = [(start, min(start + chunk_size, len(data)) - 1) for start in range(0, len(data), chunk_size)]
+    return data, chunk_size, ranges
+
+
+def test_download_blob_resumes_missing_chunks(catalog_dir, tmp_path):
+    pytest.importorskip('google.cloud.storage')
+    from benchmarks.fake_gcs import FakeStorageClient
+    from program.interaction_with_GCP import DOWNLOAD_STATE_SUFFIX, download_blob
+
+    # The metadata and 3 chunks are served, one at a time, then the network fails
+    client = FakeStorageClient(fail_after=4)
+    data, chunk_size, ranges = upload_shows_in_chunks(client)
+    destination_file_name = str(tmp_path / 'netflix_shows.csv')
+    download = functools.partial(download_blob, 'bucket', 'netflix_shows.csv', destination_file_name, None, None,
+                                 chunk_size=chunk_size, max_workers=1, client=client)
+    with pytest.raises(ConnectionError):
+        download()
+    assert client.ranges == ranges[:3]
+    assert not os.path.exists(destination_file_name)
+
+    # The next call only requests the chunks the failed one did not write
+    client.fail_after = None
+    client.ranges = []
+    assert download()
+    assert sorted(client.ranges) == ranges[3:]
+    with open(destination_file_name, 'rb') as downloaded_file:
+        assert hashlib.md5(downloaded_file.read()).digest() == hashlib.md5(data).digest()
+    assert sorted(os.listdir(tmp_path)) == ['netflix_shows.csv', 'netflix_shows.csv' + DOWNLOAD_STATE_SUFFIX]
+
+    client.ranges = []
+    assert not download()
+    assert client.ranges == []
+
+
+def test_download_blob_restarts_on_new_generation(catalog_dir, tmp_path):
+    pytest.importorskip('google.cloud.storage')
+    from benchmarks.fake_gcs import FakeStorageClient
+    from program.interaction_with_GCP import download_blob
+
+    client = FakeStorageClient(fail_after=4)
+    data, chunk_size, ranges = upload_shows_in_chunks(client)
+    destination_file_name = str(tmp_path / 'netflix_shows.csv')
+    download = functools.partial(download_blob, 'bucket', 'netflix_shows.csv', destination_file_name, None, None,
+                                 chunk_size=chunk_size, max_workers=1, client=client)
+    with pytest.raises(ConnectionError):
+        download()
+
+    # Replaced by an object of the same size, the chunks already written belong to the old generation
+    new_data = data[::-1]
+    client.upload('bucket', 'netflix_shows.csv', new_data)
+    client.fail_after = None
+    client.ranges = []
+    assert download()
+    assert sorted(client.ranges) == ranges
+    with open(destination_file_name, 'rb') as downloaded_file:
+        assert hashlib.md5(downloaded_file.read()).digest() == hashlib.md5(new_data).digest()
+
+
+def test_download_blob_rejects_md5_mismatch(catalog_dir, tmp_path):
+    pytest.importorskip('google.cloud.storage')
+    from benchmarks.fake_gcs import FakeStorageClient
+    from program.interaction_with_GCP import download_blob
+
+    client = FakeStorageClient()
+    data, chunk_size, ranges = upload_shows_in_chunks(client)
+    client.objects[('bucket', 'netflix_shows.csv')].md5_hash = base64.b64encode(hashlib.md5(b'').digest()).decode()
+    destination_file_name = str(tmp_path / 'netflix_shows.csv')
+    with pytest.raises(RuntimeError, match='MD5'):
+        download_blob('bucket', 'netflix_shows.csv', destination_file_name, None, None,
+                      chunk_size=chunk_size, max_workers=1, client=client)
+    # Neither the corrupted download nor its progress is kept, the next call starts from scratch
+    assert os.listdir(tmp_path) == []
+
+def test_read_from_bigquery_and_save_csv(benchmark, catalog_dir, tmp_path):
+    pytest.importorskip('google.cloud.bigquery')
+    import pandas as pd
+    from benchmarks.fake_bigquery import FakeBigQueryClient
+    from program.interaction_with_GCP import read_from_bigquery_and_save_csv
+
+    # A ratings table of BENCH_ROWS rows, with a column which is not exported
+    ratings = pd.read_csv('program/data_sources/ratings.csv').rename(columns={'name': 'rating'})
+    ratings = ratings.sample(BENCH_ROWS, replace=True, random_state=42).assign(id=range(BENCH_ROWS), notes='x' * 100)
+    client = FakeBigQueryClient()
+    client.load_table('project.dataset.ratings', ratings)
+
+    benchmark.pedantic(read_from_bigquery_and_save_csv,
+                       args=('project', 'dataset', 'ratings', None, str(tmp_path / 'ratings.csv')),
+                       kwargs={'client': client}, rounds=BENCH_ROUNDS)
+
+
+
+def test_read_from_bigquery_and_save_csv_incremental(tmp_path):
+    pytest.importorskip('google.cloud.bigquery')
+    import json
+    import pandas as pd
+    from benchmarks.fake_bigquery import FakeBigQueryClient
+    from program.interaction_with_GCP import EXPORT_STATE_SUFFIX, read_from_bigquery_and_save_csv
+
+    client = FakeBigQueryClient()
+    csv_file_path = str(tmp_path / 'ratings.csv')
+    export = functools.partial(read_from_bigquery_and_save_csv, 'project', 'dataset', 'ratings', None, csv_file_path,
+                               watermark_column='updated_at', client=client)
+
+    def exported():
+        with open(csv_file_path + EXPORT_STATE_SUFFIX) as state_file:
+            state = json.load(state_file)
+        return pd.read_csv(csv_file_path).sort_values('id').values.tolist(), state
+
+    ratings = pd.DataFrame({'id': [1, 2, 3], 'rating': ['G', 'PG', 'R'], 'updated_at': [10, 20, 20]})
+    client.load_table('project.dataset.ratings', ratings)
+    assert export() == 3
+    assert exported() == ([[1, 'G'], [2, 'PG'], [3, 'R']],
+                          {'watermark_column': 'updated_at', 'watermark_type': 'INT64', 'watermark': 20})
+
+    # The rows at the watermark are pulled again, but nothing changed so the file is kept as it is
+    modified_at = os.stat(csv_file_path).st_mtime_ns
+    assert export() == 0
+    assert '>= @watermark' in client.queries[-1]
+    assert os.stat(csv_file_path).st_mtime_ns == modified_at
+
+    # A row edited and a row committed late, both at the watermark of the previous export
+    ratings = pd.DataFrame({'id': [1, 2, 3, 4], 'rating': ['G', 'PG', 'NC-17', 'TV-Y'], 'updated_at': [10, 20, 20, 20]})
+    client.load_table('project.dataset.ratings', ratings)
+    assert export() == 3
+    assert exported()[0] == [[1, 'G'], [2, 'PG'], [3, 'NC-17'], [4, 'TV-Y']]
+
+    # A row edited and a row added after it, which move the watermark
+    ratings = pd.concat([ratings.assign(rating=['PG-13', 'PG', 'NC-17', 'TV-Y'], updated_at=[30, 20, 20, 20]),
+                         pd.DataFrame({'id': [5], 'rating': ['TV-G'], 'updated_at': [30]})])
+    client.load_table('project.dataset.ratings', ratings)
+    assert export() == 5
+    assert exported() == ([[1, 'PG-13'], [2, 'PG'], [3, 'NC-17'], [4, 'TV-Y'], [5, 'TV-G']],
+                          {'watermark_column': 'updated_at', 'watermark_type': 'INT64', 'watermark': 30})
+
+@pytest.mark.parametrize('cache', ['cold', 'warm'])
+def test_fetch_gdp_per_capita(benchmark, catalog_dir, tmp_path, cache):
+    pytest.importorskip('requests')
+    import sqlite3
+    from benchmarks.stub_gdp_api import StubGdpApi, read_gdp_csv
+    from program.interaction_with_API import fetch_gdp_per_capita
+
+    # 20 ms per request, and a country the API does not know
+    gdp_by_country = read_gdp_csv('program/data_sources/gdp_per_capita.csv')
+    countries = [*gdp_by_country, 'Atlantis']
+    cache_path = str(tmp_path / 'gdp_cache.db')
+
+    with StubGdpApi(gdp_by_country, latency=0.02) as api:
+        options = {'api_url': api.url, 'api_key': 'key', 'csv_file_path': str(tmp_path / 'gdp_per_capita.csv'),
+                   'max_concurrency': 8, 'requests_per_second': 200.0}
+
+        def setup():
+            # A cold run starts from an empty cache, a warm run from the cache filled by a cold run
+            if os.path.exists(cache_path):
+                os.remove(cache_path)
+            connection = sqlite3.connect(cache_path)
+            if cache == 'warm':
+                fetch_gdp_per_capita(countries, cache_connection=connection, **options)
+            return (countries,), {'cache_connection': connection, **options}
+
+        benchmark.pedantic(fetch_gdp_per_capita, setup=setup, rounds=BENCH_ROUNDS)
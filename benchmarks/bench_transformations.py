@@ -0,0 +1,85 @@
+"""
+Micro-benchmark of the per-row apply() calls against their vectorized replacements.
+
+Rows of program/data_sources/netflix_shows.csv are repeated up to each size, and every
+transformation step is timed with the original lambda and with the vectorized function.
+
+Usage:
+    python -m benchmarks.bench_transformations --sizes 10000 100000 1000000
+"""
+import argparse
+import time
+
+import pandas as pd
+
+from program.vectorized_transformations import KEYWORDS_FOR_KIDS, replace_multiple_countries, \
+    flag_release_2000_or_newer, is_listed_for_kids
+
+
+def country_with_apply(data):
+    return data['country'].apply(lambda x: 'many' if ',' in str(x) else x)
+
+
+def country_vectorized(data):
+    return replace_multiple_countries(data['country'])
+
+
+def release_year_with_apply(data):
+    return data['release_year'].apply(lambda year: 'yes' if year >= 2000 else 'no')
+
+
+def release_year_vectorized(data):
+    return flag_release_2000_or_newer(data['release_year'])
+
+
+def listed_in_with_apply(data):
+    return data['listed_in'].apply(lambda x: any(keyword in x for keyword in KEYWORDS_FOR_KIDS))
+
+
+def listed_in_vectorized(data):
+    return is_listed_for_kids(data['listed_in'])
+
+
+STEPS = [
+    ('country', country_with_apply, country_vectorized),
+    ('release_2000_or_newer', release_year_with_apply, release_year_vectorized),
+    ('listed_in', listed_in_with_apply, listed_in_vectorized),
+]
+
+
+def load_catalog(csv_file_path, size):
+    data = pd.read_csv(csv_file_path, delimiter=';', usecols=['country', 'release_year', 'listed_in'])
+    data['country'] = data['country'].fillna('unknown')
+    repeats = -(-size // len(data))
+    return pd.concat([data] * repeats, ignore_index=True).iloc[:size]
+
+
+def time_step(function, data, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        result = function(data)
+        best = min(best, time.perf_counter() - start_time)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10_000, 100_000, 1_000_000])
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--csv', default='program/data_sources/netflix_shows.csv')
+    args = parser.parse_args()
+
+    print(f"{'rows':>10} {'step':<24} {'apply (s)':>10} {'vectorized (s)':>15} {'speed-up':>9}")
+    for size in args.sizes:
+        data = load_catalog(args.csv, size)
+        for name, with_apply, vectorized in STEPS:
+            apply_time, expected = time_step(with_apply, data, args.repeat)
+            vectorized_time, result = time_step(vectorized, data, args.repeat)
+            assert list(expected) == list(result), f"{name}: vectorized result differs from apply()"
+            print(f"{size:>10} {name:<24} {apply_time:>10.4f} {vectorized_time:>15.4f} "
+                  f"{apply_time / vectorized_time:>8.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+"""
+Benchmark of the typed loading layer against plain object columns.
+
+Rows of program/data_sources/netflix_shows.csv, joined with their rating name, are repeated up to each
+size in an in-memory SQLite table, then read with pd.read_sql_query and with read_typed_sql. The memory
+per row of both DataFrames is reported, and every filter of the cleaning and kids-friendly stages is timed
+on each of them.
+
+Usage:
+    python -m benchmarks.bench_typed_loading --sizes 100000 1000000
+"""
+import argparse
+import sqlite3
+import time
+
+import pandas as pd
+
+from program.interaction_with_SQL import KIDS_EXCLUDED_RATINGS
+from program.typed_loading import read_typed_sql, fill_missing
+from program.vectorized_transformations import replace_multiple_countries, flag_release_2000_or_newer, \
+    is_listed_for_kids
+
+
+def rating_filter(data):
+    return data[~data['rating'].isin(KIDS_EXCLUDED_RATINGS)]
+
+
+def cast_filter(data):
+    return data[data['cast'].notna() & (data['cast'] != '')]
+
+
+def country_cleaning(data):
+    return replace_multiple_countries(fill_missing(data['country'], 'unknown'))
+
+
+def release_year_flag(data):
+    return flag_release_2000_or_newer(data['release_year'])
+
+
+def listed_in_filter(data):
+    return data[is_listed_for_kids(data['listed_in'])]
+
+
+def show_id_filter(data):
+    return data[data['show_id'].isin(set(data['show_id'].iloc[::10]))]
+
+
+STEPS = [
+    ('rating isin', rating_filter),
+    ('cast not empty', cast_filter),
+    ('country cleaning', country_cleaning),
+    ('release_2000_or_newer', release_year_flag),
+    ('listed_in for kids', listed_in_filter),
+    ('show_id isin', show_id_filter),
+]
+
+
+def create_catalog_table(connection, csv_file_path, ratings_csv_path, size):
+    data = pd.read_csv(csv_file_path, delimiter=';')
+    ratings = pd.read_csv(ratings_csv_path).set_index('id')['name']
+    data['rating'] = data['rating'].map(ratings)
+    repeats = -(-size // len(data))
+    data = pd.concat([data] * repeats, ignore_index=True).iloc[:size]
+    # Show ids stay unique, like in NETFLIX_SHOWS
+    data['show_id'] = 's' + data.index.astype(str)
+    data.to_sql('CATALOG', connection, index=False)
+
+
+def as_list(result):
+    # Filters are compared by the rows they keep, transformations by their values
+    return list(result.index) if isinstance(result, pd.DataFrame) else [str(value) for value in result]
+
+
+def time_call(function, *arguments, repeat=1):
+    best = float('inf')
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        result = function(*arguments)
+        best = min(best, time.perf_counter() - start_time)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100_000, 1_000_000])
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--csv', default='program/data_sources/netflix_shows.csv')
+    parser.add_argument('--ratings-csv', default='program/data_sources/ratings.csv')
+    args = parser.parse_args()
+
+    print(f"{'rows':>10} {'step':<24} {'object':>12} {'typed':>12} {'ratio':>7}")
+    for size in args.sizes:
+        connection = sqlite3.connect(':memory:')
+        create_catalog_table(connection, args.csv, args.ratings_csv, size)
+        object_time, object_data = time_call(pd.read_sql_query, 'SELECT * FROM CATALOG', connection)
+        typed_time, typed_data = time_call(read_typed_sql, 'SELECT * FROM CATALOG', connection)
+        connection.close()
+
+        object_bytes = object_data.memory_usage(deep=True).sum() / size
+        typed_bytes = typed_data.memory_usage(deep=True).sum() / size
+        print(f"{size:>10} {'bytes per row':<24} {object_bytes:>12.0f} {typed_bytes:>12.0f} "
+              f"{object_bytes / typed_bytes:>6.1f}x")
+        print(f"{size:>10} {'load (s)':<24} {object_time:>12.4f} {typed_time:>12.4f} "
+              f"{object_time / typed_time:>6.1f}x")
+        for name, step in STEPS:
+            object_step_time, expected = time_call(step, object_data, repeat=args.repeat)
+            typed_step_time, result = time_call(step, typed_data, repeat=args.repeat)
+            assert as_list(expected) == as_list(result), f"{name}: typed result differs from object columns"
+            print(f"{size:>10} {name + ' (s)':<24} {object_step_time:>12.4f} {typed_step_time:>12.4f} "
+                  f"{object_step_time / typed_step_time:>6.1f}x")
+
+
+if __name__ == '__main__':
+    main()
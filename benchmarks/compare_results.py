@@ -0,0 +1,58 @@
+"""
+Compare two end-to-end benchmark results saved by benchmarks/run_end_to_end.py.
+
+The stage times are printed side by side, then the output checksums are compared, so that two execution
+modes claimed to be equivalent can be checked; the exit status is 1 when the outputs differ.
+
+Usage:
+    python -m benchmarks.compare_results benchmarks/results/e2e-100000-abc1234-....json \
+        benchmarks/results/e2e-100000-def5678-....json
+"""
+import argparse
+import json
+
+
+def load_stage_times(result_path):
+    with open(result_path) as result_file:
+        result = json.load(result_file)
+    return result, {stage['stage']: stage['wall_seconds'] for stage in result['stages']}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('baseline')
+    parser.add_argument('candidate')
+    args = parser.parse_args()
+
+    baseline, baseline_times = load_stage_times(args.baseline)
+    candidate, candidate_times = load_stage_times(args.candidate)
+    if baseline['rows'] != candidate['rows']:
+        print(f"Warning: comparing runs of {baseline['rows']} and {candidate['rows']} rows")
+
+    print(f"{'stage':<45} {baseline['commit']:>10} {candidate['commit']:>10} {'change':>8}")
+    for stage in dict.fromkeys([*baseline_times, *candidate_times]):
+        before = baseline_times.get(stage)
+        after = candidate_times.get(stage)
+        if before is None or after is None:
+            change = ''
+        else:
+            change = f'{(after - before) / before * 100:+.0f}%' if before else ''
+        print(f"{stage:<45} {before if before is not None else '-':>10} {after if after is not None else '-':>10} "
+              f"{change:>8}")
+    print(f"{'total':<45} {baseline['total_seconds']:>10} {candidate['total_seconds']:>10} "
+          f"{(candidate['total_seconds'] - baseline['total_seconds']) / baseline['total_seconds'] * 100:>+7.0f}%")
+
+    # Results saved before the outputs were checksummed have none to compare
+    baseline_outputs, candidate_outputs = baseline.get('outputs'), candidate.get('outputs')
+    if baseline_outputs is None or candidate_outputs is None:
+        print('Outputs: not recorded by both runs, not compared')
+        return 0
+    different = [output for output in dict.fromkeys([*baseline_outputs, *candidate_outputs])
+                 if baseline_outputs.get(output) != candidate_outputs.get(output)]
+    print(f"Outputs: {'identical' if not different else 'different: ' + ', '.join(different)} "
+          f"({baseline['options']} vs {candidate['options']})")
+    return 1 if different else 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,58 @@
+"""
+Local stand-in for the google.cloud.bigquery client, for running `read_from_bigquery_and_save_csv` without
+a project.
+
+Tables are DataFrames loaded into an in-memory SQLite database, which runs the queries as written: SQLite
+accepts the `project.dataset.table` names in backticks and the @name query parameters of BigQuery. The
+results are returned as Arrow record batches of `page_size` rows, like a paged RowIterator.
+
+Usage:
+    client = FakeBigQueryClient()
+    client.load_table('python-rocket-1.etl_netflix.ratings', ratings)
+    read_from_bigquery_and_save_csv('python-rocket-1', 'etl_netflix', 'ratings', None, 'ratings.csv', client=client)
+"""
+import sqlite3
+
+import pyarrow as pa
+
+
+class FakeRowIterator:
+    def __init__(self, cursor, page_size):
+        self.cursor = cursor
+        self.page_size = page_size or 10000
+        self.pages_read = 0
+
+    def to_arrow_iterable(self, bqstorage_client=None):
+        names = [description[0] for description in self.cursor.description]
+        while rows := self.cursor.fetchmany(self.page_size):
+            self.pages_read += 1
+            yield pa.RecordBatch.from_pydict({name: list(values) for name, values in zip(names, zip(*rows))})
+
+
+class FakeQueryJob:
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    def result(self, page_size=None):
+        return FakeRowIterator(self.cursor, page_size)
+
+
+class FakeBigQueryClient:
+    def __init__(self):
+        self.connection = sqlite3.connect(':memory:', check_same_thread=False)
+        self.queries = []
+
+    def load_table(self, table_path, data):
+        """
+        Create or replace a table.
+
+        Parameters:
+        - table_path (str): 'project.dataset.table'.
+        - data (pd.DataFrame): The rows of the table.
+        """
+        data.to_sql(table_path, self.connection, if_exists='replace', index=False)
+
+    def query(self, query, job_config=None):
+        self.queries.append(query)
+        parameters = {parameter.name: parameter.value for parameter in getattr(job_config, 'query_parameters', [])}
+        return FakeQueryJob(self.connection.execute(query, parameters))
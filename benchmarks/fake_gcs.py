@@ -0,0 +1,81 @@
+"""
+In-memory stand-in for the google.cloud.storage client, for running `download_blob` without a bucket.
+
+It implements the calls `download_blob` makes (`Client.bucket`, `Bucket.get_blob` and ranged
+`Blob.download_as_bytes`), with a latency per request like a real round trip, and can fail after a
+number of requests to exercise resumed downloads. The byte ranges served are recorded in `ranges`.
+Replacing an object bumps its generation, and reads of an older generation fail as they do on Cloud Storage.
+
+Usage:
+    client = FakeStorageClient(latency=0.02)
+    client.upload('bucket', 'etl-netflix/netflix_shows.csv', data)
+    download_blob('bucket', 'etl-netflix/netflix_shows.csv', 'netflix_shows.csv', None, None, client=client)
+"""
+import base64
+import hashlib
+import threading
+import time
+
+
+class FakeBlob:
+    def __init__(self, client, bucket_name, name, data, generation):
+        self.client = client
+        self.bucket_name = bucket_name
+        self.name = name
+        self.data = data
+        self.generation = generation
+        self.size = len(data)
+        self.md5_hash = base64.b64encode(hashlib.md5(data).digest()).decode('ascii')
+
+    def download_as_bytes(self, start=None, end=None, checksum='md5'):
+        self.client.request()
+        current = self.client.objects.get((self.bucket_name, self.name))
+        if current is None or current.generation != self.generation:
+            raise FileNotFoundError(f'gs://{self.bucket_name}/{self.name}#{self.generation} does not exist')
+        start = start or 0
+        end = self.size - 1 if end is None else end
+        with self.client.lock:
+            self.client.ranges.append((start, end))
+        return self.data[start:end + 1]
+
+
+class FakeBucket:
+    def __init__(self, client, name):
+        self.client = client
+        self.name = name
+
+    def get_blob(self, blob_name):
+        self.client.request()
+        return self.client.objects.get((self.name, blob_name))
+
+
+class FakeStorageClient:
+    """
+    Parameters:
+    - latency (float): Seconds each request takes.
+    - fail_after (int): Number of requests served before every following one fails, None to never fail.
+    """
+
+    def __init__(self, latency=0.0, fail_after=None):
+        self.latency = latency
+        self.fail_after = fail_after
+        self.objects = {}
+        self.requests = 0
+        self.ranges = []
+        self.lock = threading.Lock()
+
+    def request(self):
+        with self.lock:
+            self.requests += 1
+            failed = self.fail_after is not None and self.requests > self.fail_after
+        time.sleep(self.latency)
+        if failed:
+            raise ConnectionError('Simulated network failure')
+
+    def upload(self, bucket_name, blob_name, data):
+        previous = self.objects.get((bucket_name, blob_name))
+        generation = previous.generation + 1 if previous else 1
+        self.objects[(bucket_name, blob_name)] = FakeBlob(self, bucket_name, blob_name, data, generation)
+
+    def bucket(self, bucket_name):
+        return FakeBucket(self, bucket_name)
@@ -0,0 +1,134 @@
+"""
+Load test of the recommendation read path with concurrent readers, reporting p50/p99 latencies.
+
+Every reader draws queries from a fixed pool of filters (countries, genres, popularity and sentiment
+thresholds found in the database) and follows their pages, so repeated queries hit the LRU cache.
+Queries go to a RecommendationService in this process, or to a running `program.recommendation_api`
+server with --url.
+
+Usage:
+    python -m benchmarks.load_recommendations --database program/database/netflix_database.db --readers 8
+    python -m benchmarks.load_recommendations --url http://127.0.0.1:8000 --readers 8
+"""
+import argparse
+import json
+import random
+import sqlite3
+import statistics
+import threading
+import time
+from urllib.parse import urlencode
+from urllib.request import urlopen
+
+from program.recommendation_api import RecommendationService
+
+
+def build_query_pool(database_path, size, seed):
+    # Filters drawn from the values of the database, the most frequent first
+    connection = sqlite3.connect(f'file:{database_path}?mode=ro', uri=True)
+    countries = [country for (country,) in connection.execute(
+        'SELECT country FROM SHOW_COUNTRY GROUP BY country ORDER BY COUNT(*) DESC LIMIT 30')]
+    genres = [genre for (genre,) in connection.execute(
+        'SELECT genre FROM SHOW_GENRE GROUP BY genre ORDER BY COUNT(*) DESC LIMIT 20')]
+    connection.close()
+
+    rng = random.Random(seed)
+    pool = []
+    for _ in range(size):
+        query = {'limit': rng.choice([10, 20, 50])}
+        if rng.random() < 0.5:
+            query['country'] = rng.choice(countries)
+        if rng.random() < 0.3:
+            query['genre'] = rng.choice(genres)
+        if rng.random() < 0.3:
+            query['min_popularity'] = rng.choice([2, 3])
+        if rng.random() < 0.3:
+            query['min_sentiment'] = rng.choice([0.0, 0.2, 0.5])
+        pool.append(query)
+    return pool
+
+
+def http_client(url):
+    def recommendations(**query):
+        with urlopen(f'{url}/recommendations?{urlencode(query)}') as response:
+            return json.load(response)
+    return recommendations
+
+
+def percentile(sorted_values, fraction):
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+def run_load(recommendations, pool, readers, requests_per_reader, max_pages, seed):
+    """
+    Run `readers` threads, each sending `requests_per_reader` page requests.
+
+    Returns:
+    - tuple: The latencies of all requests in seconds and the wall time of the run.
+    """
+    latencies = []
+    latencies_lock = threading.Lock()
+
+    def reader(index):
+        # Skewed draws, so some queries are much more frequent than others like real traffic
+        rng = random.Random(seed + index)
+        reader_latencies = []
+        while len(reader_latencies) < requests_per_reader:
+            query = pool[min(int(rng.paretovariate(1.2)) - 1, len(pool) - 1)]
+            after = None
+            for _ in range(rng.randint(1, max_pages)):
+                start_time = time.perf_counter()
+                page = recommendations(**query, **({'after': after} if after else {}))
+                reader_latencies.append(time.perf_counter() - start_time)
+                after = page['next_after']
+                if after is None or len(reader_latencies) >= requests_per_reader:
+                    break
+        with latencies_lock:
+            latencies.extend(reader_latencies)
+
+    threads = [threading.Thread(target=reader, args=(index,)) for index in range(readers)]
+    start_time = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, time.perf_counter() - start_time
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--database', default='program/database/netflix_database.db',
+                        help='database written by main.py, also read for the query pool with --url')
+    parser.add_argument('--url', default=None, help='base URL of a running recommendation server')
+    parser.add_argument('--readers', type=int, default=8, help='number of concurrent readers')
+    parser.add_argument('--requests', type=int, default=2000, help='page requests per reader')
+    parser.add_argument('--pool-size', type=int, default=200, help='number of distinct filters')
+    parser.add_argument('--max-pages', type=int, default=3, help='pages followed per query')
+    parser.add_argument('--cache-size', type=int, default=1024, help='LRU size of the in-process service, 0 to disable')
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    pool = build_query_pool(args.database, args.pool_size, args.seed)
+    service = None
+    if args.url:
+        recommendations = http_client(args.url.rstrip('/'))
+    else:
+        service = RecommendationService(args.database, cache_size=args.cache_size)
+        recommendations = service.recommendations
+
+    latencies, wall_time = run_load(recommendations, pool, args.readers, args.requests, args.max_pages, args.seed)
+    latencies.sort()
+    print(f'{len(latencies)} requests from {args.readers} readers in {wall_time:.2f} s '
+          f'({len(latencies) / wall_time:.0f} requests/s)')
+    print(f'p50 {percentile(latencies, 0.50) * 1000:.3f} ms, p90 {percentile(latencies, 0.90) * 1000:.3f} ms, '
+          f'p99 {percentile(latencies, 0.99) * 1000:.3f} ms, max {latencies[-1] * 1000:.3f} ms, '
+          f'mean {statistics.fmean(latencies) * 1000:.3f} ms')
+    if service is not None:
+        stats = service.stats()
+        print(f"Cache: {stats['hits']} hits, {stats['misses']} misses, {stats['cached_pages']} pages "
+              f"of version {stats['version']}")
+        service.close()
+
+
+if __name__ == '__main__':
+    main()
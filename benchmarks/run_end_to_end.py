@@ -0,0 +1,144 @@
+"""
+End-to-end benchmark of main() on a synthetic catalog, with the GCP and API stages replaced by local fixtures.
+
+The synthetic sources are written where the pipeline expects them, the download, BigQuery export and
+GDP fetch stages become no-ops, and the per-stage metrics of the run are saved to benchmarks/results
+together with the commit they were measured on and checksums of the outputs. Compare two saved runs with
+benchmarks/compare_results.py, which also checks that both produced the same recommendations.
+
+Usage:
+    python -m benchmarks.run_end_to_end --rows 100000
+    python -m benchmarks.run_end_to_end --rows 100000 --execution-mode sharded --shards 4
+"""
+import argparse
+import hashlib
+import json
+import os
+import sqlite3
+import subprocess
+import sys
+import time
+import types
+from datetime import datetime, timezone
+from pathlib import Path
+
+from benchmarks.synthetic_catalog import generate_catalog
+from program.interaction_with_csv import hash_file
+
+REPOSITORY_ROOT = Path(__file__).resolve().parents[1]
+RESULTS_DIR = REPOSITORY_ROOT / 'benchmarks' / 'results'
+
+
+def current_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPOSITORY_ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def local_stage(name):
+    def stage(*args, **kwargs):
+        print(f'{name}: using the local synthetic catalog')
+    return stage
+
+
+def import_main_with_local_fixtures():
+    # The API credentials are not needed when the GDP stage is local
+    if 'program.authorization.api_key' not in sys.modules:
+        api_key_module = types.ModuleType('program.authorization.api_key')
+        api_key_module.API_KEY = 'local'
+        api_key_module.API_URL = 'http://localhost'
+        sys.modules['program.authorization.api_key'] = api_key_module
+
+    import main as pipeline
+    pipeline.download_blob = local_stage('download_blob')
+    pipeline.read_from_bigquery_and_save_csv = local_stage('read_from_bigquery_and_save_csv')
+    pipeline.fetch_gdp_per_capita = local_stage('fetch_gdp_per_capita')
+    return pipeline
+
+
+def output_checksums(workdir):
+    # Checksums of the recommendations table, in show_id order with the scores rounded, and of the exported files
+    connection = sqlite3.connect(workdir / 'program' / 'database' / 'netflix_database.db')
+    try:
+        digest = hashlib.sha256()
+        for row in connection.execute('SELECT show_id, title, popularity, sentiment_score '
+                                      'FROM SHOWS_FOR_KIDS_RECOMMENDATION ORDER BY show_id'):
+            digest.update(repr([round(value, 6) if isinstance(value, float) else value for value in row]).encode())
+    finally:
+        connection.close()
+    checksums = {'SHOWS_FOR_KIDS_RECOMMENDATION': digest.hexdigest()}
+    for export_path in sorted((workdir / 'program' / 'data_export').glob('shows_for_kids_recommendation.*')):
+        checksums[export_path.name] = hash_file(str(export_path))
+    return checksums
+
+
+def run_end_to_end(rows, workdir, seed=42, **main_options):
+    """
+    Run main() on a synthetic catalog and save its metrics to benchmarks/results.
+
+    Parameters:
+    - rows (int): Number of synthetic shows.
+    - workdir (str): Working directory of the run, receiving the program/ data layout.
+    - seed (int): Seed of the synthetic catalog.
+    - main_options: Keyword arguments passed to main(), e.g. execution_mode='sql'.
+
+    Returns:
+    - str: Path of the saved result file.
+    """
+    workdir = Path(workdir)
+    generate_catalog(str(workdir / 'program' / 'data_sources'), rows, seed=seed,
+                     source_dir=str(REPOSITORY_ROOT / 'program' / 'data_sources'))
+    for directory in ['database', 'data_export']:
+        (workdir / 'program' / directory).mkdir(parents=True, exist_ok=True)
+
+    pipeline = import_main_with_local_fixtures()
+    previous_dir = os.getcwd()
+    os.chdir(workdir)
+    try:
+        metrics_file_path = str(workdir / 'program' / 'database' / 'pipeline_metrics.json')
+        start_time = time.perf_counter()
+        pipeline.main(metrics_file_path=metrics_file_path, **main_options)
+        total_seconds = time.perf_counter() - start_time
+    finally:
+        os.chdir(previous_dir)
+
+    with open(metrics_file_path) as metrics_file:
+        metrics = json.load(metrics_file)
+
+    RESULTS_DIR.mkdir(parents=True, exist_ok=True)
+    commit = current_commit()
+    timestamp = datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%SZ')
+    result_path = RESULTS_DIR / f'e2e-{rows}-{commit}-{timestamp}.json'
+    with open(result_path, 'w') as result_file:
+        json.dump({'commit': commit, 'rows': rows, 'seed': seed, 'options': main_options,
+                   'total_seconds': round(total_seconds, 4), 'outputs': output_checksums(workdir),
+                   'stages': metrics['stages']}, result_file, indent=2)
+    print(f'End-to-end run of {rows} shows took {total_seconds:.2f} s, results saved to {result_path}')
+    return str(result_path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--rows', type=int, default=10_000)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--workdir', default=None, help='defaults to a new directory under /tmp')
+    parser.add_argument('--execution-mode', choices=['pandas', 'sql', 'batch', 'sharded'], default='pandas')
+    parser.add_argument('--sentiment-mode', choices=['cached', 'serial'], default='cached')
+    parser.add_argument('--batch-size', type=int, default=None,
+                        help='rows per batch of --execution-mode batch and of each shard, main.py default if omitted')
+    parser.add_argument('--shards', type=int, default=None,
+                        help='shards of --execution-mode sharded, the number of CPUs if omitted')
+    args = parser.parse_args()
+
+    # Options left to the defaults of main() are not recorded, so results of the same run compare equal
+    main_options = {name: value for name, value in [('batch_size', args.batch_size), ('shards', args.shards)]
+                    if value is not None}
+    workdir = args.workdir or f'/tmp/netflix_e2e_{args.rows}_{os.getpid()}'
+    run_end_to_end(args.rows, workdir, seed=args.seed, execution_mode=args.execution_mode,
+                   sentiment_mode=args.sentiment_mode, **main_options)
+
+
+if __name__ == '__main__':
+    main()
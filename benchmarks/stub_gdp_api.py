@@ -0,0 +1,114 @@
+"""
+Local stub of the GDP per capita API, for running `fetch_gdp_per_capita` without an API key.
+
+It answers `GET /?name=<country>` like the API, with a JSON list holding the GDP per capita of the country
+(an empty list for an unknown country), after a latency per request like a real round trip. Requests
+without the X-Api-Key header are rejected with 401, and `fail_every` makes every n-th request fail with
+503 to exercise the retries.
+
+Usage:
+    with StubGdpApi({'France': 40493.9}, latency=0.05) as api:
+        fetch_gdp_per_capita(['France'], api_url=api.url, api_key='key', csv_file_path='gdp_per_capita.csv')
+
+    python -m benchmarks.stub_gdp_api --port 8080
+"""
+import argparse
+import csv
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+def read_gdp_csv(csv_file_path):
+    with open(csv_file_path, newline='', encoding='utf-8') as csv_file:
+        return {row['Country']: float(row['GDP_per_capita']) for row in csv.DictReader(csv_file)}
+
+
+class StubGdpApi:
+    """
+    Parameters:
+    - gdp_by_country (dict): GDP per capita served for each known country.
+    - latency (float): Seconds each request takes.
+    - fail_every (int): Every n-th request fails with 503, None to never fail.
+    - port (int): Port to listen on, 0 for any free port.
+    """
+
+    def __init__(self, gdp_by_country, latency=0.0, fail_every=None, port=0):
+        self.gdp_by_country = gdp_by_country
+        self.latency = latency
+        self.fail_every = fail_every
+        self.requests = 0
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), self.handler_class())
+        self.server.daemon_threads = True
+        self.url = f'http://127.0.0.1:{self.server.server_address[1]}/'
+        self.thread = None
+
+    def handler_class(self):
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                with api.lock:
+                    api.requests += 1
+                    failed = api.fail_every is not None and api.requests % api.fail_every == 0
+                time.sleep(api.latency)
+                if not self.headers.get('X-Api-Key'):
+                    return self.reply(401, {'error': 'Missing API key'})
+                if failed:
+                    return self.reply(503, {'error': 'Simulated failure'})
+                country = parse_qs(urlparse(self.path).query).get('name', [''])[0]
+                if country not in api.gdp_by_country:
+                    return self.reply(200, [])
+                return self.reply(200, [{'name': country, 'gdp_per_capita': api.gdp_by_country[country]}])
+
+            def reply(self, status, body):
+                payload = json.dumps(body).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--latency', type=float, default=0.05)
+    parser.add_argument('--fail-every', type=int, default=None)
+    parser.add_argument('--csv', default='program/data_sources/gdp_per_capita.csv',
+                        help='CSV with the Country and GDP_per_capita columns served by the stub')
+    args = parser.parse_args()
+
+    api = StubGdpApi(read_gdp_csv(args.csv), latency=args.latency, fail_every=args.fail_every, port=args.port)
+    print(f'Serving the GDP per capita of {len(api.gdp_by_country)} countries on {api.url}')
+    try:
+        api.server.serve_forever()
+    except KeyboardInterrupt:
+        api.server.server_close()
+
+
+if __name__ == '__main__':
+    main()
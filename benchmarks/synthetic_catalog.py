@@ -0,0 +1,169 @@
+"""
+Synthetic catalog generator for benchmarking the pipeline at any scale.
+
+The distributions of type, cast, country, listed_in, ratings, durations and description words are
+learned from the bundled program/data_sources/netflix_shows.csv, then rows are drawn from them with
+a fixed seed and streamed to disk, so 10M-row catalogs do not need 10M rows in memory.
+
+Usage:
+    python -m benchmarks.synthetic_catalog --rows 1000000 --output-dir /tmp/catalog_1m
+"""
+import argparse
+import csv
+import os
+import random
+import shutil
+from collections import Counter
+
+NETFLIX_SHOWS_HEADER = ['show_id', 'type', 'title', 'director', 'cast', 'country', 'date_added',
+                        'release_year', 'rating', 'duration', 'listed_in', 'description']
+
+
+class WeightedSampler:
+    """
+    Draw values with the frequencies they have in a Counter.
+
+    The counter is expanded into one entry per occurrence, so a draw is a single random index.
+    """
+
+    def __init__(self, counter):
+        self.values = list(counter.keys())
+        self.population = list(counter.elements())
+
+    def sample(self, rng):
+        return self.population[int(rng.random() * len(self.population))]
+
+    def sample_many(self, rng, count):
+        population = self.population
+        size = len(population)
+        random_value = rng.random
+        return [population[int(random_value() * size)] for _ in range(count)]
+
+
+def split_values(value):
+    return [item.strip() for item in value.split(',') if item.strip()] if value else []
+
+
+def learn_distributions(source_csv_path):
+    """
+    Learn the value distributions of the bundled catalog.
+
+    Parameters:
+    - source_csv_path (str): Path of a ';'-delimited Netflix shows CSV.
+
+    Returns:
+    - dict: A WeightedSampler per generated attribute.
+    """
+    counters = {name: Counter() for name in [
+        'type', 'director', 'director_count', 'cast', 'cast_count', 'country', 'country_count', 'date_added',
+        'release_year', 'rating', 'listed_in', 'listed_in_count', 'description_word', 'description_length',
+        'title_word', 'title_length']}
+    durations = {}
+
+    with open(source_csv_path, newline='', encoding='utf-8') as source_file:
+        reader = csv.DictReader(source_file, delimiter=';')
+        for row in reader:
+            counters['type'][row['type']] += 1
+            durations.setdefault(row['type'], Counter())[row['duration']] += 1
+            for column in ['director', 'cast', 'country', 'listed_in']:
+                values = split_values(row[column])
+                counters[f'{column}_count'][len(values)] += 1
+                counters[column].update(values)
+            counters['date_added'][row['date_added']] += 1
+            counters['release_year'][row['release_year']] += 1
+            counters['rating'][row['rating']] += 1
+            description_words = row['description'].split()
+            counters['description_length'][len(description_words)] += 1
+            counters['description_word'].update(description_words)
+            title_words = row['title'].split()
+            counters['title_length'][max(len(title_words), 1)] += 1
+            counters['title_word'].update(title_words)
+
+    samplers = {name: WeightedSampler(counter) for name, counter in counters.items() if counter}
+    samplers['duration'] = {show_type: WeightedSampler(counter) for show_type, counter in durations.items()}
+    return samplers
+
+
+def sample_list(samplers, column, rng):
+    count = samplers[f'{column}_count'].sample(rng)
+    return ', '.join(dict.fromkeys(samplers[column].sample_many(rng, count)))
+
+
+def generate_rows(samplers, rows, seed):
+    rng = random.Random(seed)
+    for index in range(1, rows + 1):
+        show_type = samplers['type'].sample(rng)
+        title = ' '.join(samplers['title_word'].sample_many(rng, samplers['title_length'].sample(rng)))
+        description = ' '.join(samplers['description_word'].sample_many(rng, samplers['description_length'].sample(rng)))
+        yield [
+            f's{index}',
+            show_type,
+            title,
+            sample_list(samplers, 'director', rng),
+            sample_list(samplers, 'cast', rng),
+            sample_list(samplers, 'country', rng),
+            samplers['date_added'].sample(rng),
+            samplers['release_year'].sample(rng),
+            samplers['rating'].sample(rng),
+            samplers['duration'][show_type].sample(rng),
+            sample_list(samplers, 'listed_in', rng),
+            description,
+        ]
+
+
+def generate_catalog(output_dir, rows, seed=42, source_dir='program/data_sources'):
+    """
+    Write netflix_shows.csv, ratings.csv, gdp_per_capita.csv and popular_directors.csv for a synthetic catalog.
+
+    Parameters:
+    - output_dir (str): Directory receiving the four files, created if needed.
+    - rows (int): Number of shows to generate.
+    - seed (int): Seed of the random generator, the same seed always gives the same catalog.
+    - source_dir (str): Directory of the bundled sources the distributions are learned from.
+
+    Returns:
+    - dict: Paths of the generated files by name.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    samplers = learn_distributions(os.path.join(source_dir, 'netflix_shows.csv'))
+    paths = {name: os.path.join(output_dir, f'{name}.csv')
+             for name in ['netflix_shows', 'ratings', 'gdp_per_capita', 'popular_directors']}
+
+    with open(paths['netflix_shows'], 'w', newline='', encoding='utf-8') as shows_file:
+        writer = csv.writer(shows_file, delimiter=';')
+        writer.writerow(NETFLIX_SHOWS_HEADER)
+        writer.writerows(generate_rows(samplers, rows, seed))
+
+    # The rating ids of the catalog refer to the bundled ratings
+    shutil.copyfile(os.path.join(source_dir, 'ratings.csv'), paths['ratings'])
+
+    rng = random.Random(seed)
+    with open(paths['gdp_per_capita'], 'w', newline='', encoding='utf-8') as gdp_file:
+        writer = csv.writer(gdp_file)
+        writer.writerow(['Country', 'GDP_per_capita'])
+        for country in samplers['country'].values:
+            writer.writerow([country, round(rng.lognormvariate(9.6, 1.0), 1)])
+
+    with open(paths['popular_directors'], 'w', newline='', encoding='utf-8') as directors_file:
+        directors_file.write('director\n')
+        directors = samplers['director'].values
+        for director in rng.sample(directors, min(60, len(directors))):
+            directors_file.write(f'{director}\n')
+
+    return paths
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--rows', type=int, default=10_000, help='number of shows, e.g. 10000 to 10000000')
+    parser.add_argument('--output-dir', required=True)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--source-dir', default='program/data_sources')
+    args = parser.parse_args()
+
+    paths = generate_catalog(args.output_dir, args.rows, seed=args.seed, source_dir=args.source_dir)
+    print(f"Generated {args.rows} shows in {paths['netflix_shows']}")
+
+
+if __name__ == '__main__':
+    main()
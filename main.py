@@ -1,10 +1,32 @@
-from program.interaction_with_SQL import create_sql_tables, insert_data_into_tables, join_tables, create_view, \
-    clean_and_create_table
+import time
+
+# Start of the imports of the CLI, reported by --profile-imports
+import_start_time = time.perf_counter()
+
+import argparse
+import sys
+
+from program.interaction_with_SQL import KIDS_EXCLUDED_RATINGS, KIDS_EXCLUDED_QUERIES, \
+    LOOKUP_FILE_PATHS, BRIDGE_TABLES, create_sql_tables, load_netflix_shows, mark_shows_changed_by_lookups, \
+    load_lookup_tables, join_tables, create_view, clean_and_create_table, clean_and_filter_kids_friendly_in_sql, \
+    has_load_state
 from program.interaction_with_GCP import download_blob, read_from_bigquery_and_save_csv
-from program.interaction_with_csv import get_unique_countries
-from program.interaction_with_API import fetch_gdp_per_capita
-from program.authorization.api_key import API_KEY, API_URL
-from program.data_transformation import filter_kids_friendly_movies_from_sql, create_shows_for_kids_recommendation_table
+from program.interaction_with_csv import SourceReader
+from program.full_text_search import SEARCH_INDEX
+from program.table_publishing import KEPT_VERSIONS
+from program.columnar_staging import DICTIONARY_COLUMNS, stage_csv_to_parquet, get_unique_countries_from_parquet
+from program.interaction_with_API import GDP_CACHE_TTL, create_gdp_cache_table, read_gdp_cache, write_gdp_cache, \
+    fetch_gdp_per_capita
+from program.data_transformation import POSITIVE_SENTIMENT_THRESHOLD, filter_kids_friendly_movies_from_sql, \
+    create_shows_for_kids_recommendation_table, create_shows_for_kids_recommendation_table_in_batches
+from program.sharded_execution import clean_and_recommend_in_shards
+from program.popularity_rules import AGGREGATES, POPULARITY_RULES_PATH, read_rules
+from program.sql_session import open_connection, close_connection
+from program.typed_loading import TYPED_CHUNK_SIZE, read_typed_sql
+from program.helper_functions import DIAGNOSTICS_LEVELS, set_diagnostics_level, report_import_times
+from program.instrumentation import start_run_metrics, write_run_metrics
+from program.pipeline_scheduler import Stage, run_stages
+from program.stage_cache import StageCache
 
 database_path = "program/database/netflix_database.db"
 project_id = "python-rocket-1"
@@ -18,30 +40,386 @@ table_id = "ratings"
 csv_file_path_ratings = "program/data_sources/ratings.csv"
 csv_file_path_netflix_shows = "program/data_sources/netflix_shows.csv"
 csv_file_path_gdp_per_capita = "program/data_sources/gdp_per_capita.csv"
+csv_file_path_popular_directors = "program/data_sources/popular_directors.csv"
+csv_file_path_recommendations = "program/data_export/shows_for_kids_recommendation.csv"
+parquet_file_path_netflix_shows = "program/data_sources/netflix_shows.parquet"
+parquet_file_path_recommendations = "program/data_export/shows_for_kids_recommendation.parquet"
 name_view = "VIEW_NETFLIX_SHOWS_WITH_RATING"
+metrics_file_path_default = "program/database/pipeline_metrics.json"
+stage_cache_dir = "program/database/stage_cache"
+
+startup_import_seconds = time.perf_counter() - import_start_time
+
+# Stages of the pipeline, each of them run on its own by the subcommand of the same name with dashes
+STAGE_COMMANDS = {
+    "download_blob": "download the Netflix shows CSV from Cloud Storage",
+    "read_from_bigquery_and_save_csv": "export the ratings from BigQuery to CSV",
+    "read_gdp_cache": "read the cached GDP per capita of the countries of the shows",
+    "fetch_gdp_per_capita": "fetch the GDP per capita of the countries missing from the cache",
+    "write_gdp_cache": "save the fetched GDP per capita to the cache",
+    "create_sql_tables": "create the tables of the database",
+    "stage_csv_to_parquet": "parse the shows CSV into the Parquet staging file (--staging-format parquet)",
+    "get_unique_countries": "read the countries from the Parquet staging file (--staging-format parquet)",
+    "load_netflix_shows": "load the shows CSV into NETFLIX_SHOWS, its bridge tables and the search index",
+    "mark_shows_changed_by_lookups": "mark every show as changed when a lookup file changed (--incremental)",
+    "load_lookup_tables": "load the ratings, GDP per capita and popular directors",
+    "join_tables": "join the shows with their rating into NETFLIX_META_WITH_RATING",
+    "create_view": "create the view of the shows with their rating",
+    "clean_and_create_table": "clean the shows into NETFLIX_COMBINED_CLEANED",
+    "filter_kids_friendly_movies_from_sql": "filter the kids-friendly shows",
+    "clean_and_filter_kids_friendly_in_sql": "clean and filter the kids-friendly shows in SQL (--execution-mode sql)",
+    "create_shows_for_kids_recommendation_table": "score the kids-friendly shows into the recommendations",
+    "create_shows_for_kids_recommendation_table_in_batches":
+        "filter and score the kids-friendly shows a batch at a time (--execution-mode batch)",
+    "clean_and_recommend_in_shards":
+        "clean, filter and score the shows in one worker process per shard (--execution-mode sharded)",
+}
+
+
+def unique_countries_stage():
+    # Module-level, so the process pool can pickle it
+    return {"unique_countries": get_unique_countries_from_parquet(parquet_file_path_netflix_shows)}
+
+
+def build_stages(connection, artifacts, incremental=False, execution_mode="pandas", sentiment_mode="cached",
+                 staging_format="csv", gdp_scoring=None, excluded_queries=KIDS_EXCLUDED_QUERIES,
+                 keep_versions=KEPT_VERSIONS, ratings_watermark=None, popularity_rules=POPULARITY_RULES_PATH,
+                 batch_size=TYPED_CHUNK_SIZE, shards=None):
+    """
+    Describe the pipeline as stages with the artifacts they read and write.
+
+    In-memory artifacts such as the country list or the kids-friendly shows are read from `artifacts`;
+    when their stage was not selected with --only/--from they are recomputed from the database or files.
+    The 'batch' execution mode never holds the catalog in memory: the kids-friendly shows are not an
+    artifact, they are streamed from NETFLIX_COMBINED_CLEANED by the recommendation stage. The 'sharded'
+    execution mode runs the cleaning, the kids filter and the recommendations as a single stage, whose worker
+    processes each read their shard of the shows from the database file.
+    The shows CSV is parsed once: the loader streams it through `source`, which collects the unique
+    countries on the way.
+    """
+    source = SourceReader(csv_file_path_netflix_shows)
+    # Without a load state (first incremental load, or reset by a rollback) the published output tables may hold
+    # shows the state does not describe: the load stays incremental to record the state, the outputs are rebuilt
+    update_outputs = incremental and has_load_state(connection)
+    if incremental and not update_outputs:
+        print("No incremental load state, the output tables are rebuilt in full")
+
+    def unique_countries():
+        if "unique_countries" not in artifacts:
+            artifacts.update(unique_countries_stage() if not countries_from_loader
+                             else {"unique_countries": source.unique_countries()})
+        return artifacts["unique_countries"]
+
+    def download():
+        download_blob(bucket_name=bucket_name, source_blob_name=source_blob_name,
+                      destination_file_name=destination_file_name, project_id=project_id,
+                      service_account_file=service_user_key_file_path)
+
+    def export_ratings():
+        read_from_bigquery_and_save_csv(project_id=project_id, dataset_id=dataset_id, table_id=table_id,
+                                        service_user_key_path=service_user_key_bigquery_path,
+                                        csv_file_path=csv_file_path_ratings, watermark_column=ratings_watermark)
+
+    def read_cache():
+        create_gdp_cache_table(connection)
+        return {"cached_gdp": read_gdp_cache(connection, unique_countries(), GDP_CACHE_TTL)}
+
+    def fetch_gdp():
+        # Runs in a worker thread, so the cache is read and written by the 'db' stages around it; the API key is
+        # only needed here, the other stages run without program/authorization/api_key.py
+        from program.authorization.api_key import API_KEY, API_URL
+        fetched_gdp = fetch_gdp_per_capita(unique_countries(), api_key=API_KEY, api_url=API_URL,
+                                           csv_file_path=csv_file_path_gdp_per_capita, is_test=False,
+                                           cached_gdp=artifacts.get("cached_gdp"))
+        return {"fetched_gdp": fetched_gdp}
+
+    def write_cache():
+        write_gdp_cache(connection, artifacts.get("fetched_gdp") or {})
 
+    def load_shows():
+        # The lookup files are only written after the GDP fetch, which waits for the countries of this load
+        changed_rows = load_netflix_shows(connection, loader=netflix_shows_loader, source=source, check_lookups=False)
+        loaded = {"loaded_changed_rows" if incremental else "changed_rows": changed_rows}
+        if countries_from_loader:
+            loaded["unique_countries"] = source.unique_countries()
+        return loaded
 
-def main():
+    def mark_lookup_changes():
+        changed_rows = mark_shows_changed_by_lookups(connection, lookup_file_paths)
+        if changed_rows == 0:
+            print("No shows changed since the last run, the output tables are up to date.")
+        return {"changed_rows": changed_rows}
+
+    def no_changed_shows(run_artifacts):
+        return incremental and run_artifacts.get("changed_rows") == 0
+
+    def clean_and_filter_in_sql():
+        return {"kids_friendly_shows": clean_and_filter_kids_friendly_in_sql(
+            connection, view=name_view, excluded_queries=excluded_queries)}
+
+    def filter_kids_friendly():
+        return {"kids_friendly_shows": filter_kids_friendly_movies_from_sql(connection, incremental=update_outputs,
+                                                                            excluded_queries=excluded_queries)}
+
+    def create_recommendations():
+        if "kids_friendly_shows" not in artifacts:
+            if execution_mode == "sql":
+                artifacts["kids_friendly_shows"] = read_typed_sql("SELECT * FROM NETFLIX_KIDS_FRIENDLY", connection)
+            else:
+                artifacts.update(filter_kids_friendly())
+        create_shows_for_kids_recommendation_table(netflix_data=artifacts["kids_friendly_shows"],
+                                                   connection=connection, incremental=update_outputs,
+                                                   sentiment_mode=sentiment_mode, export_format=staging_format,
+                                                   gdp_scoring=gdp_scoring, keep_versions=keep_versions,
+                                                   rules_path=popularity_rules)
+
+    def create_recommendations_in_shards():
+        clean_and_recommend_in_shards(connection, database_path, view=name_view, shards=shards, batch_size=batch_size,
+                                      sentiment_mode=sentiment_mode, export_format=staging_format,
+                                      gdp_scoring=gdp_scoring, keep_versions=keep_versions,
+                                      rules_path=popularity_rules, excluded_queries=excluded_queries)
+
+    def create_recommendations_in_batches():
+        create_shows_for_kids_recommendation_table_in_batches(connection, batch_size=batch_size,
+                                                              sentiment_mode=sentiment_mode,
+                                                              export_format=staging_format, gdp_scoring=gdp_scoring,
+                                                              keep_versions=keep_versions, rules_path=popularity_rules,
+                                                              excluded_queries=excluded_queries)
+
+    # The incremental loader compares the hash of every CSV row with LOAD_STATE, so it keeps reading the CSV
+    netflix_shows_loader = "incremental" if incremental else "parquet" if staging_format == "parquet" else "stream"
+    netflix_shows_source = parquet_file_path_netflix_shows if netflix_shows_loader == "parquet" \
+        else csv_file_path_netflix_shows
+    countries_from_loader = netflix_shows_loader != "parquet"
+    recommendations_export = csv_file_path_recommendations if staging_format == "csv" \
+        else parquet_file_path_recommendations
+
+    # A change of the popularity rules recomputes every show, like a change of the lookup files
+    lookup_file_paths = [*LOOKUP_FILE_PATHS, popularity_rules]
+    rules_lookup_paths = list(dict.fromkeys(rule["lookup"]["path"] for rule in read_rules(popularity_rules)["rules"]))
+    kids_filter_params = {"excluded_ratings": KIDS_EXCLUDED_RATINGS,
+                          "excluded_queries": excluded_queries}
+    recommendation_params = {"sentiment_mode": sentiment_mode,
+                             "positive_threshold": POSITIVE_SENTIMENT_THRESHOLD,
+                             "gdp_scoring": gdp_scoring}
+    recommendation_inputs = ["NETFLIX_SHOWS", "SHOW_GENRE", popularity_rules, *rules_lookup_paths]
+
+    stages = [
+        Stage("download_blob", download, kind="io", outputs=[csv_file_path_netflix_shows]),
+        Stage("read_from_bigquery_and_save_csv", export_ratings, kind="io", outputs=[csv_file_path_ratings]),
+        Stage("read_gdp_cache", read_cache, inputs=["unique_countries"], outputs=["cached_gdp"]),
+        Stage("fetch_gdp_per_capita", fetch_gdp, kind="io", inputs=["unique_countries", "cached_gdp"],
+              outputs=[csv_file_path_gdp_per_capita, "fetched_gdp"]),
+        Stage("write_gdp_cache", write_cache, inputs=["fetched_gdp"], outputs=["GDP_API_CACHE"]),
+        Stage("create_sql_tables", lambda: create_sql_tables(connection), outputs=["schema"]),
+        Stage("load_netflix_shows", load_shows, inputs=[netflix_shows_source, "schema"],
+              outputs=["NETFLIX_SHOWS", *BRIDGE_TABLES, SEARCH_INDEX,
+                       "loaded_changed_rows" if incremental else "changed_rows",
+                       *(["unique_countries"] if countries_from_loader else [])],
+              cacheable=True,
+              params={"loader": netflix_shows_loader}),
+        Stage("load_lookup_tables", lambda: load_lookup_tables(connection),
+              inputs=["schema", csv_file_path_ratings, csv_file_path_gdp_per_capita, csv_file_path_popular_directors],
+              outputs=["RATINGS", "GDP_PER_CAPITA", "POPULAR_DIRECTORS"], cacheable=True),
+        Stage("join_tables",
+              lambda: join_tables(connection, new_table="NETFLIX_META_WITH_RATING", incremental=update_outputs,
+                                  batch_size=batch_size if execution_mode in ("batch", "sharded") else None),
+              inputs=["NETFLIX_SHOWS", "RATINGS", "changed_rows"], outputs=["NETFLIX_META_WITH_RATING"],
+              skip_if=no_changed_shows, cacheable=True),
+        Stage("create_view", lambda: create_view(connection, new_view=name_view),
+              inputs=["NETFLIX_SHOWS", "RATINGS", "changed_rows"], outputs=[name_view], skip_if=no_changed_shows,
+              cacheable=True),
+    ]
+    if incremental:
+        stages.append(Stage("mark_shows_changed_by_lookups", mark_lookup_changes,
+                            inputs=["loaded_changed_rows", *lookup_file_paths], outputs=["changed_rows"]))
+    if staging_format == "parquet":
+        # Parse the downloaded CSV once; the country list and the shows load read the Parquet file
+        stages.append(Stage("stage_csv_to_parquet", stage_csv_to_parquet, kind="cpu",
+                            args=(csv_file_path_netflix_shows, parquet_file_path_netflix_shows),
+                            inputs=[csv_file_path_netflix_shows], outputs=[parquet_file_path_netflix_shows],
+                            cacheable=True, params={"dictionary_columns": DICTIONARY_COLUMNS}))
+    if not countries_from_loader:
+        # The Parquet loader does not go through `source`, the countries are read from the staged column
+        stages.append(Stage("get_unique_countries", unique_countries_stage, kind="cpu",
+                            inputs=[parquet_file_path_netflix_shows], outputs=["unique_countries"], cacheable=True))
+    if execution_mode == "sql":
+        stages.append(Stage("clean_and_filter_kids_friendly_in_sql", clean_and_filter_in_sql,
+                            inputs=[name_view, SEARCH_INDEX], outputs=["NETFLIX_KIDS_FRIENDLY", "kids_friendly_shows"],
+                            cacheable=True, params=kids_filter_params))
+    elif execution_mode == "batch":
+        stages.append(Stage("clean_and_create_table",
+                            lambda: clean_and_create_table(connection, view=name_view, keep_versions=keep_versions,
+                                                           batch_size=batch_size),
+                            inputs=[name_view], outputs=["NETFLIX_COMBINED_CLEANED"], cacheable=True))
+    elif execution_mode == "sharded":
+        # Each shard is cleaned, filtered and scored in its own process, then the shards are merged
+        stages.append(Stage("clean_and_recommend_in_shards", create_recommendations_in_shards,
+                            inputs=[name_view, SEARCH_INDEX, *recommendation_inputs],
+                            outputs=["NETFLIX_COMBINED_CLEANED", "SHOWS_FOR_KIDS_RECOMMENDATION",
+                                     recommendations_export],
+                            cacheable=True, params={**kids_filter_params, **recommendation_params}))
+    else:
+        stages += [
+            Stage("clean_and_create_table",
+                  lambda: clean_and_create_table(connection, view=name_view, incremental=update_outputs,
+                                                 keep_versions=keep_versions),
+                  inputs=[name_view], outputs=["NETFLIX_COMBINED_CLEANED"], cacheable=True),
+            Stage("filter_kids_friendly_movies_from_sql", filter_kids_friendly,
+                  inputs=["NETFLIX_COMBINED_CLEANED", SEARCH_INDEX], outputs=["kids_friendly_shows"], cacheable=True,
+                  params=kids_filter_params),
+        ]
+    if execution_mode == "batch":
+        # The kids-friendly shows are streamed from NETFLIX_COMBINED_CLEANED, filtered and scored a batch at a time
+        stages.append(Stage("create_shows_for_kids_recommendation_table_in_batches", create_recommendations_in_batches,
+                            inputs=["NETFLIX_COMBINED_CLEANED", SEARCH_INDEX, *recommendation_inputs],
+                            outputs=["SHOWS_FOR_KIDS_RECOMMENDATION", recommendations_export], cacheable=True,
+                            params={**kids_filter_params, **recommendation_params}))
+    elif execution_mode != "sharded":
+        stages.append(Stage("create_shows_for_kids_recommendation_table", create_recommendations,
+                            inputs=["kids_friendly_shows", *recommendation_inputs],
+                            outputs=["SHOWS_FOR_KIDS_RECOMMENDATION", recommendations_export], cacheable=True,
+                            params=recommendation_params))
+    return stages
+
+
+def main(incremental=False, execution_mode="pandas", sentiment_mode="cached", in_memory=False, pragmas=None,
+         trace_memory=False, metrics_file_path=metrics_file_path_default, only=None, from_stage=None, force=False,
+         staging_format="csv", gdp_scoring=None, excluded_queries=KIDS_EXCLUDED_QUERIES,
+         keep_versions=KEPT_VERSIONS, ratings_watermark=None, popularity_rules=POPULARITY_RULES_PATH,
+         batch_size=TYPED_CHUNK_SIZE, shards=None):
     print("---------------------")
     print("netflix for kids")
     print("---------------------")
-    download_blob(bucket_name=bucket_name, source_blob_name=source_blob_name,
-                  destination_file_name=destination_file_name, project_id=project_id,
-                  service_account_file=service_user_key_file_path)
-    read_from_bigquery_and_save_csv(project_id=project_id, dataset_id=dataset_id, table_id=table_id,
-                                    service_user_key_path=service_user_key_bigquery_path,
-                                    csv_file_path=csv_file_path_ratings)
-    unique_countries = get_unique_countries(csv_file_path_netflix_shows)
-    fetch_gdp_per_capita(unique_countries, api_key=API_KEY, api_url=API_URL, csv_file_path=csv_file_path_gdp_per_capita,
-                         is_test=False)
-    create_sql_tables(database_path)
-    insert_data_into_tables(database_path)
-    join_tables(database_path=database_path, new_table="NETFLIX_META_WITH_RATING")
-    create_view(database_path=database_path, new_view=name_view)
-    clean_and_create_table(database_path=database_path, view=name_view)
-    filter_for_kids = filter_kids_friendly_movies_from_sql(database_path=database_path)
-    create_shows_for_kids_recommendation_table(database_path=database_path, netflix_data=filter_for_kids)
+    run_metrics = start_run_metrics(trace_memory=trace_memory)
+    connection = open_connection(database_path, pragmas=pragmas, in_memory=in_memory)
+    artifacts = {}
+    succeeded = False
+    try:
+        stages = build_stages(connection, artifacts, incremental=incremental, execution_mode=execution_mode,
+                              sentiment_mode=sentiment_mode, staging_format=staging_format,
+                              gdp_scoring=gdp_scoring, excluded_queries=excluded_queries,
+                              keep_versions=keep_versions, ratings_watermark=ratings_watermark,
+                              popularity_rules=popularity_rules, batch_size=batch_size, shards=shards)
+        # Incremental runs track their changes with LOAD_STATE, and their stages depend on the previous output
+        stage_cache = None if incremental else StageCache(connection, stage_cache_dir, force=force)
+        run_stages(stages, run_metrics, connection, artifacts, only=only, from_stage=from_stage,
+                   stage_cache=stage_cache)
+        succeeded = True
+    finally:
+        write_run_metrics(run_metrics, metrics_file_path, connection)
+        # A failed run in memory is not copied over the database of the last successful run
+        close_connection(connection, database_path, in_memory=in_memory, snapshot=succeeded)
+
+
+def parse_pragma(value):
+    name, separator, pragma_value = value.partition("=")
+    if not separator:
+        raise argparse.ArgumentTypeError(f"expected NAME=VALUE, got '{value}'")
+    return name.strip(), pragma_value.strip()
+
+
+def build_parser():
+    # Options of a run, shared by run-all and the subcommand of each stage
+    run_options = argparse.ArgumentParser(add_help=False)
+    run_options.add_argument("--incremental", action="store_true",
+                             help="load only new or changed shows and recompute only their rows; the first "
+                                  "incremental run, and the next one after a rollback of an output table, "
+                                  "rebuild the output tables in full")
+    run_options.add_argument("--execution-mode", choices=["pandas", "sql", "batch", "sharded"], default="pandas",
+                             help="run the cleaning and kids filter in pandas (reference), as one SQL statement, "
+                                  "in pandas a batch of rows at a time for catalogs larger than memory, or in one "
+                                  "worker process per shard of the shows")
+    run_options.add_argument("--batch-size", type=int, default=TYPED_CHUNK_SIZE,
+                             help="number of rows cleaned, filtered and scored at a time by --execution-mode batch "
+                                  "and by each worker of --execution-mode sharded")
+    run_options.add_argument("--shards", type=int, default=None,
+                             help="number of shards of the shows, ranges of show_id of about the same size, and "
+                                  "of worker processes of --execution-mode sharded; defaults to the number of CPUs")
+    run_options.add_argument("--sentiment-mode", choices=["cached", "serial"], default="cached",
+                             help="score descriptions in a process pool with a persistent cache, or one by one "
+                                  "(baseline)")
+    run_options.add_argument("--in-memory", action="store_true",
+                             help="run on an in-memory copy of the database and snapshot it to disk at the end")
+    run_options.add_argument("--pragma", type=parse_pragma, action="append", default=[], metavar="NAME=VALUE",
+                             help="override one of the default SQLite pragmas, e.g. --pragma synchronous=FULL")
+    run_options.add_argument("--diagnostics", choices=DIAGNOSTICS_LEVELS, default=None,
+                             help="how much data is read back after each stage: off, counts (default), sample or "
+                                  "full; defaults to the NETFLIX_DIAGNOSTICS environment variable")
+    run_options.add_argument("--diagnostics-sample-size", type=int, default=None,
+                             help="number of rows shown per table at the sample level")
+    run_options.add_argument("--trace-memory", action="store_true",
+                             help="also record the peak of Python allocations per stage with tracemalloc (slower)")
+    run_options.add_argument("--profile-imports", action="store_true",
+                             help="report the time spent importing modules, at startup and on first use by the "
+                                  "stages")
+    run_options.add_argument("--metrics-file", default=metrics_file_path_default,
+                             help="path of the JSON summary with the per-stage metrics of the run")
+    run_options.add_argument("--staging-format", choices=["csv", "parquet"], default="csv",
+                             help="parse the shows CSV once into a dictionary-encoded Parquet file read by the later "
+                                  "stages, and export the recommendations as Parquet")
+    run_options.add_argument("--gdp-scoring", choices=list(AGGREGATES), default=None,
+                             help="demote shows from a single low-GDP country, or shows whose countries have a low "
+                                  "GDP per capita on average; defaults to the aggregate of the rule file")
+    run_options.add_argument("--popularity-rules", default=POPULARITY_RULES_PATH, metavar="PATH",
+                             help="JSON rule file scoring the popularity of the shows, see "
+                                  "program/popularity_rules.py")
+    run_options.add_argument("--exclude-query", dest="excluded_queries", action="append", default=None,
+                             metavar="QUERY",
+                             help="full-text query matching shows which are not for kids, e.g. 'description: "
+                                  "horror'; can be repeated, replacing the default queries about war and violence")
+    run_options.add_argument("--keep-versions", type=int, default=KEPT_VERSIONS,
+                             help="number of previous versions of the output tables kept for rollbacks with "
+                                  "python -m program.table_publishing rollback")
+    run_options.add_argument("--ratings-watermark", default=None, metavar="COLUMN",
+                             help="only pull the BigQuery ratings whose COLUMN (e.g. an updated_at timestamp) is "
+                                  "above the highest value of the previous export, merged into the ratings CSV")
+    run_options.add_argument("--force", action="store_true",
+                             help="rerun the stages even when their inputs match a cached run")
+
+    parser = argparse.ArgumentParser(description="ETL pipeline building the Netflix for kids recommendations. "
+                                                 "Without a command, the options are those of run-all.")
+    commands = parser.add_subparsers(dest="command", metavar="COMMAND")
+    run_all = commands.add_parser("run-all", parents=[run_options], help="run every stage of the pipeline")
+    run_all.add_argument("--only", action="append", default=None, metavar="STAGE",
+                         help="run only this stage, reading the outputs of the others from a previous run; "
+                              "can be repeated")
+    run_all.add_argument("--from", dest="from_stage", default=None, metavar="STAGE",
+                         help="run this stage and every stage downstream of it")
+    run_all.set_defaults(stage=None)
+    for stage, description in STAGE_COMMANDS.items():
+        # A single stage reads the outputs of the others from a previous run, like --only
+        stage_command = commands.add_parser(stage.replace("_", "-"), parents=[run_options], help=description,
+                                            description=f"Run the {stage} stage: {description}.")
+        stage_command.set_defaults(stage=stage, only=None, from_stage=None)
+    return parser
 
 
 if __name__ == "__main__":
-    main()
+    parser = build_parser()
+    # Without a command, e.g. `python main.py --incremental`, the options are those of run-all
+    command_line = sys.argv[1:]
+    if not command_line or command_line[0].startswith("-") and command_line[0] not in ("-h", "--help"):
+        command_line = ["run-all", *command_line]
+    args = parser.parse_args(command_line)
+    set_diagnostics_level(args.diagnostics, sample_size=args.diagnostics_sample_size)
+    if args.incremental and args.execution_mode != "pandas":
+        parser.error("--incremental is only supported with --execution-mode pandas")
+    if args.batch_size < 1:
+        parser.error("--batch-size must be at least 1")
+    if args.shards is not None and args.shards < 1:
+        parser.error("--shards must be at least 1")
+    if args.execution_mode == "sharded" and args.in_memory:
+        parser.error("--execution-mode sharded reads the database file from its worker processes, "
+                     "it cannot run --in-memory")
+    try:
+        main(incremental=args.incremental, execution_mode=args.execution_mode, sentiment_mode=args.sentiment_mode,
+             in_memory=args.in_memory, pragmas=dict(args.pragma), trace_memory=args.trace_memory,
+             metrics_file_path=args.metrics_file, only=[args.stage] if args.stage else args.only,
+             from_stage=args.from_stage, force=args.force, staging_format=args.staging_format,
+             gdp_scoring=args.gdp_scoring, excluded_queries=tuple(args.excluded_queries or KIDS_EXCLUDED_QUERIES),
+             keep_versions=args.keep_versions, ratings_watermark=args.ratings_watermark,
+             popularity_rules=args.popularity_rules, batch_size=args.batch_size, shards=args.shards)
+    finally:
+        if args.profile_imports:
+            report_import_times(startup_import_seconds)
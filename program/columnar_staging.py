@@ -0,0 +1,146 @@
+import csv
+import time
+from program.helper_functions import lazy_import
+from program.interaction_with_SQL import NETFLIX_SHOWS_COLUMNS, print_load_rate
+
+pa = lazy_import('pyarrow')
+pa_csv = lazy_import('pyarrow.csv')
+pq = lazy_import('pyarrow.parquet')
+
+# Low-cardinality columns stored as dictionary indexes instead of repeated strings ('rating' holds the rating_id)
+DICTIONARY_COLUMNS = ['type', 'country', 'rating', 'listed_in']
+# Columns which are not text; the others are read as strings, so a numeric-looking title cannot break type inference
+STAGED_COLUMN_TYPES = {'release_year': 'int64'}
+
+
+def staged_column_types(csv_file_path, delimiter, dictionary_columns):
+    with open(csv_file_path, newline='', encoding='utf-8') as csv_file:
+        header = next(csv.reader(csv_file, delimiter=delimiter))
+    return {column: pa.dictionary(pa.int32(), pa.string()) if column in dictionary_columns
+            else pa.type_for_alias(STAGED_COLUMN_TYPES.get(column, 'string')) for column in header}
+
+
+def stage_csv_to_parquet(csv_file_path, parquet_file_path, delimiter=';', dictionary_columns=DICTIONARY_COLUMNS,
+                         block_size=16 << 20):
+    """
+    Parse a CSV once into a Parquet staging file, read by every later stage instead of the CSV.
+
+    The CSV is read in blocks and written batch by batch, so the whole file is never held in memory.
+    `dictionary_columns` are dictionary-encoded, both in memory and in the Parquet file.
+
+    Parameters:
+    - csv_file_path (str): Path of the source CSV.
+    - parquet_file_path (str): Path of the Parquet file to write.
+    - delimiter (str): Delimiter of the CSV.
+    - dictionary_columns (list): Columns to dictionary-encode.
+    - block_size (int): Bytes of CSV parsed per batch.
+
+    Returns:
+    - int: Number of rows staged.
+    """
+    start_time = time.perf_counter()
+    # Empty fields are NULL, like in `iterate_csv_chunks`
+    convert_options = pa_csv.ConvertOptions(
+        strings_can_be_null=True, null_values=[''],
+        column_types=staged_column_types(csv_file_path, delimiter, dictionary_columns))
+    reader = pa_csv.open_csv(csv_file_path, read_options=pa_csv.ReadOptions(block_size=block_size),
+                             parse_options=pa_csv.ParseOptions(delimiter=delimiter),
+                             convert_options=convert_options)
+
+    staged_rows = 0
+    with pq.ParquetWriter(parquet_file_path, reader.schema, use_dictionary=dictionary_columns) as writer:
+        for batch in reader:
+            writer.write_batch(batch)
+            staged_rows += batch.num_rows
+
+    print(f'Staged {staged_rows} rows of {csv_file_path} in {parquet_file_path} '
+          f'in {time.perf_counter() - start_time:.2f} s')
+    return staged_rows
+
+
+def read_staged_columns(parquet_file_path, columns=None):
+    """
+    Read only the given columns of a staging file.
+
+    Parameters:
+    - parquet_file_path (str): Path of the Parquet staging file.
+    - columns (list): Columns to read, None for all of them.
+
+    Returns:
+    - pyarrow.Table: The projected table, dictionary-encoded columns stay encoded.
+    """
+    return pq.read_table(parquet_file_path, columns=columns)
+
+
+def get_unique_countries_from_parquet(parquet_file_path):
+    """
+    Get a list of all unique countries from a Parquet staging file.
+
+    Only the dictionary-encoded 'country' column is read, and its distinct values are split, not every row.
+
+    Parameters:
+    - parquet_file_path (str): Path of the Parquet staging file.
+
+    Returns:
+    - list: A list of unique countries, in order of first appearance.
+    """
+    unique_countries = {}
+    # Each chunk has its own dictionary, so the chunks are visited in order to keep the order of appearance
+    for chunk in read_staged_columns(parquet_file_path, columns=['country'])['country'].chunks:
+        values = chunk.unique()
+        if pa.types.is_dictionary(values.type):
+            values = values.dictionary_decode()
+        for value in values.to_pylist():
+            for country in (value or '').split(','):
+                country = country.strip()
+                if country:
+                    unique_countries[country] = None
+    return list(unique_countries)
+
+
+def iterate_parquet_batches(parquet_file_path, columns=None, batch_size=10000):
+    """
+    Read a Parquet staging file in batches of row tuples, like `iterate_csv_chunks`.
+
+    Parameters:
+    - parquet_file_path (str): Path of the Parquet staging file.
+    - columns (list): Columns to read, None for all of them in file order.
+    - batch_size (int): Number of rows per batch.
+
+    Yields:
+    - list: Rows of the batch as tuples of the given columns.
+    """
+    for batch in pq.ParquetFile(parquet_file_path).iter_batches(batch_size=batch_size, columns=columns):
+        # Decoding a dictionary column in one cast is faster than converting it value by value
+        yield list(zip(*(column.cast(pa.string()).to_pylist() if pa.types.is_dictionary(column.type)
+                         else column.to_pylist() for column in batch.columns)))
+
+
+def stream_parquet_into_table(connection, parquet_file_path, chunk_size=10000):
+    """
+    Replace the contents of NETFLIX_SHOWS with the rows of the Parquet staging file.
+
+    The Parquet counterpart of `stream_netflix_shows_into_table`: the staged columns are in the order
+    of the source CSV, i.e. of NETFLIX_SHOWS_COLUMNS, and are inserted batch by batch.
+
+    Args:
+    - connection (sqlite3.Connection): Open connection to the SQLite database.
+    - parquet_file_path (str): Path of the staged Netflix shows.
+    - chunk_size (int): Number of rows inserted per batch.
+
+    Returns:
+    tuple: The number of inserted rows and the elapsed time in seconds.
+    """
+    start_time = time.perf_counter()
+    insert_query = 'INSERT INTO NETFLIX_SHOWS ({}) VALUES ({})'.format(
+        ', '.join(NETFLIX_SHOWS_COLUMNS), ', '.join('?' * len(NETFLIX_SHOWS_COLUMNS)))
+
+    inserted_rows = 0
+    connection.execute('DELETE FROM NETFLIX_SHOWS')
+    for chunk in iterate_parquet_batches(parquet_file_path, batch_size=chunk_size):
+        connection.executemany(insert_query, chunk)
+        inserted_rows += len(chunk)
+
+    elapsed_time = time.perf_counter() - start_time
+    print_load_rate('NETFLIX_SHOWS', inserted_rows, elapsed_time)
+    return inserted_rows, elapsed_time
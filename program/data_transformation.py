@@ -1,123 +1,392 @@
-import sqlite3
-import pandas as pd
-from nltk.sentiment import SentimentIntensityAnalyzer
+import os
+from program.helper_functions import lazy_import, table_exists, show_dataframe
+from program.interaction_with_SQL import KIDS_EXCLUDED_RATINGS, KIDS_EXCLUDED_QUERIES
+from program.table_publishing import KEPT_VERSIONS, new_table_version, swap_table_version
+from program.full_text_search import excluded_shows_condition
+from program.vectorized_transformations import KEYWORDS_FOR_KIDS, is_listed_for_kids
+from program.sentiment_scoring import score_descriptions
+from program.popularity_rules import AGGREGATES, POPULARITY_RULES_PATH, compile_rules, apply_rules
+from program.typed_loading import TYPED_CHUNK_SIZE, read_typed_sql, iterate_typed_sql, write_typed_batches
 
+pd = lazy_import('pandas')
+pa = lazy_import('pyarrow')
+pq = lazy_import('pyarrow.parquet')
+sentiment = lazy_import('nltk.sentiment')
 
-def filter_kids_friendly_movies_from_sql(database_path):
+# Shows with a sentiment score above this are flagged as positive
+POSITIVE_SENTIMENT_THRESHOLD = 0.2
+# Columns of SHOWS_FOR_KIDS_RECOMMENDATION and of the exported recommendations
+RECOMMENDATION_TABLE_COLUMNS = ['show_id', 'title', 'popularity', 'sentiment_score']
+RECOMMENDATION_EXPORT_COLUMNS = ['show_id', 'title', 'popularity']
+# Arrow types of the columns exported as Parquet, the same for every batch, even one without rows
+RECOMMENDATION_EXPORT_TYPES = {'show_id': 'string', 'title': 'string', 'popularity': 'int64'}
+RECOMMENDATION_EXPORT_PATHS = {
+    'csv': 'program/data_export/shows_for_kids_recommendation.csv',
+    'parquet': 'program/data_export/shows_for_kids_recommendation.parquet',
+}
+
+
+def filter_kids_friendly_movies_from_sql(connection, incremental=False, excluded_ratings=KIDS_EXCLUDED_RATINGS,
+                                         excluded_queries=KIDS_EXCLUDED_QUERIES):
     """
     Filters kids-friendly movies from an SQLite database based on rating and content description.
 
     Parameters:
-    - database_path (str): The path to the SQLite database.
+    - connection (sqlite3.Connection): Open connection to the SQLite database.
+    - incremental (bool): Only filter the shows listed in CHANGED_SHOWS.
+    - excluded_ratings (tuple): Ratings which are not suitable for kids.
+    - excluded_queries (tuple): FTS5 queries over SHOWS_FTS, by default about war or violence.
 
     Returns:
-    - pd.DataFrame: A DataFrame containing kids-friendly movies.
+    - pd.DataFrame: A DataFrame containing kids-friendly movies, with the dtypes of CATALOG_DTYPES.
 
     Steps:
-    1. Connect to the SQLite database.
-    2. Filter out movies not suitable for kids based on rating.
-    3. Remove movies about war or violence from the filtered data.
-    4. Display the result or further process the DataFrame.
+    1. Filter out movies not suitable for kids based on rating.
+    2. Remove movies matching one of the excluded full-text queries, looked up in SHOWS_FTS.
+    3. Display the result or further process the DataFrame.
 
     Example:
     ```python
-    kids_movies = filter_kids_friendly_movies_from_sql('path/to/database.db')
+    kids_movies = filter_kids_friendly_movies_from_sql(connection)
     ```
 
     Note:
-    The function assumes a table named 'NETFLIX_COMBINED_CLEANED' in the database with columns 'rating' and 'description'.
+    The function assumes a table named 'NETFLIX_COMBINED_CLEANED' in the database with a column 'rating', and the
+    SHOWS_FTS index built by `load_netflix_shows`.
     """
 
-    # Connect to the SQLite database
-    connection = sqlite3.connect(database_path)
+    query, query_params = kids_friendly_query(incremental, excluded_ratings, excluded_queries)
+    kids_friendly_data = read_typed_sql(query, connection, params=query_params)
+
+    # Display the result or further process the kids_friendly_data DataFrame
+    print(
+        'Filter out movies where the rating says its not for kids and emove all movies which are about war or violence.\n')
+    show_dataframe('kids_friendly_data', kids_friendly_data)
+    return kids_friendly_data
+
+
+def kids_friendly_query(incremental=False, excluded_ratings=KIDS_EXCLUDED_RATINGS,
+                        excluded_queries=KIDS_EXCLUDED_QUERIES, table='NETFLIX_COMBINED_CLEANED'):
+    # Query of `filter_kids_friendly_movies_from_sql` over the cleaned shows of `table`, and its parameters
 
     # Step 1: Filter out movies not suitable for kids based on rating
     query = '''
   SELECT *
-  FROM NETFLIX_COMBINED_CLEANED
-  WHERE rating NOT IN  ('NC-17', 'TV-MA', 'NR', 'UR')
-  '''
+  FROM {}
+  WHERE rating NOT IN  ({})
+  '''.format(table, ', '.join('?' * len(excluded_ratings)))
+    if incremental:
+        query += "AND show_id IN (SELECT show_id FROM CHANGED_SHOWS)"
 
-    kids_friendly_data = pd.read_sql_query(query, connection)
+    # Step 2: Remove movies about war or violence, with a lookup of the full-text index
+    query_condition, query_params = excluded_shows_condition('show_id', excluded_queries)
+    return query + query_condition, (*excluded_ratings, *query_params)
 
-    # Step 2: Remove movies about war or violence
-    kids_friendly_data = kids_friendly_data[
-        ~kids_friendly_data['description'].str.contains('War') & ~kids_friendly_data['description'].str.contains(
-            'Violence')]
 
-    # Display the result or further process the kids_friendly_data DataFrame
-    print(
-        'Filter out movies where the rating says its not for kids and emove all movies which are about war or violence.\n')
-    print(kids_friendly_data)
-    return kids_friendly_data
+def fill_scored_shows(connection, show_ids):
+    # Temp table of the shows being scored, joined by key with the tables holding their values
+    connection.execute('CREATE TEMP TABLE IF NOT EXISTS SCORED_SHOWS (show_id VARCHAR(50) PRIMARY KEY)')
+    connection.execute('DELETE FROM temp.SCORED_SHOWS')
+    connection.executemany('INSERT OR IGNORE INTO temp.SCORED_SHOWS VALUES (?)', [(show_id,) for show_id in show_ids])
+
+
+def shows_listed_for_kids(connection, show_ids=None):
+    """
+    Get the shows listed in one of the genres for kids, with an index search of SHOW_GENRE.
+
+    Parameters:
+    - connection (sqlite3.Connection): Open connection to the SQLite database.
+    - show_ids (pd.Series): Only look up these shows, by the key of SHOW_GENRE, e.g. a batch; None for all shows.
+
+    Returns:
+    - set: The ids of the shows listed in one of `KEYWORDS_FOR_KIDS`.
+    """
+    genre_placeholders = ', '.join('?' * len(KEYWORDS_FOR_KIDS))
+    if show_ids is None:
+        query = f'SELECT DISTINCT show_id FROM SHOW_GENRE WHERE genre IN ({genre_placeholders})'
+        return {show_id for (show_id,) in connection.execute(query, KEYWORDS_FOR_KIDS)}
+
+    fill_scored_shows(connection, show_ids)
+    listed_for_kids = {show_id for (show_id,) in connection.execute(f'''
+    SELECT DISTINCT g.show_id
+    FROM temp.SCORED_SHOWS AS k
+    JOIN SHOW_GENRE AS g
+    ON g.show_id = k.show_id
+    WHERE g.genre IN ({genre_placeholders})
+    ''', KEYWORDS_FOR_KIDS)}
+    connection.execute('DELETE FROM temp.SCORED_SHOWS')
+    return listed_for_kids
+
+
+def score_popularity(connection, show_ids, gdp_scoring=None, rules_path=POPULARITY_RULES_PATH):
+    """
+    Score the popularity of shows with the rules of a rule file.
+
+    With the default rules, a show gets 0 when the GDP per capita of its countries is below 30000,
+    otherwise 3 when one of its directors is a popular director, otherwise 2. The rules are compiled
+    once into sets of keys (see `compile_rules`), the fields they read are looked up in NETFLIX_SHOWS by
+    key, with every country of a show rather than the cleaned 'many', and all rules are applied in one
+    vectorized pass (see `apply_rules`).
+
+    Parameters:
+    - connection (sqlite3.Connection): Open connection to the SQLite database.
+    - show_ids (pd.Series): Ids of the shows to score.
+    - gdp_scoring (str): How the GDP of a show is taken from its countries, one of `AGGREGATES`; None for
+      the aggregate of the rule file.
+    - rules_path (str): Path of the JSON rule file, see `read_rules`.
+
+    Returns:
+    - pd.Series: The popularity of each show, aligned with `show_ids`.
+    """
+    if gdp_scoring is not None and gdp_scoring not in AGGREGATES:
+        raise ValueError(f"Unknown GDP scoring '{gdp_scoring}', expected one of {list(AGGREGATES)}")
+    compiled = compile_rules(rules_path)
+    fields = list(dict.fromkeys(rule['field'] for rule in compiled['rules']))
+
+    fill_scored_shows(connection, show_ids)
+    shows = read_typed_sql(f'''
+    SELECT ns.show_id{''.join(f', ns.{field}' for field in fields)}
+    FROM temp.SCORED_SHOWS AS k
+    JOIN NETFLIX_SHOWS AS ns
+    ON ns.show_id = k.show_id
+    ''', connection)
+    connection.execute('DELETE FROM temp.SCORED_SHOWS')
+
+    popularity = dict(zip(shows['show_id'], apply_rules(shows, compiled, aggregate=gdp_scoring)))
+    # Every show is in NETFLIX_SHOWS; the dtype is set so a batch without shows still gives an integer column
+    return show_ids.map(popularity).astype('int64')
+
+
+def export_path_for(export_format):
+    if export_format not in RECOMMENDATION_EXPORT_PATHS:
+        raise ValueError(f"Unknown export format '{export_format}', expected 'csv' or 'parquet'")
+    return RECOMMENDATION_EXPORT_PATHS[export_format]
+
+
+def export_recommendations(recommendations, export_format='csv'):
+    """
+    Export the recommendations to 'program/data_export/', as CSV or as Parquet.
+    """
+    print(f'Saving the final DataFrame as a {export_format} file shows_for_kids_recommendation...')
+    # Written as a single batch, so the file has the same column types as the one of the batch execution mode
+    export_recommendations_in_batches([recommendations], export_format)
 
 
-def create_shows_for_kids_recommendation_table(netflix_data, database_path):
+def export_recommendations_in_batches(batches, export_format='csv'):
+    """
+    Export the recommendations batch by batch, to 'program/data_export/'.
+
+    Each batch is appended to a '.part' file as it arrives, which replaces the export once every batch is
+    written, so readers never see a partial export.
+
+    Parameters:
+    - batches (iterable): DataFrames of recommendations, in export order.
+    - export_format (str): 'csv' or 'parquet', format of the exported file.
+
+    Returns:
+    - int: The number of exported rows.
+    """
+    export_path = export_path_for(export_format)
+    part_file_name = f'{export_path}.part'
+
+    exported_rows = 0
+    if export_format == 'csv':
+        with open(part_file_name, 'w', newline='', encoding='utf-8') as part_file:
+            for batch_number, batch in enumerate(batches):
+                batch[RECOMMENDATION_EXPORT_COLUMNS].to_csv(part_file, header=batch_number == 0, index=False)
+                exported_rows += len(batch)
+    else:
+        schema = pa.schema([(column, pa.type_for_alias(type_name))
+                            for column, type_name in RECOMMENDATION_EXPORT_TYPES.items()])
+        with pq.ParquetWriter(part_file_name, schema) as parquet_writer:
+            for batch in batches:
+                parquet_writer.write_table(pa.Table.from_pandas(batch[RECOMMENDATION_EXPORT_COLUMNS], schema=schema,
+                                                                preserve_index=False))
+                exported_rows += len(batch)
+    os.replace(part_file_name, export_path)
+    return exported_rows
+
+
+def publish_recommendations(connection, shadow_table, version, keep_versions=KEPT_VERSIONS):
+    # Index the pages read by `query_recommendations` in the new version, then swap it in for its readers
+    connection.execute(f'CREATE INDEX IF NOT EXISTS {shadow_table}_popularity '
+                       f'ON {shadow_table} (popularity DESC, show_id)')
+    swap_table_version(connection, 'SHOWS_FOR_KIDS_RECOMMENDATION', version, keep_versions=keep_versions)
+
+
+def score_recommendations(netflix_data, connection, sentiment_mode='cached', gdp_scoring=None,
+                          rules_path=POPULARITY_RULES_PATH, sentiment_workers=None):
+    """
+    Score kids-friendly shows and keep the ones for kids, steps 1 to 3 of `create_shows_for_kids_recommendation_table`.
+
+    Each show is scored on its own, so the shows can be scored all at once or a batch at a time.
+
+    Parameters:
+    - netflix_data (pd.DataFrame): The kids-friendly shows.
+    - connection (sqlite3.Connection): Open connection to the SQLite database.
+    - sentiment_mode (str): 'cached' or 'serial', see `create_shows_for_kids_recommendation_table`.
+    - gdp_scoring (str): How the GDP of a show is taken from its countries, see `score_popularity`.
+    - rules_path (str): Path of the JSON rule file scoring the popularity, see `score_popularity`.
+    - sentiment_workers (int): Number of processes scoring the descriptions in 'cached' mode, defaults to the
+      number of CPUs; 1 when the shows are already scored in a worker process.
+
+    Returns:
+    - pd.DataFrame: The shows for kids, with their popularity, sentiment score and positive flag.
+    """
+    positive_threshold = POSITIVE_SENTIMENT_THRESHOLD
+
+    if sentiment_mode == 'serial':
+        # Assign popularity values based on directors' popularity and countries with low GDP
+        netflix_data['popularity'] = score_popularity(connection, netflix_data['show_id'], gdp_scoring=gdp_scoring,
+                                                  rules_path=rules_path)
+
+        # First Extra ideas: Perform sentiment analysis on movie descriptions to identify movies with positive and uplifting content
+
+        sia = sentiment.SentimentIntensityAnalyzer()
+        netflix_data['sentiment_score'] = netflix_data['description'].apply(lambda x: sia.polarity_scores(x)['compound'])
+        netflix_data['is_positive'] = netflix_data['sentiment_score'] > positive_threshold
+
+        # Second Extra ideas: filter for column "listed_in"
+
+        netflix_data = netflix_data[is_listed_for_kids(netflix_data['listed_in'])]
+    elif sentiment_mode == 'cached':
+        # Filter for the genres for kids first, so only the remaining shows are scored
+        listed_for_kids = shows_listed_for_kids(connection, netflix_data['show_id'])
+        netflix_data = netflix_data[netflix_data['show_id'].isin(listed_for_kids)].copy()
+
+        # Assign popularity values based on directors' popularity and countries with low GDP
+        netflix_data['popularity'] = score_popularity(connection, netflix_data['show_id'], gdp_scoring=gdp_scoring,
+                                                  rules_path=rules_path)
+
+        # Perform sentiment analysis on movie descriptions to identify movies with positive and uplifting content
+        netflix_data['sentiment_score'] = score_descriptions(netflix_data['description'].tolist(), connection,
+                                                              max_workers=sentiment_workers)
+        netflix_data['is_positive'] = netflix_data['sentiment_score'] > positive_threshold
+    else:
+        raise ValueError(f"Unknown sentiment mode '{sentiment_mode}', expected 'cached' or 'serial'")
+
+    return netflix_data
+
+
+def create_shows_for_kids_recommendation_table(netflix_data, connection, incremental=False,
+                                               sentiment_mode='cached', export_format='csv', gdp_scoring=None,
+                                               keep_versions=KEPT_VERSIONS, rules_path=POPULARITY_RULES_PATH):
     """
     Creates a recommendation table for kids' shows based on specified criteria and saves it to an SQLite database and CSV file.
 
     Parameters:
     - netflix_data (pd.DataFrame): The DataFrame containing Netflix data.
-    - database_path (str): The path to the SQLite database.
+    - connection (sqlite3.Connection): Open connection to the SQLite database.
+    - incremental (bool): `netflix_data` only holds the shows listed in CHANGED_SHOWS; replace just their rows
+      in a copy of the table and re-export the CSV in source order.
+    - sentiment_mode (str): 'cached' to score only the shows left after the 'listed_in' filter, in a process
+      pool and through the SENTIMENT_CACHE table; 'serial' for the original one-by-one scoring of every row.
+    - export_format (str): 'csv' or 'parquet', format of the exported file.
+    - gdp_scoring (str): How the GDP of a show is taken from its countries, see `score_popularity`.
+    - keep_versions (int): Number of previous versions of the table kept for rollbacks.
+    - rules_path (str): Path of the JSON rule file scoring the popularity, see `score_popularity`.
 
     Steps:
-    1. Create a new column "popularity" with a default value of 2.
-    2. Load the list of popular directors from 'popular_directors.csv'.
-    3. Load information about GDP from 'gdp_per_capita.csv'.
-    4. Assign popularity values based on conditions: directors' popularity and countries with low GDP.
-    5. Perform sentiment analysis on movie descriptions to identify movies with positive and uplifting content.
-    6. Filter shows based on the 'listed_in' column for children and family content.
-    7. Save the final DataFrame as an SQL table named "SHOWS_FOR_KIDS_RECOMMENDATION" in the specified database.
-    8. Save the final DataFrame as a CSV file in 'program/data_export/shows_for_kids_recommendation.csv'.
+    1. Create a new column "popularity" with the rules of `rules_path`: by default 3 for shows by popular
+       directors, 0 for shows from countries with a low GDP, otherwise 2 (see `score_popularity`).
+    2. Filter shows based on the 'listed_in' column for children and family content.
+    3. Perform sentiment analysis on movie descriptions to identify movies with positive and uplifting content.
+    4. Save the final DataFrame as an SQL table named "SHOWS_FOR_KIDS_RECOMMENDATION" in the specified database,
+       with the sentiment score, as a new version swapped in for its readers (see `swap_table_version`).
+    5. Save the final DataFrame as 'program/data_export/shows_for_kids_recommendation.csv' (or .parquet).
 
     Example:
     ```python
-    create_shows_for_kids_recommendation_table(netflix_data, 'path/to/database.db')
+    create_shows_for_kids_recommendation_table(netflix_data, connection)
     ```
 
     Note:
-    - Assumes the presence of 'popular_directors.csv' and 'gdp_per_capita.csv' in the 'program/data_sources/' directory.
+    - Assumes NETFLIX_SHOWS and SHOW_GENRE are loaded (see `load_netflix_shows`), and the lookup files of the
+      rules are written.
     - Requires the 'pandas' and 'sqlite3' libraries.
     """
 
-    # Create a new column "popularity" with a default value of 2
-    netflix_data['popularity'] = 2
+    netflix_data = score_recommendations(netflix_data, connection, sentiment_mode=sentiment_mode,
+                                         gdp_scoring=gdp_scoring, rules_path=rules_path)
 
-    # Load the list of popular directors
-    popular_directors = pd.read_csv("program/data_sources/popular_directors.csv", delimiter=';')
-    popular_directors['director'] = popular_directors['director'].str.split(',')
-    popular_directors = popular_directors.explode('director')
-    popular_directors['director'] = popular_directors['director'].str.strip()
+    # Save the final DataFrame as an SQL table, with the sentiment score the recommendations can be queried by
+    print('Saving the final DataFrame as an SQL table shows_for_kids_recommendation...')
+    if incremental and table_exists(connection, 'SHOWS_FOR_KIDS_RECOMMENDATION'):
+        shadow_table, version = new_table_version(connection, 'SHOWS_FOR_KIDS_RECOMMENDATION', copy_published=True)
+        # Tables written before the sentiment score was kept get the column, empty for the unchanged shows
+        if 'sentiment_score' not in [column for _, column, *_ in
+                                     connection.execute(f'PRAGMA table_info({shadow_table})')]:
+            connection.execute(f'ALTER TABLE {shadow_table} ADD COLUMN sentiment_score FLOAT')
 
-    # Load information about GDP
-    gdp_per_capita = pd.read_csv("program/data_sources/gdp_per_capita.csv")
+        # Replace only the rows of the changed shows
+        connection.execute(f'DELETE FROM {shadow_table} WHERE show_id IN (SELECT show_id FROM CHANGED_SHOWS)')
+        netflix_data[RECOMMENDATION_TABLE_COLUMNS].to_sql(shadow_table, connection, if_exists='append', index=False)
+        publish_recommendations(connection, shadow_table, version, keep_versions=keep_versions)
 
-    # Assign popularity values based on conditions
-    netflix_data.loc[netflix_data['director'].isin(popular_directors['director']), 'popularity'] = 3
-    netflix_data.loc[netflix_data['country'].isin(
-        gdp_per_capita['Country'][gdp_per_capita['GDP_per_capita'] < 30000]), 'popularity'] = 0
+        # Export the whole table in the order of the source file
+        recommendations = pd.read_sql_query('''
+        SELECT r.show_id, r.title, r.popularity
+        FROM SHOWS_FOR_KIDS_RECOMMENDATION AS r
+        JOIN LOAD_STATE AS s
+        ON r.show_id = s.show_id
+        ORDER BY s.source_row
+        ''', connection)
+        export_recommendations(recommendations, export_format)
+        return
 
-    # First Extra ideas: Perform sentiment analysis on movie descriptions to identify movies with positive and uplifting content
+    shadow_table, version = new_table_version(connection, 'SHOWS_FOR_KIDS_RECOMMENDATION')
+    netflix_data[RECOMMENDATION_TABLE_COLUMNS].to_sql(shadow_table, connection, if_exists='replace', index=False,
+                                       index_label='show_id')
+    publish_recommendations(connection, shadow_table, version, keep_versions=keep_versions)
 
-    sia = SentimentIntensityAnalyzer()
-    netflix_data['sentiment_score'] = netflix_data['description'].apply(lambda x: sia.polarity_scores(x)['compound'])
-    positive_threshold = 0.2
-    netflix_data['is_positive'] = netflix_data['sentiment_score'] > positive_threshold
+    # Save the final DataFrame as a CSV file
+    export_recommendations(netflix_data[RECOMMENDATION_EXPORT_COLUMNS], export_format)
 
-    # Second Extra ideas: filter for column "listed_in"
 
-    keywords_for_kids = ['Children & Family Movies', "Kids' TV"]
+def create_shows_for_kids_recommendation_table_in_batches(connection, batch_size=TYPED_CHUNK_SIZE,
+                                                          sentiment_mode='cached', export_format='csv',
+                                                          gdp_scoring=None, keep_versions=KEPT_VERSIONS,
+                                                          rules_path=POPULARITY_RULES_PATH,
+                                                          excluded_ratings=KIDS_EXCLUDED_RATINGS,
+                                                          excluded_queries=KIDS_EXCLUDED_QUERIES):
+    """
+    Filter the kids-friendly shows and create the recommendations a batch at a time, for catalogs which do not
+    fit in memory.
 
-    netflix_data = netflix_data[
-        netflix_data['listed_in'].apply(lambda x: any(keyword in x for keyword in keywords_for_kids))]
+    This is the out-of-core counterpart of `filter_kids_friendly_movies_from_sql` followed by
+    `create_shows_for_kids_recommendation_table`. The kids-friendly shows of NETFLIX_COMBINED_CLEANED are
+    fetched `batch_size` rows at a time, and each batch flows through a chain of generators: it is scored
+    (see `score_recommendations`), appended to a new version of SHOWS_FOR_KIDS_RECOMMENDATION, then appended
+    to the export. Only one batch is held in memory, and the table and the export are the same as with the
+    in-memory path.
 
-    # Save the final DataFrame as an SQL table
-    print('Saving the final DataFrame as an SQL table shows_for_kids_recommendation...')
-    connection = sqlite3.connect(database_path)
-    netflix_data[['show_id', 'title', 'popularity']].to_sql("SHOWS_FOR_KIDS_RECOMMENDATION", connection,
-                                                            if_exists='replace', index=False, index_label='show_id')
+    Parameters:
+    - connection (sqlite3.Connection): Open connection to the SQLite database.
+    - batch_size (int): Number of shows read, scored and written at a time.
+    - sentiment_mode (str): 'cached' or 'serial', see `create_shows_for_kids_recommendation_table`.
+    - export_format (str): 'csv' or 'parquet', format of the exported file.
+    - gdp_scoring (str): How the GDP of a show is taken from its countries, see `score_popularity`.
+    - keep_versions (int): Number of previous versions of the table kept for rollbacks.
+    - rules_path (str): Path of the JSON rule file scoring the popularity, see `score_popularity`.
+    - excluded_ratings (tuple): Ratings which are not suitable for kids.
+    - excluded_queries (tuple): FTS5 queries over SHOWS_FTS, by default about war or violence.
 
-    # Save the final DataFrame as a CSV file
-    print('Saving the final DataFrame as a CSV file shows_for_kids_recommendation...')
-    netflix_data[['show_id', 'title', 'popularity']].to_csv("program/data_export/shows_for_kids_recommendation.csv",
-                                                            index=False)
+    Returns:
+    - int: The number of recommended shows.
+    """
+    query, query_params = kids_friendly_query(excluded_ratings=excluded_ratings, excluded_queries=excluded_queries)
+    kids_friendly_batches = iterate_typed_sql(query, connection, params=query_params, chunk_size=batch_size)
+    recommendation_batches = (score_recommendations(batch, connection, sentiment_mode=sentiment_mode,
+                                                    gdp_scoring=gdp_scoring, rules_path=rules_path)
+                              for batch in kids_friendly_batches)
+
+    shadow_table, version = new_table_version(connection, 'SHOWS_FOR_KIDS_RECOMMENDATION')
+    print(f'Saving the recommendations batch by batch as an SQL table and a {export_format} file '
+          f'shows_for_kids_recommendation...')
+    written_batches = write_typed_batches(recommendation_batches, shadow_table, connection,
+                                          columns=RECOMMENDATION_TABLE_COLUMNS)
+    recommended_shows = export_recommendations_in_batches(written_batches, export_format)
+    publish_recommendations(connection, shadow_table, version, keep_versions=keep_versions)
+
+    print(f'Recommended {recommended_shows} shows in batches of {batch_size} rows')
+    return recommended_shows
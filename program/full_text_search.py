@@ -0,0 +1,136 @@
+import argparse
+import os
+import sqlite3
+import time
+from program.helper_functions import lazy_import, show_data_from_table
+
+pd = lazy_import('pandas')
+
+# FTS5 index of NETFLIX_SHOWS, one row per show
+SEARCH_INDEX = 'SHOWS_FTS'
+SEARCH_COLUMNS = ['title', 'description', 'listed_in']
+# Case-folded and Porter-stemmed tokens: 'War' matches 'war' and 'wars', 'violen*' matches 'violent' and 'violence'
+SEARCH_TOKENIZER = 'porter unicode61 remove_diacritics 2'
+
+
+def create_search_index(cursor):
+    """
+    Create the SHOWS_FTS full-text index over the title, description and listed_in of the shows.
+
+    Parameters:
+    - cursor (sqlite3.Cursor or sqlite3.Connection): Cursor of the SQLite database.
+    """
+    cursor.execute(f"""
+    CREATE VIRTUAL TABLE IF NOT EXISTS {SEARCH_INDEX} USING fts5(
+        show_id UNINDEXED, {', '.join(SEARCH_COLUMNS)}, tokenize = '{SEARCH_TOKENIZER}'
+    );
+    """)
+
+
+def build_search_index(connection, incremental=False):
+    """
+    Fill SHOWS_FTS from NETFLIX_SHOWS.
+
+    Parameters:
+    - connection (sqlite3.Connection): Open connection to the SQLite database.
+    - incremental (bool): Only reindex the shows listed in CHANGED_SHOWS.
+
+    Returns:
+    - int: The number of shows indexed.
+    """
+    start_time = time.perf_counter()
+    select_query = 'SELECT ns.show_id, {} FROM NETFLIX_SHOWS AS ns'.format(
+        ', '.join(f'ns.{column}' for column in SEARCH_COLUMNS))
+    # A database created before the index existed gets it in full once
+    incremental = incremental and connection.execute(f'SELECT 1 FROM {SEARCH_INDEX} LIMIT 1').fetchone() is not None
+
+    if incremental:
+        connection.execute(f'DELETE FROM {SEARCH_INDEX} WHERE show_id IN (SELECT show_id FROM CHANGED_SHOWS)')
+        select_query += " WHERE ns.show_id IN (SELECT show_id FROM CHANGED_SHOWS WHERE change_type = 'upsert')"
+    else:
+        # Recreating the index is faster than deleting each of its rows
+        connection.execute(f'DROP TABLE IF EXISTS {SEARCH_INDEX}')
+        create_search_index(connection)
+    indexed_rows = connection.execute(
+        f'INSERT INTO {SEARCH_INDEX} (show_id, {", ".join(SEARCH_COLUMNS)}) {select_query}').rowcount
+    if not incremental:
+        # Merge the segments written by the insert, so a query reads one b-tree per term
+        connection.execute(f"INSERT INTO {SEARCH_INDEX} ({SEARCH_INDEX}) VALUES ('optimize')")
+
+    print(f'Indexed {indexed_rows} shows in {SEARCH_INDEX} in {time.perf_counter() - start_time:.2f} s')
+    show_data_from_table(connection, SEARCH_INDEX)
+    return indexed_rows
+
+
+def combine_queries(queries):
+    # A single FTS5 query matching the shows which match any of `queries`
+    return ' OR '.join(f'({query})' for query in queries)
+
+
+def excluded_shows_condition(show_id_column, queries):
+    """
+    Build the SQL condition removing the shows which match one of the full-text queries.
+
+    The queries are resolved by SHOWS_FTS, so the cost depends on the number of matching shows and not
+    on the number of descriptions.
+
+    Parameters:
+    - show_id_column (str): The show_id column of the filtered query, e.g. 'v.show_id'.
+    - queries (tuple): FTS5 queries, e.g. 'description: war'.
+
+    Returns:
+    - tuple: The condition, starting with ' AND ' (empty without queries), and its parameters.
+    """
+    if not queries:
+        return '', ()
+    return (f' AND {show_id_column} NOT IN (SELECT show_id FROM {SEARCH_INDEX} WHERE {SEARCH_INDEX} MATCH ?)',
+            (combine_queries(queries),))
+
+
+def search_shows(connection, query, limit=20):
+    """
+    Find the shows matching a full-text query, best matches first.
+
+    Parameters:
+    - connection (sqlite3.Connection): Open connection to the SQLite database.
+    - query (str): FTS5 query, e.g. 'friendship', 'title: dragon*' or 'space NOT war'.
+    - limit (int): Maximum number of shows returned.
+
+    Returns:
+    - pd.DataFrame: show_id, title, listed_in, a snippet of the description and the bm25 score
+      (lower is better) of the matching shows.
+    """
+    description_column = 1 + SEARCH_COLUMNS.index('description')
+    return pd.read_sql_query(f'''
+    SELECT show_id, title, listed_in,
+           snippet({SEARCH_INDEX}, {description_column}, '[', ']', '...', 12) AS snippet,
+           bm25({SEARCH_INDEX}) AS score
+    FROM {SEARCH_INDEX}
+    WHERE {SEARCH_INDEX} MATCH ?
+    ORDER BY rank
+    LIMIT ?
+    ''', connection, params=(query, limit))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Search the Netflix shows by keyword.')
+    parser.add_argument('query', help="FTS5 query, e.g. 'friendship', 'title: dragon*' or 'space NOT war'")
+    parser.add_argument('--limit', type=int, default=20, help='maximum number of shows shown')
+    parser.add_argument('--database', default='program/database/netflix_database.db',
+                        help='database written by main.py')
+    args = parser.parse_args()
+    if not os.path.isfile(args.database):
+        parser.error(f'{args.database} does not exist, run main.py first')
+
+    connection = sqlite3.connect(args.database)
+    try:
+        results = search_shows(connection, args.query, limit=args.limit)
+    except (sqlite3.OperationalError, pd.errors.DatabaseError) as error:
+        parser.error(f'cannot search {args.database}: {error}')
+    finally:
+        connection.close()
+    print(results.to_string(index=False) if len(results) else 'No shows found.')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,3 +1,103 @@
+import importlib
+import json
+import os
+import sys
+import time
+import types
+
+# Diagnostics levels, from the quietest to the most verbose:
+# - off: nothing is read back from the database
+# - counts: row counts with SELECT COUNT(*)
+# - sample: the first rows with LIMIT n
+# - full: every row of every table, plus table schemas and relations
+DIAGNOSTICS_LEVELS = ['off', 'counts', 'sample', 'full']
+DEFAULT_DIAGNOSTICS_LEVEL = 'counts'
+DEFAULT_DIAGNOSTICS_SAMPLE_SIZE = 5
+
+
+def read_diagnostics_environment():
+  # Read the levels from NETFLIX_DIAGNOSTICS and NETFLIX_DIAGNOSTICS_SAMPLE, falling back to the defaults
+  # on an invalid value rather than failing at import or in the middle of a stage
+  level = os.environ.get('NETFLIX_DIAGNOSTICS', DEFAULT_DIAGNOSTICS_LEVEL)
+  if level not in DIAGNOSTICS_LEVELS:
+    print(f"Ignoring NETFLIX_DIAGNOSTICS='{level}', expected one of {DIAGNOSTICS_LEVELS}, "
+          f"using '{DEFAULT_DIAGNOSTICS_LEVEL}'")
+    level = DEFAULT_DIAGNOSTICS_LEVEL
+  sample_size = os.environ.get('NETFLIX_DIAGNOSTICS_SAMPLE', str(DEFAULT_DIAGNOSTICS_SAMPLE_SIZE))
+  if not sample_size.strip().isdigit() or int(sample_size) < 1:
+    print(f"Ignoring NETFLIX_DIAGNOSTICS_SAMPLE='{sample_size}', expected a positive integer, "
+          f"using {DEFAULT_DIAGNOSTICS_SAMPLE_SIZE}")
+    sample_size = DEFAULT_DIAGNOSTICS_SAMPLE_SIZE
+  return level, int(sample_size)
+
+
+diagnostics_level, diagnostics_sample_size = read_diagnostics_environment()
+
+
+def set_diagnostics_level(level=None, sample_size=None):
+  # Override the levels read from the environment, None keeps the current value
+  global diagnostics_level, diagnostics_sample_size
+  if level is not None:
+    if level not in DIAGNOSTICS_LEVELS:
+      raise ValueError(f"Unknown diagnostics level '{level}', expected one of {DIAGNOSTICS_LEVELS}")
+    diagnostics_level = level
+  if sample_size is not None:
+    if sample_size < 1:
+      raise ValueError(f"Diagnostics sample size must be a positive integer, got {sample_size}")
+    diagnostics_sample_size = sample_size
+
+
+def diagnostics_enabled(level):
+  # Check if the current level is at least as verbose as the given one
+  return DIAGNOSTICS_LEVELS.index(diagnostics_level) >= DIAGNOSTICS_LEVELS.index(level)
+
+
+def log_diagnostics(event, **fields):
+  # Emit one structured diagnostics record as a JSON line
+  if diagnostics_enabled('counts'):
+    print(json.dumps({'event': event, **fields}, default=str))
+
+
+# Seconds spent importing each module deferred by `lazy_import`, reported by --profile-imports
+deferred_import_seconds = {}
+
+
+class LazyModule(types.ModuleType):
+  # Stand-in for a module until one of its attributes is used, which imports it and takes over its attributes
+  def __getattr__(self, attribute):
+    name = self.__name__
+    start_time = time.perf_counter()
+    first_import = name not in sys.modules
+    module = importlib.import_module(name)
+    if first_import:
+      deferred_import_seconds[name] = time.perf_counter() - start_time
+    self.__dict__.update(module.__dict__)
+    return getattr(module, attribute)
+
+
+def lazy_import(name):
+  """
+  Import a module the first time one of its attributes is used, rather than when it is named.
+
+  Heavy dependencies such as pandas or the Google Cloud clients are imported this way at the top of the
+  modules, so running a stage only imports what that stage uses.
+
+  Parameters:
+  - name (str): Full name of the module, e.g. 'pyarrow.parquet'.
+
+  Returns:
+  - module: The module if it is already imported, otherwise a LazyModule standing in for it.
+  """
+  return sys.modules.get(name) or LazyModule(name)
+
+
+def report_import_times(startup_seconds):
+  # Print the time spent importing at startup, then in each module deferred by `lazy_import`, slowest first
+  deferred_seconds = sum(deferred_import_seconds.values())
+  print(f"Imports: {startup_seconds:.3f} s at startup, {deferred_seconds:.3f} s deferred to the stages")
+  for name, seconds in sorted(deferred_import_seconds.items(), key=lambda item: item[1], reverse=True):
+    print(f"  {name:<32} {seconds:.3f} s")
+
 
 def get_relations(conn):
   # Create a cursor object to execute SQL queries
@@ -53,8 +153,18 @@ def show_all_tables(conn):
 
 
 def show_data_from_table(conn, table):
+  # Read the table back as far as the diagnostics level asks for
+  if not diagnostics_enabled('counts'):
+    return
+  if not diagnostics_enabled('sample'):
+    rows = conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+    log_diagnostics('table', table=table, rows=rows)
+    return
   import pandas as pd
-  query = f"SELECT * FROM {table}"
+  if diagnostics_enabled('full'):
+    query = f"SELECT * FROM {table}"
+  else:
+    query = f"SELECT * FROM {table} LIMIT {diagnostics_sample_size}"
   data = pd.read_sql_query(query, conn)
   print(f"showing data columns sql table {table}")
   print(data.columns)
@@ -62,6 +172,27 @@ def show_data_from_table(conn, table):
   print(data)
 
 
+def show_dataframe(name, data):
+  # Show a DataFrame which is already in memory as far as the diagnostics level asks for
+  if not diagnostics_enabled('counts'):
+    return
+  log_diagnostics('dataframe', name=name, rows=len(data))
+  if diagnostics_enabled('full'):
+    print(data)
+  elif diagnostics_enabled('sample'):
+    print(data.head(diagnostics_sample_size))
+
+
+def show_schema_checks(conn, tables):
+  # Tables, schemas and relations are only printed at the full level
+  if not diagnostics_enabled('full'):
+    return
+  show_all_tables(conn)
+  for table_name in tables:
+    show_table_schema(conn, table_name)
+  get_relations(conn)
+
+
 def drop_table(conn, table_name, view=False):
   # Create a cursor object
   cursor = conn.cursor()
@@ -78,3 +209,12 @@ def drop_table(conn, table_name, view=False):
   # Close the cursor and the connection
   cursor.close()
   print(f"The '{table_name}' table has been dropped successfully.")
+
+
+def table_exists(conn, table_name):
+  # Look the table or view up in the schema
+  cursor = conn.execute(
+    "SELECT 1 FROM sqlite_schema WHERE type IN ('table', 'view') AND name = ?", (table_name,))
+  exists = cursor.fetchone() is not None
+  cursor.close()
+  return exists
@@ -0,0 +1,230 @@
+import json
+import sys
+import threading
+import time
+import tracemalloc
+import uuid
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from program.helper_functions import log_diagnostics, table_exists
+
+try:
+    import resource
+except ImportError:
+    # Windows has no getrusage, the stages are then recorded without their memory
+    resource = None
+
+METRICS_COLUMNS = ['run_id', 'stage', 'status', 'started_at', 'overlapped', 'wall_seconds', 'cpu_seconds',
+                   'max_rss_mb', 'rss_increase_mb', 'peak_traced_mb', 'rows_in', 'rows_out', 'bytes_read',
+                   'bytes_written']
+
+# Records of the stages running in this process, to know which ones shared it with another stage
+running_records = []
+running_records_lock = threading.Lock()
+
+
+def start_run_metrics(trace_memory=False):
+    """
+    Start collecting the metrics of a pipeline run.
+
+    Parameters:
+    - trace_memory (bool): Also record the peak of Python allocations per stage with tracemalloc.
+      This is precise but slows the stages down, so it is off by default.
+
+    Returns:
+    - dict: The run metrics, passed to `instrument_stage` and `write_run_metrics`.
+    """
+    if trace_memory:
+        tracemalloc.start()
+    return {
+        'run_id': uuid.uuid4().hex,
+        'started_at': datetime.now(timezone.utc).isoformat(),
+        'trace_memory': trace_memory,
+        'stages': [],
+    }
+
+
+def read_process_io():
+    # Bytes read and written by this process, as counted by Linux; None elsewhere
+    try:
+        with open('/proc/self/io') as io_file:
+            fields = dict(line.split(': ') for line in io_file.read().splitlines())
+        return int(fields['rchar']), int(fields['wchar'])
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def max_rss_mb():
+    # Highest resident memory of this process since it started, None where getrusage is not available;
+    # ru_maxrss is in KiB on Linux and in bytes on macOS
+    if resource is None:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss / 1024 / 1024 if sys.platform == 'darwin' else max_rss / 1024
+
+
+def count_rows(connection, tables):
+    # Artifacts which are not tables (files, in-memory values) are not counted
+    tables = [table for table in tables if table_exists(connection, table)] if connection is not None else []
+    if not tables:
+        return None
+    return sum(connection.execute(f'SELECT COUNT(*) FROM {table}').fetchone()[0] for table in tables)
+
+
+def measure_in_worker(function, *args):
+    """
+    Run a 'cpu' stage in a worker process and measure it there, where its CPU time and I/O are spent.
+
+    A worker runs one task at a time, so the figures of the worker process belong to this stage alone.
+
+    Parameters:
+    - function (callable): The function of the stage.
+    - args: Its arguments.
+
+    Returns:
+    - tuple: The result of the function and the metrics of the worker, to hand to `instrument_stage`.
+    """
+    io_before = read_process_io()
+    max_rss_before = max_rss_mb()
+    cpu_start = time.process_time()
+    result = function(*args)
+    io_after = read_process_io()
+    max_rss_after = max_rss_mb()
+    worker_metrics = {
+        'cpu_seconds': round(time.process_time() - cpu_start, 4),
+        'max_rss_mb': round(max_rss_after, 1) if max_rss_after is not None else None,
+        'rss_increase_mb': round(max_rss_after - max_rss_before, 1) if max_rss_after is not None else None,
+        'bytes_read': io_after[0] - io_before[0] if io_before and io_after else None,
+        'bytes_written': io_after[1] - io_before[1] if io_before and io_after else None,
+    }
+    return result, worker_metrics
+
+
+@contextmanager
+def instrument_stage(run_metrics, stage, connection=None, tables_in=(), tables_out=()):
+    """
+    Record wall time, CPU time, memory, rows and bytes of one pipeline stage.
+
+    Rows in and out are counted in `tables_in` before the stage and in `tables_out` after it. A stage
+    producing a DataFrame instead can set `rows_out` on the yielded record itself.
+
+    CPU time is that of the thread running the stage, so stages running side by side each get their own.
+    Bytes read and written and memory are only known for the whole process: they are recorded when the
+    stage had the process to itself and left as None when another stage ran at the same time, which the
+    `overlapped` flag of the record tells. Resident memory is the high-water mark of the process:
+    `max_rss_mb` is that mark after the stage, and `rss_increase_mb` how much the stage raised it. With
+    `trace_memory`, `peak_traced_mb` is the peak of the Python allocations of the stage itself.
+
+    A stage run in a worker process with `measure_in_worker` sets `worker_metrics` on the yielded record,
+    its CPU time, bytes and memory are then those measured in the worker.
+
+    Parameters:
+    - run_metrics (dict): The run metrics from `start_run_metrics`.
+    - stage (str): Name of the stage.
+    - connection (sqlite3.Connection): Connection used to count rows, None for stages outside the database.
+    - tables_in (list): Tables read by the stage.
+    - tables_out (list): Tables written by the stage.
+
+    Yields:
+    - dict: The record of the stage.
+    """
+    record = {
+        'run_id': run_metrics['run_id'],
+        'stage': stage,
+        'status': 'ok',
+        'started_at': datetime.now(timezone.utc).isoformat(),
+        'rows_in': count_rows(connection, tables_in),
+        'rows_out': None,
+    }
+    with running_records_lock:
+        record['overlapped'] = bool(running_records)
+        for running_record in running_records:
+            running_record['overlapped'] = True
+        running_records.append(record)
+        # Resetting the peak only spoils the peaks of stages which are now marked as overlapped
+        if run_metrics['trace_memory']:
+            tracemalloc.reset_peak()
+    io_before = read_process_io()
+    max_rss_before = max_rss_mb()
+    wall_start = time.perf_counter()
+    cpu_start = time.thread_time()
+    try:
+        yield record
+    except BaseException:
+        record['status'] = 'failed'
+        raise
+    finally:
+        record['wall_seconds'] = round(time.perf_counter() - wall_start, 4)
+        record['cpu_seconds'] = round(time.thread_time() - cpu_start, 4)
+        max_rss_after = max_rss_mb()
+        io_after = read_process_io()
+        with running_records_lock:
+            running_records.remove(record)
+            overlapped = record['overlapped']
+        record['max_rss_mb'] = round(max_rss_after, 1) if max_rss_after is not None else None
+        record['rss_increase_mb'] = (round(max_rss_after - max_rss_before, 1)
+                                     if max_rss_after is not None and not overlapped else None)
+        record['peak_traced_mb'] = (round(tracemalloc.get_traced_memory()[1] / 1024 / 1024, 1)
+                                    if run_metrics['trace_memory'] and not overlapped else None)
+        if io_before and io_after and not overlapped:
+            record['bytes_read'] = io_after[0] - io_before[0]
+            record['bytes_written'] = io_after[1] - io_before[1]
+        else:
+            record['bytes_read'] = record['bytes_written'] = None
+        record.update(record.pop('worker_metrics', {}))
+        if record['status'] == 'ok' and record['rows_out'] is None:
+            record['rows_out'] = count_rows(connection, tables_out)
+        run_metrics['stages'].append(record)
+        log_diagnostics('stage', **{column: record[column] for column in METRICS_COLUMNS[1:]})
+
+
+def write_run_metrics(run_metrics, json_file_path, connection=None):
+    """
+    Save the metrics of a run to a JSON file and append them to the PIPELINE_METRICS table.
+
+    Parameters:
+    - run_metrics (dict): The run metrics from `start_run_metrics`.
+    - json_file_path (str): Path of the JSON summary.
+    - connection (sqlite3.Connection): Connection to the database holding PIPELINE_METRICS, None to skip it.
+    """
+    summary = {
+        'run_id': run_metrics['run_id'],
+        'started_at': run_metrics['started_at'],
+        'total_wall_seconds': round(sum(record['wall_seconds'] for record in run_metrics['stages']), 4),
+        'stages': run_metrics['stages'],
+    }
+    with open(json_file_path, 'w') as json_file:
+        json.dump(summary, json_file, indent=2)
+
+    if connection is not None:
+        connection.execute("""
+        CREATE TABLE IF NOT EXISTS PIPELINE_METRICS (
+            run_id CHAR(32),
+            stage VARCHAR(100),
+            status VARCHAR(10),
+            started_at TIMESTAMP,
+            overlapped BOOLEAN,
+            wall_seconds FLOAT,
+            cpu_seconds FLOAT,
+            max_rss_mb FLOAT,
+            rss_increase_mb FLOAT,
+            peak_traced_mb FLOAT,
+            rows_in INTEGER,
+            rows_out INTEGER,
+            bytes_read INTEGER,
+            bytes_written INTEGER
+        );
+        """)
+        # Tables created by earlier versions lack the newer columns
+        existing_columns = [row[1] for row in connection.execute('PRAGMA table_info(PIPELINE_METRICS)')]
+        for column in METRICS_COLUMNS:
+            if column not in existing_columns:
+                connection.execute(f'ALTER TABLE PIPELINE_METRICS ADD COLUMN {column} FLOAT')
+        with connection:
+            connection.executemany(
+                'INSERT INTO PIPELINE_METRICS ({}) VALUES ({})'.format(
+                    ', '.join(METRICS_COLUMNS), ', '.join('?' * len(METRICS_COLUMNS))),
+                [[record[column] for column in METRICS_COLUMNS] for record in run_metrics['stages']])
+
+    print(f"Run metrics saved to {json_file_path} (run {run_metrics['run_id']}, "
+          f"{summary['total_wall_seconds']:.2f} s over {len(run_metrics['stages'])} stages)")
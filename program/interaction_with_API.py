@@ -1,53 +1,183 @@
 import logging
-import requests
+import random
 import time
-import pandas as pd
+from program.helper_functions import lazy_import
 
+asyncio = lazy_import('asyncio')
+pd = lazy_import('pandas')
+requests = lazy_import('requests')
 
-def fetch_gdp_per_capita(country_list, api_url, api_key, csv_file_path, is_test=False, max_retries=3):
+GDP_CACHE_TTL = 7 * 24 * 3600  # seconds
+
+
+class TokenBucket:
     """
-    Fetch GDP per capita for each country from the ninja API and save to a CSV file.
+    Token-bucket rate limiter shared by asyncio tasks.
+
+    Parameters:
+    - rate (float): Number of tokens added per second, i.e. the sustained request rate.
+    - capacity (int): Maximum number of tokens, i.e. the allowed burst of requests.
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+def create_gdp_cache_table(connection):
+    connection.execute("""
+    CREATE TABLE IF NOT EXISTS GDP_API_CACHE (
+        Country VARCHAR(50) PRIMARY KEY,
+        GDP_per_capita FLOAT,
+        fetched_at FLOAT
+    );
+    """)
+
+
+def read_gdp_cache(connection, country_list, cache_ttl):
+    """
+    Read the cached GDP per capita of the countries which have not expired.
 
     Parameters:
+    - connection (sqlite3.Connection): Connection to the database holding the cache.
     - country_list (list): List of countries.
-    - is_test (bool): Optional parameter to test the function with only the first 10 countries.
+    - cache_ttl (float): Time to live of a cached value, in seconds.
 
     Returns:
-    - None
+    - dict: GDP per capita by country, for the countries found in the cache.
     """
-    if is_test:
-        country_list = country_list[:10]  # If it's a test, use only the first 10 countries
+    oldest_valid = time.time() - cache_ttl
+    cached = {}
+    for country, gdp_per_capita, fetched_at in connection.execute(
+            'SELECT Country, GDP_per_capita, fetched_at FROM GDP_API_CACHE'):
+        if fetched_at >= oldest_valid:
+            cached[country] = gdp_per_capita
+    return {country: cached[country] for country in country_list if country in cached}
+
 
-    gdp_data = []
+def write_gdp_cache(connection, gdp_by_country):
+    fetched_at = time.time()
+    connection.executemany('INSERT OR REPLACE INTO GDP_API_CACHE VALUES (?, ?, ?)',
+                           [(country, gdp, fetched_at) for country, gdp in gdp_by_country.items()])
 
-    for country in country_list:
-        name_country = country
-        api_url = f'{api_url}?name={name_country}'
-        retries = 0
-        while retries < max_retries:
+
+async def fetch_country_gdp(country, api_url, api_key, rate_limiter, semaphore, max_retries, backoff_base, timeout):
+    """
+    Fetch the GDP per capita of one country, retrying failures with exponential backoff and jitter.
+
+    Returns:
+    - tuple: The country, its GDP per capita (None if the API does not know the country) and whether
+      the request succeeded.
+    """
+    for attempt in range(1, max_retries + 1):
+        async with semaphore:
+            await rate_limiter.acquire()
             try:
-                response = requests.get(api_url, headers={'X-Api-Key': api_key})
+                response = await asyncio.to_thread(requests.get, api_url, params={'name': country},
+                                                   headers={'X-Api-Key': api_key}, timeout=timeout)
                 response.raise_for_status()  # Checking for errors
 
                 country_data_list = response.json()
-                logging.debug(f"Country Data for {name_country}: {country_data_list}")
-                if country_data_list:
-                    # Use the first (and only) element of the list
-                    country_data = country_data_list[0]
-
-                gdp_per_capita = country_data.get('gdp_per_capita', None)
-                gdp_data.append({'Country': country, 'GDP_per_capita': gdp_per_capita})
-                break  # Exiting the loop after a successful request
+                logging.debug(f"Country Data for {country}: {country_data_list}")
+                # Use the first (and only) element of the list
+                gdp_per_capita = country_data_list[0].get('gdp_per_capita', None) if country_data_list else None
+                return country, gdp_per_capita, True
             except requests.exceptions.RequestException as err:
-                logging.error(f"Error for {name_country}: {err}")
-                retries += 1
-                logging.warning(f"Retrying {retries}/{max_retries}...")
-                time.sleep(5)  # Pause between retries
+                logging.error(f"Error for {country}: {err}")
+
+        if attempt < max_retries:
+            # Full jitter: wait a random time up to the exponential backoff
+            delay = random.uniform(0, backoff_base * 2 ** (attempt - 1))
+            logging.warning(f"Retrying {country} {attempt}/{max_retries} in {delay:.1f} s...")
+            await asyncio.sleep(delay)
+
+    return country, None, False
+
+
+async def fetch_countries_gdp(country_list, api_url, api_key, max_concurrency, requests_per_second, max_retries,
+                              backoff_base, timeout):
+    rate_limiter = TokenBucket(rate=requests_per_second, capacity=max_concurrency)
+    semaphore = asyncio.Semaphore(max_concurrency)
+    results = await asyncio.gather(*(
+        fetch_country_gdp(country, api_url, api_key, rate_limiter, semaphore, max_retries, backoff_base, timeout)
+        for country in country_list))
+    return {country: gdp_per_capita for country, gdp_per_capita, succeeded in results if succeeded}
+
+
+def fetch_gdp_per_capita(country_list, api_url, api_key, csv_file_path, is_test=False, max_retries=3,
+                         cache_connection=None, cache_ttl=GDP_CACHE_TTL, max_concurrency=8,
+                         requests_per_second=5.0, backoff_base=1.0, timeout=30, cached_gdp=None):
+    """
+    Fetch GDP per capita for each country from the ninja API and save to a CSV file.
+
+    Countries are fetched concurrently with asyncio, bounded by `max_concurrency` and a token-bucket
+    rate limit. When `cache_connection` is set, responses are kept in the GDP_API_CACHE table of that
+    database, and only countries missing from it or older than `cache_ttl` are requested again. A caller
+    running this function outside the thread of its connection can instead read the cache itself, pass
+    it as `cached_gdp` and write the returned values back with `write_gdp_cache`.
+
+    Parameters:
+    - country_list (list): List of countries.
+    - api_url (str): URL of the GDP API.
+    - api_key (str): Key of the GDP API.
+    - csv_file_path (str): The path where the CSV file will be saved.
+    - is_test (bool): Optional parameter to test the function with only the first 10 countries.
+    - max_retries (int): Number of attempts per country.
+    - cache_connection (sqlite3.Connection): Connection to the database holding the response cache, None to disable it.
+    - cache_ttl (float): Time to live of a cached response, in seconds.
+    - max_concurrency (int): Maximum number of requests in flight.
+    - requests_per_second (float): Sustained request rate allowed by the rate limiter.
+    - backoff_base (float): Upper bound of the first retry delay in seconds, doubled on every retry.
+    - timeout (float): Timeout of a single request in seconds.
+    - cached_gdp (dict): GDP per capita by country already read from the cache, used instead of `cache_connection`.
+
+    Returns:
+    - dict: GDP per capita by country, for the countries fetched from the API.
+    """
+    start_time = time.perf_counter()
+    if is_test:
+        country_list = country_list[:10]  # If it's a test, use only the first 10 countries
+
+    cached = dict(cached_gdp or {})
+    if cache_connection is not None:
+        create_gdp_cache_table(cache_connection)
+        cached = read_gdp_cache(cache_connection, country_list, cache_ttl)
+
+    missing_countries = [country for country in country_list if country not in cached]
+    fetched = {}
+    if missing_countries:
+        fetched = asyncio.run(fetch_countries_gdp(missing_countries, api_url, api_key, max_concurrency,
+                                                  requests_per_second, max_retries, backoff_base, timeout))
+
+    if cache_connection is not None:
+        write_gdp_cache(cache_connection, fetched)
+        cache_connection.commit()
+
+    gdp_by_country = {**cached, **fetched}
+    gdp_data = [{'Country': country, 'GDP_per_capita': gdp_by_country[country]}
+                for country in country_list if country in gdp_by_country]
 
     # Convert the data to a DataFrame
-    gdp_df = pd.DataFrame(gdp_data)
+    gdp_df = pd.DataFrame(gdp_data, columns=['Country', 'GDP_per_capita'])
 
     # Save the DataFrame to a CSV file
     gdp_df.to_csv(csv_file_path, index=False)
 
-    print(f'Data has been successfully exported to {csv_file_path}')
+    print(f'Data has been successfully exported to {csv_file_path} '
+          f'({len(cached)} countries from cache, {len(fetched)} fetched, '
+          f'{len(missing_countries) - len(fetched)} failed) in {time.perf_counter() - start_time:.2f} s')
+    return fetched
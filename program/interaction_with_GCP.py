@@ -1,9 +1,124 @@
-import pandas as pd
-from google.cloud import storage
-from google.oauth2 import service_account
+import base64
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from program.helper_functions import lazy_import
+from program.interaction_with_csv import hash_file
 
+pd = lazy_import('pandas')
+pa = lazy_import('pyarrow')
+pc = lazy_import('pyarrow.compute')
+bigquery = lazy_import('google.cloud.bigquery')
+storage = lazy_import('google.cloud.storage')
+service_account = lazy_import('google.oauth2.service_account')
 
-def download_blob(bucket_name, source_blob_name, destination_file_name, project_id, service_account_file):
+# Objects are downloaded in byte ranges of this size, DOWNLOAD_WORKERS at a time
+DOWNLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+DOWNLOAD_WORKERS = 4
+# Generation and MD5 of the last downloaded object, kept next to the file
+DOWNLOAD_STATE_SUFFIX = '.gcs.json'
+# Columns exported from the BigQuery ratings table, and their name in the RATINGS table
+RATINGS_COLUMNS = {'id': 'id', 'rating': 'name'}
+BIGQUERY_PAGE_SIZE = 10000
+# Watermark of the last incremental export, kept next to the file
+EXPORT_STATE_SUFFIX = '.bq.json'
+
+
+def storage_client_for(project_id, service_account_file):
+    # With STORAGE_EMULATOR_HOST set, e.g. to a local fake-gcs-server, the client talks to it without credentials
+    if os.environ.get('STORAGE_EMULATOR_HOST'):
+        return storage.Client(project=project_id)
+    credentials = service_account.Credentials.from_service_account_file(service_account_file)
+    return storage.Client(project=project_id, credentials=credentials)
+
+
+def file_md5(file_path):
+    # Base64 of the MD5 digest, the format of `Blob.md5_hash`
+    return base64.b64encode(bytes.fromhex(hash_file(file_path, algorithm='md5'))).decode('ascii')
+
+
+def read_json(file_path):
+    try:
+        with open(file_path) as json_file:
+            return json.load(json_file)
+    except (OSError, ValueError):
+        return None
+
+
+def write_json(file_path, data):
+    # Written next to the file and renamed, so an interrupted write never leaves half a state file
+    with open(file_path + '.tmp', 'w') as json_file:
+        json.dump(data, json_file)
+    os.replace(file_path + '.tmp', file_path)
+
+
+def blob_is_unchanged(blob, destination_file_name):
+    """
+    Check if the local file already holds this generation of the blob.
+
+    The generation and MD5 recorded by the last download are compared first; without them (e.g. a file
+    copied by hand) the MD5 of the local file is computed once and compared with the one of the blob.
+    """
+    if not os.path.isfile(destination_file_name) or os.path.getsize(destination_file_name) != blob.size:
+        return False
+    downloaded = read_json(destination_file_name + DOWNLOAD_STATE_SUFFIX)
+    if downloaded is not None:
+        return downloaded == {'generation': blob.generation, 'md5_hash': blob.md5_hash}
+    if blob.md5_hash is not None and file_md5(destination_file_name) == blob.md5_hash:
+        write_json(destination_file_name + DOWNLOAD_STATE_SUFFIX,
+                   {'generation': blob.generation, 'md5_hash': blob.md5_hash})
+        return True
+    return False
+
+
+def download_chunks(blob, part_file_name, chunk_size, max_workers):
+    """
+    Download the blob in byte ranges of `chunk_size`, `max_workers` at a time, into `part_file_name`.
+
+    The ranges written are recorded in `part_file_name` + '.json' as they finish, so a download interrupted
+    by an error or a crash resumes with the missing ranges, provided the blob has the same generation.
+    """
+    state_file_name = part_file_name + '.json'
+    ranges = [(start, min(start + chunk_size, blob.size) - 1) for start in range(0, blob.size, chunk_size)]
+    state = {'generation': blob.generation, 'size': blob.size, 'chunk_size': chunk_size, 'done': []}
+    previous_state = read_json(state_file_name)
+    if (previous_state is not None and os.path.isfile(part_file_name)
+            and {**previous_state, 'done': []} == state and os.path.getsize(part_file_name) == blob.size):
+        state['done'] = previous_state['done']
+        print(f'Resuming the download of {blob.name}: {len(state["done"])} of {len(ranges)} chunks already written')
+    else:
+        # Allocate the whole file, so every chunk is written at its offset
+        with open(part_file_name, 'wb') as part_file:
+            part_file.truncate(blob.size)
+        write_json(state_file_name, state)
+
+    state_lock = threading.Lock()
+
+    def download_range(index):
+        start, end = ranges[index]
+        # The blob returned by `get_blob` carries its generation, so every range is read from the same object
+        data = blob.download_as_bytes(start=start, end=end, checksum=None)
+        if len(data) != end - start + 1:
+            raise RuntimeError(f'Got {len(data)} bytes for the range {start}-{end} of {blob.name}')
+        with open(part_file_name, 'r+b') as part_file:
+            part_file.seek(start)
+            part_file.write(data)
+        with state_lock:
+            state['done'].append(index)
+            write_json(state_file_name, state)
+
+    missing = [index for index in range(len(ranges)) if index not in set(state['done'])]
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='download') as executor:
+        # Raises the first failed range once the others are finished and recorded
+        for future in [executor.submit(download_range, index) for index in missing]:
+            future.result()
+    return state_file_name
+
+
+def download_blob(bucket_name, source_blob_name, destination_file_name, project_id, service_account_file,
+                  chunk_size=DOWNLOAD_CHUNK_SIZE, max_workers=DOWNLOAD_WORKERS, client=None):
     """
     Downloads a blob from Google Cloud Storage (GCS) bucket.
 
@@ -13,12 +128,19 @@ def download_blob(bucket_name, source_blob_name, destination_file_name, project_
     - destination_file_name (str): The local path to which the file should be downloaded.
     - project_id (str): The ID of the Google Cloud project.
     - service_account_file (str): The path to the service account key file.
+    - chunk_size (int): Size of the byte ranges downloaded in parallel.
+    - max_workers (int): Number of ranges downloaded at a time.
+    - client (google.cloud.storage.Client): Client to use instead of one authorized with `service_account_file`,
+      e.g. a fake client in tests.
 
     Returns:
-    - None
+    - bool: True if the blob was downloaded, False if the local file already held it.
 
-    This function uses the Google Cloud Storage client library to download a blob
-    from the specified GCS bucket to the local file system.
+    The metadata of the blob (generation, MD5, size) is read first, and nothing is downloaded when the
+    local file already holds this generation (see `blob_is_unchanged`). Otherwise the blob is downloaded
+    in byte ranges into `destination_file_name` + '.part' (see `download_chunks`), its MD5 checked, and
+    the file renamed into place, so the pipeline never reads a partial or corrupted download. A failed
+    download is resumed by the next call.
 
     Example:
     download_blob(
@@ -30,65 +152,180 @@ def download_blob(bucket_name, source_blob_name, destination_file_name, project_
     )
     """
 
-    credentials = service_account.Credentials.from_service_account_file(service_account_file)
-
-    """Downloads a blob from the bucket."""
-    # The ID of your GCS bucket
-    # bucket_name = "your-bucket-name"
-
-    # The ID of your GCS object
-    # source_blob_name = "storage-object-name"
-
-    # The path to which the file should be downloaded
-    # destination_file_name = "local/path/to/file"
+    storage_client = client or storage_client_for(project_id, service_account_file)
+    bucket = storage_client.bucket(bucket_name)
 
-    storage_client = storage.Client(project=project_id, credentials=credentials)
+    # Unlike `Bucket.blob`, `Bucket.get_blob` reads the metadata of the object, compared with the local file
+    blob = bucket.get_blob(source_blob_name)
+    if blob is None:
+        raise FileNotFoundError(f'gs://{bucket_name}/{source_blob_name} does not exist')
+    if blob_is_unchanged(blob, destination_file_name):
+        print(f'Storage object {source_blob_name} (generation {blob.generation}) is unchanged, '
+              f'keeping {destination_file_name}')
+        return False
 
-    bucket = storage_client.bucket(bucket_name)
+    start_time = time.perf_counter()
+    part_file_name = destination_file_name + '.part'
+    state_file_name = download_chunks(blob, part_file_name, chunk_size, max_workers)
 
-    # Construct a client side representation of a blob.
-    # Note `Bucket.blob` differs from `Bucket.get_blob` as it doesn't retrieve
-    # any content from Google Cloud Storage. As we don't need additional data,
-    # using `Bucket.blob` is preferred here.
-    blob = bucket.blob(source_blob_name)
-    blob.download_to_filename(destination_file_name)
+    if blob.md5_hash is not None and file_md5(part_file_name) != blob.md5_hash:
+        # Start again from scratch on the next call
+        os.remove(part_file_name)
+        os.remove(state_file_name)
+        raise RuntimeError(f'The MD5 of the download of {source_blob_name} does not match the storage object')
+    os.replace(part_file_name, destination_file_name)
+    os.remove(state_file_name)
+    write_json(destination_file_name + DOWNLOAD_STATE_SUFFIX,
+               {'generation': blob.generation, 'md5_hash': blob.md5_hash})
 
     print(
-        "Downloaded storage object {} from bucket {} to local file {}.".format(
-            source_blob_name, bucket_name, destination_file_name
+        "Downloaded storage object {} from bucket {} to local file {} ({:.1f} MB in {:.2f} s).".format(
+            source_blob_name, bucket_name, destination_file_name, blob.size / 1024 / 1024,
+            time.perf_counter() - start_time
         )
     )
+    return True
+
+
+def bigquery_clients_for(project_id, service_user_key_path):
+    # Both clients are authorized with the same credentials. The Storage Read API streams Arrow batches in
+    # parallel, without google-cloud-bigquery-storage there is no read client and results are paged
+    credentials = service_account.Credentials.from_service_account_file(service_user_key_path)
+    bigquery_client = bigquery.Client(project=project_id, credentials=credentials)
+    try:
+        from google.cloud import bigquery_storage
+    except ImportError:
+        return bigquery_client, None
+    return bigquery_client, bigquery_storage.BigQueryReadClient(credentials=credentials)
+
+
+def query_parameter_type(arrow_type):
+    # BigQuery type of the watermark parameter, from the Arrow type of the column
+    if pa.types.is_integer(arrow_type):
+        return 'INT64'
+    if pa.types.is_floating(arrow_type):
+        return 'FLOAT64'
+    if pa.types.is_timestamp(arrow_type):
+        return 'TIMESTAMP'
+    if pa.types.is_date(arrow_type):
+        return 'DATE'
+    return 'STRING'
 
 
-def read_from_bigquery_and_save_csv(project_id, dataset_id, table_id, service_user_key_path, csv_file_path):
+def merge_csv_rows(part_file_name, csv_file_path, pulled_keys, key_column, chunk_size=100000):
+    # Append the rows of the previous export which were not pulled again, a chunk at a time
+    for chunk in pd.read_csv(csv_file_path, chunksize=chunk_size):
+        chunk[~chunk[key_column].isin(pulled_keys)].to_csv(part_file_name, mode='a', header=False, index=False)
+
+
+def rows_already_exported(part_file_name, csv_file_path, key_column, chunk_size=100000):
+    # True when every row pulled again is in the previous export with the same values, compared as text
+    pulled = pd.read_csv(part_file_name, dtype=str, keep_default_na=False)
+    pulled_keys = set(pulled[key_column])
+    previous = pd.concat([chunk[chunk[key_column].isin(pulled_keys)] for chunk in
+                          pd.read_csv(csv_file_path, dtype=str, keep_default_na=False, chunksize=chunk_size)])
+    if len(previous) != len(pulled):
+        return False
+    return (pulled.sort_values(key_column).reset_index(drop=True)
+            .equals(previous[pulled.columns].sort_values(key_column).reset_index(drop=True)))
+
+
+def watermark_state(watermark):
+    return watermark.isoformat() if hasattr(watermark, 'isoformat') else watermark
+
+
+def read_from_bigquery_and_save_csv(project_id, dataset_id, table_id, service_user_key_path, csv_file_path,
+                                    columns=RATINGS_COLUMNS, key_column='id', watermark_column=None,
+                                    page_size=BIGQUERY_PAGE_SIZE, client=None):
     """
     Export data from a BigQuery table to a CSV file, rename a specified column, and save it.
 
+    Only the needed columns are queried, renamed in the query, and the results are streamed as Arrow
+    record batches (with the Storage Read API when google-cloud-bigquery-storage is installed, otherwise
+    in pages of `page_size` rows) and appended to the CSV file one batch at a time, so the table is never
+    held in memory. The file is written next to `csv_file_path` and renamed into place once complete.
+
+    With `watermark_column`, only the rows whose value of that column is at or above the highest one pulled
+    by the previous export are queried (recorded in `csv_file_path` + '.bq.json'), and merged by `key_column`
+    into the previous file. Rows at the previous watermark are pulled again, since a row committed after
+    the previous export may share its value. The file is left untouched when no row changed, so the
+    pipeline sees the ratings as unchanged. Rows deleted from the table are only dropped by a full export.
+
     Parameters:
     - project_id (str): The Google Cloud project ID.
     - dataset_id (str): The BigQuery dataset ID.
     - table_id (str): The BigQuery table ID.
     - service_user_key_path (str): The path to the service user JSON key file for BigQuery authorization.
     - csv_file_path (str): The path where the CSV file will be saved.
-    - new_column_name (str): The new name for the specified column (default is 'name').
+    - columns (dict): The BigQuery columns to export and their name in the CSV file, 'rating' -> 'name' for
+      the RATINGS table.
+    - key_column (str): Column of the CSV file identifying a row, used to merge incremental exports.
+    - watermark_column (str): BigQuery column increasing whenever a row is added or changed, e.g. an
+      `updated_at` timestamp, None to export the whole table.
+    - page_size (int): Number of rows per page when the results are paged.
+    - client (google.cloud.bigquery.Client): Client to use instead of one authorized with
+      `service_user_key_path`, e.g. a fake client in tests.
 
     Returns:
-    - None
+    - int: The number of rows pulled.
     """
+    start_time = time.perf_counter()
+    if client is None:
+        bigquery_client, bqstorage_client = bigquery_clients_for(project_id, service_user_key_path)
+    else:
+        bigquery_client, bqstorage_client = client, None
+    state_file_name = csv_file_path + EXPORT_STATE_SUFFIX
+    previous_export = read_json(state_file_name) if watermark_column and os.path.isfile(csv_file_path) else None
+    if previous_export is not None and (previous_export.get('watermark_column') != watermark_column
+                                        or previous_export.get('watermark') is None):
+        previous_export = None
 
-    # Set up BigQuery credentials
-    credentials = service_account.Credentials.from_service_account_file(service_user_key_path)
-
-    # Set up the BigQuery query string
-    query = f'SELECT * FROM `{project_id}.{dataset_id}.{table_id}`'
-
-    # Read data from BigQuery into a DataFrame
-    df = pd.read_gbq(query, project_id=project_id, credentials=credentials)
+    # Only the needed columns, renamed by the query
+    selected = [f'{column} AS {name}' if column != name else column for column, name in columns.items()]
+    if watermark_column and watermark_column not in columns:
+        selected.append(watermark_column)
+    query = f'SELECT {", ".join(selected)} FROM `{project_id}.{dataset_id}.{table_id}`'
+    query_parameters = []
+    if previous_export is not None:
+        query += f' WHERE {watermark_column} >= @watermark'
+        query_parameters.append(bigquery.ScalarQueryParameter('watermark', previous_export['watermark_type'],
+                                                              previous_export['watermark']))
+    rows = bigquery_client.query(query, job_config=bigquery.QueryJobConfig(query_parameters=query_parameters)) \
+        .result(page_size=page_size)
 
-    # Rename the specified column
-    df = df.rename(columns={'rating': 'name'})
+    part_file_name = csv_file_path + '.part'
+    output_columns = list(columns.values())
+    watermark_name = columns.get(watermark_column, watermark_column)
+    pulled_rows, pulled_keys, watermark, watermark_type = 0, [], None, None
+    with open(part_file_name, 'w', newline='') as part_file:
+        part_file.write(','.join(output_columns) + '\n')
+        for batch in rows.to_arrow_iterable(bqstorage_client=bqstorage_client):
+            if batch.num_rows == 0:
+                continue
+            if watermark_column:
+                batch_watermark = pc.max(batch.column(watermark_name)).as_py()
+                if watermark is None or batch_watermark > watermark:
+                    watermark = batch_watermark
+                watermark_type = query_parameter_type(batch.schema.field(watermark_name).type)
+            if previous_export is not None:
+                pulled_keys.extend(batch.column(key_column).to_pylist())
+            batch.select(output_columns).to_pandas().to_csv(part_file, header=False, index=False)
+            pulled_rows += batch.num_rows
 
-    # Save the DataFrame to a CSV file
-    df.to_csv(csv_file_path, index=False)
+    if previous_export is not None:
+        if pulled_rows == 0 or (watermark_state(watermark) == previous_export['watermark']
+                                and rows_already_exported(part_file_name, csv_file_path, key_column)):
+            os.remove(part_file_name)
+            print(f'No ratings changed since {previous_export["watermark"]}, keeping {csv_file_path}')
+            return 0
+        merge_csv_rows(part_file_name, csv_file_path, set(pulled_keys), key_column)
+    os.replace(part_file_name, csv_file_path)
+    if watermark_column:
+        if watermark is None and previous_export is not None:
+            watermark, watermark_type = previous_export['watermark'], previous_export['watermark_type']
+        write_json(state_file_name, {'watermark_column': watermark_column, 'watermark_type': watermark_type,
+                                     'watermark': watermark_state(watermark)})
 
-    print(f'Data has been successfully exported to {csv_file_path}')
+    print(f'Data has been successfully exported to {csv_file_path} '
+          f'({pulled_rows} rows pulled in {time.perf_counter() - start_time:.2f} s)')
+    return pulled_rows
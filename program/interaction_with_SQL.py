@@ -1,21 +1,48 @@
-import sqlite3
-import pandas as pd
-from program.helper_functions import show_all_tables, show_table_schema, get_relations, show_data_from_table
-
-
-def create_sql_tables(database_path):
+import hashlib
+import time
+from program.helper_functions import lazy_import, show_schema_checks, show_data_from_table, show_dataframe, \
+    table_exists
+from program.interaction_with_csv import iterate_csv_chunks, hash_file
+from program.vectorized_transformations import replace_multiple_countries, flag_release_2000_or_newer
+from program.typed_loading import read_typed_sql, iterate_typed_sql, write_typed_sql, write_typed_batches, \
+    fill_missing
+from program.full_text_search import create_search_index, build_search_index, excluded_shows_condition
+from program.table_publishing import KEPT_VERSIONS, create_table_versions, new_table_version, swap_table_version
+
+pd = lazy_import('pandas')
+
+NETFLIX_SHOWS_COLUMNS = ['show_id', 'type', 'title', 'director', 'cast', 'country', 'date_added',
+                         'release_year', 'rating_id', 'duration', 'listed_in', 'description']
+
+# Files every output row depends on, a change to one of them means every show is recomputed
+LOOKUP_FILE_PATHS = ["program/data_sources/ratings.csv", "program/data_sources/gdp_per_capita.csv",
+                     "program/data_sources/popular_directors.csv"]
+
+# Bridge tables of the comma-separated columns of NETFLIX_SHOWS: table -> (column of NETFLIX_SHOWS, key column)
+BRIDGE_TABLES = {
+    'SHOW_COUNTRY': ('country', 'country'),
+    'SHOW_GENRE': ('listed_in', 'genre'),
+    'SHOW_CAST': ('cast', 'cast_member'),
+    'SHOW_DIRECTOR': ('director', 'director'),
+}
+
+# Ratings of shows which are not suitable for kids, and full-text queries (see SHOWS_FTS) matching them
+KIDS_EXCLUDED_RATINGS = ('NC-17', 'TV-MA', 'NR', 'UR')
+KIDS_EXCLUDED_QUERIES = ('description: war', 'description: violen*')
+
+
+def create_sql_tables(connection):
     """
-    Create SQL tables for NETFLIX_SHOWS, RATINGS, and GDP_PER_CAPITA.
+    Create SQL tables for NETFLIX_SHOWS, RATINGS, GDP_PER_CAPITA, POPULAR_DIRECTORS, the bridge tables and
+    the SHOWS_FTS full-text index.
   
     Args:
-    - database_path (str): Path to the SQLite database.
+    - connection (sqlite3.Connection): Open connection to the SQLite database.
   
     Returns:
     None
     """
 
-    # Connect to the SQLite database
-    connection = sqlite3.connect(database_path)
     cursor = connection.cursor()
 
     # Create table RATINGS
@@ -34,6 +61,13 @@ def create_sql_tables(database_path):
     );
     """)
 
+    # Create table POPULAR_DIRECTORS
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS POPULAR_DIRECTORS (
+        director VARCHAR(100) PRIMARY KEY
+    );
+    """)
+
     # Define the schema for the NETFLIX_SHOWS table
     cursor.execute("""
     CREATE TABLE IF NOT EXISTS NETFLIX_SHOWS (
@@ -54,110 +88,494 @@ def create_sql_tables(database_path):
     );
     """)
 
-    # Commit the changes and close the connection
-    connection.commit()
+    # Create the bridge tables of the comma-separated columns
+    create_bridge_tables(cursor)
+
+    # Create the full-text index of the titles and descriptions
+    create_search_index(cursor)
+
+    # Create the state tables used by incremental loads
+    create_incremental_state_tables(cursor)
+
+    # Create table TABLE_VERSIONS, holding the published version of the output tables
+    create_table_versions(cursor)
+    cursor.close()
+
+    # Check the tables, their schema and the relations between them
+    show_schema_checks(connection, ['NETFLIX_SHOWS', 'RATINGS', 'GDP_PER_CAPITA', 'POPULAR_DIRECTORS', *BRIDGE_TABLES])
+
+
+def stream_netflix_shows_into_table(connection, csv_file_path, chunk_size=10000, source=None):
+    """
+    Stream the ';'-delimited Netflix shows CSV into the existing NETFLIX_SHOWS table.
+
+    The file is read in chunks of `chunk_size` rows and every chunk is bulk-inserted with
+    `executemany`, so memory use depends on the chunk size and not on the size of the file.
+    All chunks are written inside one transaction and the schema created by `create_sql_tables`
+    (primary and foreign keys) is kept.
+
+    Args:
+    - connection (sqlite3.Connection): Open connection to the SQLite database.
+    - csv_file_path (str): Path to the Netflix shows CSV file.
+    - chunk_size (int): Number of rows inserted per `executemany` call.
+    - source (SourceReader): Reader of `csv_file_path` shared with other stages, None to read the file directly.
+
+    Returns:
+    tuple: The number of inserted rows and the elapsed time in seconds.
+    """
+    chunks = source.iterate_chunks() if source is not None \
+        else iterate_csv_chunks(csv_file_path, chunk_size=chunk_size, delimiter=';')
+    insert_query = 'INSERT INTO NETFLIX_SHOWS ({}) VALUES ({})'.format(
+        ', '.join(NETFLIX_SHOWS_COLUMNS), ', '.join('?' * len(NETFLIX_SHOWS_COLUMNS)))
+
+    start_time = time.perf_counter()
+    inserted_rows = 0
+    connection.execute('DELETE FROM NETFLIX_SHOWS')
+    for chunk in chunks:
+        connection.executemany(insert_query, chunk)
+        inserted_rows += len(chunk)
+    elapsed_time = time.perf_counter() - start_time
+
+    print_load_rate('NETFLIX_SHOWS', inserted_rows, elapsed_time)
+    return inserted_rows, elapsed_time
+
+
+def load_netflix_shows_with_pandas(connection, csv_file_path):
+    """
+    Load the Netflix shows CSV in one DataFrame and replace NETFLIX_SHOWS with it.
+
+    This is the original loading path. It is kept as a baseline for the rows/sec figure of
+    `stream_netflix_shows_into_table`; note that `to_sql(if_exists="replace")` drops the schema
+    created by `create_sql_tables`.
+
+    Args:
+    - connection (sqlite3.Connection): Open connection to the SQLite database.
+    - csv_file_path (str): Path to the Netflix shows CSV file.
+
+    Returns:
+    tuple: The number of inserted rows and the elapsed time in seconds.
+    """
+    start_time = time.perf_counter()
+    netflix_shows_data = pd.read_csv(csv_file_path, delimiter=";")
+    netflix_shows_data.columns = NETFLIX_SHOWS_COLUMNS
+    netflix_shows_data.to_sql("NETFLIX_SHOWS", connection, if_exists="replace", index=False)
+    elapsed_time = time.perf_counter() - start_time
+
+    print_load_rate('NETFLIX_SHOWS', len(netflix_shows_data), elapsed_time)
+    return len(netflix_shows_data), elapsed_time
+
+
+def print_load_rate(table, inserted_rows, elapsed_time):
+    rows_per_second = inserted_rows / elapsed_time if elapsed_time > 0 else float('inf')
+    print(f"Inserted {inserted_rows} rows into {table} in {elapsed_time:.2f} s ({rows_per_second:.0f} rows/sec)")
+
+
+def create_bridge_tables(cursor):
+    """
+    Create the bridge tables linking every show to the values of its comma-separated columns.
+
+    A show from "France, United States" has one row per country in SHOW_COUNTRY, and likewise for its
+    genres (SHOW_GENRE), cast (SHOW_CAST) and directors (SHOW_DIRECTOR). Rows are keyed by show, and
+    the value column is indexed, so lookups by country, genre or director are index searches.
+
+    Args:
+    - cursor (sqlite3.Cursor): Cursor of the SQLite database.
+
+    Returns:
+    None
+    """
+    for table, (_, key_column) in BRIDGE_TABLES.items():
+        cursor.execute(f"""
+        CREATE TABLE IF NOT EXISTS {table} (
+            show_id VARCHAR(50),
+            {key_column} VARCHAR(100),
+            PRIMARY KEY (show_id, {key_column}),
+            FOREIGN KEY (show_id) REFERENCES NETFLIX_SHOWS(show_id)
+        ) WITHOUT ROWID;
+        """)
+    create_bridge_indexes(cursor)
 
-    # Check if tables were created as intended
-    show_all_tables(connection)
 
-    # Check the schema of each table
-    show_table_schema(connection, 'NETFLIX_SHOWS')
-    show_table_schema(connection, 'RATINGS')
-    show_table_schema(connection, 'GDP_PER_CAPITA')
+def create_bridge_indexes(cursor):
+    # Index of the value column of every bridge table, the show id makes it a covering index
+    for table, (_, key_column) in BRIDGE_TABLES.items():
+        cursor.execute(f'CREATE INDEX IF NOT EXISTS {table}_{key_column} ON {table} ({key_column}, show_id)')
 
-    # Check relations between tables
-    get_relations(connection)
 
+def split_values(value):
+    # Values of a comma-separated column, stripped, without blanks or repeats
+    return dict.fromkeys(item.strip() for item in value.split(',') if item.strip()) if value else {}
+
+
+def build_bridge_tables(connection, incremental=False, chunk_size=10000):
+    """
+    Fill the bridge tables from the comma-separated columns of NETFLIX_SHOWS.
+
+    Args:
+    - connection (sqlite3.Connection): Open connection to the SQLite database.
+    - incremental (bool): Only rebuild the rows of the shows listed in CHANGED_SHOWS.
+    - chunk_size (int): Number of shows split per batch.
 
-def insert_data_into_tables(database_path):
+    Returns:
+    int: The number of bridge rows inserted.
+    """
+    start_time = time.perf_counter()
+    columns = [column for column, _ in BRIDGE_TABLES.values()]
+    select_query = 'SELECT ns.show_id, {} FROM NETFLIX_SHOWS AS ns'.format(
+        ', '.join(f'ns.{column}' for column in columns))
+    # A database created before the bridge tables existed gets them in full once
+    incremental = incremental and any(
+        connection.execute(f'SELECT 1 FROM {table} LIMIT 1').fetchone() for table in BRIDGE_TABLES)
+
+    inserted_rows = 0
+    for table, (_, key_column) in BRIDGE_TABLES.items():
+        if incremental:
+            connection.execute(f'DELETE FROM {table} WHERE show_id IN (SELECT show_id FROM CHANGED_SHOWS)')
+        else:
+            # Building the index once after the inserts is faster than updating it row by row
+            connection.execute(f'DROP INDEX IF EXISTS {table}_{key_column}')
+            connection.execute(f'DELETE FROM {table}')
+    if incremental:
+        select_query += " WHERE ns.show_id IN (SELECT show_id FROM CHANGED_SHOWS WHERE change_type = 'upsert')"
+
+    shows = connection.execute(select_query)
+    while True:
+        chunk = shows.fetchmany(chunk_size)
+        if not chunk:
+            break
+        for index, table in enumerate(BRIDGE_TABLES, start=1):
+            bridge_rows = [(row[0], value) for row in chunk for value in split_values(row[index])]
+            connection.executemany(f'INSERT INTO {table} VALUES (?, ?)', bridge_rows)
+            inserted_rows += len(bridge_rows)
+    create_bridge_indexes(connection)
+
+    print_load_rate(', '.join(BRIDGE_TABLES), inserted_rows, time.perf_counter() - start_time)
+    for table in BRIDGE_TABLES:
+        show_data_from_table(connection, table)
+    return inserted_rows
+
+
+def create_incremental_state_tables(cursor):
     """
-    Insert data into SQL tables NETFLIX_SHOWS, RATINGS, and GDP_PER_CAPITA.
+    Create the state tables used by incremental loads.
+
+    - LOAD_STATE keeps the hash and source position of every loaded show.
+    - LOAD_WATERMARK keeps the hash of each source file at the last load.
+    - CHANGED_SHOWS lists the shows inserted, updated or deleted by the last load.
 
     Args:
-    - database_path (str): Path to the SQLite database.
+    - cursor (sqlite3.Cursor): Cursor of the SQLite database.
 
     Returns:
     None
     """
-    # Connect to the SQLite database
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS LOAD_STATE (
+        show_id VARCHAR(50) PRIMARY KEY,
+        row_hash CHAR(40),
+        source_row INTEGER
+    );
+    """)
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS LOAD_WATERMARK (
+        source VARCHAR(50) PRIMARY KEY,
+        file_hash CHAR(64),
+        loaded_at TIMESTAMP
+    );
+    """)
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS CHANGED_SHOWS (
+        show_id VARCHAR(50) PRIMARY KEY,
+        change_type VARCHAR(10)
+    );
+    """)
+
 
-    connection = sqlite3.connect(database_path)
+def has_load_state(connection):
+    # False before the first incremental load, and after a rollback reset the state (see `rollback_table_version`)
+    return table_exists(connection, 'LOAD_STATE') and connection.execute(
+        'SELECT 1 FROM LOAD_STATE LIMIT 1').fetchone() is not None
+
+
+def hash_row(row):
+    return hashlib.sha1('\x1f'.join('\x00' if value is None else value for value in row).encode('utf-8')).hexdigest()
+
+
+def upsert_netflix_shows_incrementally(connection, csv_file_path, lookup_file_paths, chunk_size=10000, source=None):
+    """
+    Load only new, changed or deleted Netflix shows into NETFLIX_SHOWS.
 
-    # Insert data into tables (Make sure to adapt this based on your actual data)
-    netflix_shows_data = pd.read_csv("program/data_sources/netflix_shows.csv", delimiter=";")
+    Every source row is hashed and compared with LOAD_STATE. Rows with a new or different hash are
+    UPSERTed by `show_id`, shows missing from the file are deleted, and all of them are listed in
+    CHANGED_SHOWS so that later steps recompute only those rows. When neither the shows file nor the
+    lookup files changed since the last load (see LOAD_WATERMARK), nothing is read beyond the file
+    hashes. When a lookup file changed, every show is marked as changed (see `mark_shows_changed_by_lookups`).
+
+    Args:
+    - connection (sqlite3.Connection): Open connection to the SQLite database.
+    - csv_file_path (str): Path to the Netflix shows CSV file.
+    - lookup_file_paths (list): Paths of the files the later steps depend on (ratings, GDP, directors), or
+      None when the caller runs `mark_shows_changed_by_lookups` itself once the lookup files are written.
+    - chunk_size (int): Number of rows hashed and compared per batch.
+    - source (SourceReader): Reader of `csv_file_path` shared with other stages, None to read the file directly.
+
+    Returns:
+    int: The number of changed shows.
+    """
+    start_time = time.perf_counter()
+    shows_file_hash = hash_file(csv_file_path)
+    watermark = dict(connection.execute('SELECT source, file_hash FROM LOAD_WATERMARK').fetchall())
+
+    connection.execute('DELETE FROM CHANGED_SHOWS')
+    if watermark.get('netflix_shows') == shows_file_hash:
+        print('The shows file has not changed since the last load.')
+        if lookup_file_paths is not None:
+            return mark_shows_changed_by_lookups(connection, lookup_file_paths)
+        return 0
+
+    connection.execute("""
+    CREATE TEMP TABLE IF NOT EXISTS INCOMING_HASHES (
+        show_id VARCHAR(50) PRIMARY KEY,
+        row_hash CHAR(40),
+        source_row INTEGER
+    )
+    """)
+    connection.execute('DELETE FROM temp.INCOMING_HASHES')
+
+    upsert_query = 'INSERT INTO NETFLIX_SHOWS ({}) VALUES ({}) ON CONFLICT(show_id) DO UPDATE SET {}'.format(
+        ', '.join(NETFLIX_SHOWS_COLUMNS), ', '.join('?' * len(NETFLIX_SHOWS_COLUMNS)),
+        ', '.join(f'{column} = excluded.{column}' for column in NETFLIX_SHOWS_COLUMNS[1:]))
+
+    source_row = 0
+    chunks = source.iterate_chunks() if source is not None \
+        else iterate_csv_chunks(csv_file_path, chunk_size=chunk_size, delimiter=';')
+    for chunk in chunks:
+        first_source_row = source_row
+        hashes = []
+        for row in chunk:
+            hashes.append((row[0], hash_row(row), source_row))
+            source_row += 1
+        connection.executemany('INSERT OR REPLACE INTO temp.INCOMING_HASHES VALUES (?, ?, ?)', hashes)
+
+        # Compare the chunk with the state of the last load
+        changed_ids = [show_id for (show_id,) in connection.execute("""
+        SELECT i.show_id
+        FROM temp.INCOMING_HASHES AS i
+        LEFT JOIN LOAD_STATE AS s
+        ON i.show_id = s.show_id
+        WHERE i.source_row >= ? AND (s.row_hash IS NULL OR s.row_hash != i.row_hash)
+        """, (first_source_row,))]
+        if changed_ids:
+            rows_by_id = {row[0]: row for row in chunk}
+            connection.executemany(upsert_query, [rows_by_id[show_id] for show_id in changed_ids])
+            connection.executemany("INSERT OR REPLACE INTO CHANGED_SHOWS VALUES (?, 'upsert')",
+                                   [(show_id,) for show_id in changed_ids])
+
+    # Delete shows which are no longer in the source file, also found when LOAD_STATE was reset by a rollback
+    connection.execute("""
+    INSERT OR REPLACE INTO CHANGED_SHOWS
+    SELECT show_id, 'delete' FROM NETFLIX_SHOWS
+    WHERE show_id NOT IN (SELECT show_id FROM temp.INCOMING_HASHES)
+    """)
+    connection.execute("DELETE FROM NETFLIX_SHOWS WHERE show_id IN "
+                       "(SELECT show_id FROM CHANGED_SHOWS WHERE change_type = 'delete')")
+    connection.execute("DELETE FROM LOAD_STATE WHERE show_id IN "
+                       "(SELECT show_id FROM CHANGED_SHOWS WHERE change_type = 'delete')")
+
+    connection.execute("""
+    INSERT INTO LOAD_STATE (show_id, row_hash, source_row)
+    SELECT show_id, row_hash, source_row FROM temp.INCOMING_HASHES WHERE true
+    ON CONFLICT(show_id) DO UPDATE SET row_hash = excluded.row_hash, source_row = excluded.source_row
+    WHERE row_hash != excluded.row_hash OR source_row != excluded.source_row
+    """)
+    connection.execute("INSERT OR REPLACE INTO LOAD_WATERMARK VALUES ('netflix_shows', ?, datetime('now'))",
+                       (shows_file_hash,))
+    connection.execute('DELETE FROM temp.INCOMING_HASHES')
+
+    changed_rows = connection.execute('SELECT COUNT(*) FROM CHANGED_SHOWS').fetchone()[0]
+    if lookup_file_paths is not None:
+        changed_rows = mark_shows_changed_by_lookups(connection, lookup_file_paths)
+    print(f"Incremental load of {source_row} source rows found {changed_rows} changed shows "
+          f"in {time.perf_counter() - start_time:.2f} s")
+    return changed_rows
+
+
+def mark_shows_changed_by_lookups(connection, lookup_file_paths):
+    """
+    Mark every show as changed in CHANGED_SHOWS when a lookup file changed since the last load.
+
+    Ratings, GDP per capita and popular directors affect every show, so a change to one of them means
+    all output rows are recomputed. Called after `upsert_netflix_shows_incrementally`.
+
+    Args:
+    - connection (sqlite3.Connection): Open connection to the SQLite database.
+    - lookup_file_paths (list): Paths of the files the later steps depend on (ratings, GDP, directors).
+
+    Returns:
+    int: The number of changed shows.
+    """
+    lookups_file_hash = hashlib.sha256(''.join(hash_file(path) for path in lookup_file_paths).encode()).hexdigest()
+    watermark = connection.execute("SELECT file_hash FROM LOAD_WATERMARK WHERE source = 'lookups'").fetchone()
+
+    if watermark is None or watermark[0] != lookups_file_hash:
+        print('The lookup files changed since the last load, every show is recomputed.')
+        connection.execute("INSERT OR IGNORE INTO CHANGED_SHOWS SELECT show_id, 'upsert' FROM LOAD_STATE")
+        connection.execute("INSERT OR REPLACE INTO LOAD_WATERMARK VALUES ('lookups', ?, datetime('now'))",
+                           (lookups_file_hash,))
+    return connection.execute('SELECT COUNT(*) FROM CHANGED_SHOWS').fetchone()[0]
+
+
+def load_netflix_shows(connection, chunk_size=10000, loader='stream', source=None, check_lookups=True):
+    """
+    Load the Netflix shows CSV into the NETFLIX_SHOWS table, its bridge tables (see `build_bridge_tables`)
+    and its full-text index (see `build_search_index`).
+
+    Args:
+    - connection (sqlite3.Connection): Open connection to the SQLite database.
+    - chunk_size (int): Number of rows inserted per batch by the streaming and incremental loaders.
+    - loader (str): 'stream' to stream the shows CSV into the existing schema, 'parquet' to stream the
+      Parquet staging file written by `stage_csv_to_parquet`, 'incremental' to UPSERT only new or changed
+      shows (see `upsert_netflix_shows_incrementally`), or 'pandas' for the original single-DataFrame
+      load (kept for comparing the rows/sec figure).
+    - source (SourceReader): Reader of the shows CSV shared with other stages, used by the 'stream' and
+      'incremental' loaders; `chunk_size` is then the one of the reader.
+    - check_lookups (bool): Let the 'incremental' loader mark every show as changed when a lookup file
+      changed; False when `mark_shows_changed_by_lookups` runs later, once the lookup files are written.
+
+    Returns:
+    int or None: The number of changed shows for the 'incremental' loader, otherwise None.
+    """
+    changed_rows = None
+    if loader == 'incremental':
+        changed_rows = upsert_netflix_shows_incrementally(
+            connection, "program/data_sources/netflix_shows.csv",
+            lookup_file_paths=LOOKUP_FILE_PATHS if check_lookups else None, chunk_size=chunk_size, source=source)
+    elif loader == 'stream':
+        stream_netflix_shows_into_table(connection, "program/data_sources/netflix_shows.csv", chunk_size=chunk_size,
+                                        source=source)
+    elif loader == 'parquet':
+        # Imported here, as columnar_staging builds on this module
+        from program.columnar_staging import stream_parquet_into_table
+        stream_parquet_into_table(connection, "program/data_sources/netflix_shows.parquet", chunk_size=chunk_size)
+    elif loader == 'pandas':
+        load_netflix_shows_with_pandas(connection, "program/data_sources/netflix_shows.csv")
+    else:
+        raise ValueError(f"Unknown loader '{loader}', expected 'stream', 'parquet', 'incremental' or 'pandas'")
+
+    show_data_from_table(connection, 'NETFLIX_SHOWS')
+    build_bridge_tables(connection, incremental=loader == 'incremental', chunk_size=chunk_size)
+    build_search_index(connection, incremental=loader == 'incremental')
+    return changed_rows
+
+
+def load_lookup_tables(connection):
+    """
+    Load the ratings, GDP per capita and popular directors CSVs into the RATINGS, GDP_PER_CAPITA and
+    POPULAR_DIRECTORS tables.
+
+    Args:
+    - connection (sqlite3.Connection): Open connection to the SQLite database.
+    """
+    # The lookup tables are small, so they are still loaded with pandas but appended to the existing schema
     ratings_data = pd.read_csv("program/data_sources/ratings.csv")
     gdp_per_capita_data = pd.read_csv("program/data_sources/gdp_per_capita.csv")
 
-    netflix_shows_data.columns = ['show_id', 'type', 'title', 'director', 'cast', 'country', 'date_added',
-                                  'release_year', 'rating_id', 'duration', 'listed_in', 'description']
-
-    # Write data into tables
-    netflix_shows_data.to_sql("NETFLIX_SHOWS", connection, if_exists="replace", index=False)
-    ratings_data.to_sql("RATINGS", connection, if_exists="replace", index=False)
-    gdp_per_capita_data.to_sql("GDP_PER_CAPITA", connection, if_exists="replace", index=False)
+    popular_directors_data = pd.read_csv("program/data_sources/popular_directors.csv", delimiter=';')
 
-    # Commit the changes
-    connection.commit()
+    connection.execute('DELETE FROM RATINGS')
+    connection.execute('DELETE FROM GDP_PER_CAPITA')
+    connection.execute('DELETE FROM POPULAR_DIRECTORS')
+    ratings_data.to_sql("RATINGS", connection, if_exists="append", index=False)
+    gdp_per_capita_data.to_sql("GDP_PER_CAPITA", connection, if_exists="append", index=False)
+    # A line of the directors file can list several directors
+    connection.executemany('INSERT OR IGNORE INTO POPULAR_DIRECTORS VALUES (?)', [
+        (director,) for value in popular_directors_data['director'].dropna() for director in split_values(value)])
 
     # Check if data was inserted into tables
-    show_data_from_table(connection, 'NETFLIX_SHOWS')
     show_data_from_table(connection, 'RATINGS')
     show_data_from_table(connection, 'GDP_PER_CAPITA')
+    show_data_from_table(connection, 'POPULAR_DIRECTORS')
 
-    # Close the connection
-    connection.close()
 
+def insert_data_into_tables(connection, chunk_size=10000, loader='stream'):
+    """
+    Insert data into SQL tables NETFLIX_SHOWS (with its bridge tables), RATINGS, GDP_PER_CAPITA and POPULAR_DIRECTORS.
 
-def join_tables(database_path, new_table):
+    Args:
+    - connection (sqlite3.Connection): Open connection to the SQLite database.
+    - chunk_size (int): Number of Netflix shows rows inserted per batch by the streaming loader.
+    - loader (str): Loader of the Netflix shows, see `load_netflix_shows`.
+
+    Returns:
+    int or None: The number of changed shows for the 'incremental' loader, otherwise None.
+    """
+    changed_rows = load_netflix_shows(connection, chunk_size=chunk_size, loader=loader)
+    load_lookup_tables(connection)
+    return changed_rows
+
+
+def join_tables(connection, new_table, incremental=False, batch_size=None):
     """
     Join NETFLIX_SHOWS and RATINGS tables and create a new table.
 
     Args:
-    - database_path (str): Path to the SQLite database.
+    - connection (sqlite3.Connection): Open connection to the SQLite database.
     - new_table (str): Name of the new table to be created.
+    - incremental (bool): Only recompute the rows of the shows listed in CHANGED_SHOWS.
+    - batch_size (int): Join and write the shows `batch_size` rows at a time, None to join them all at once.
 
     Returns:
     None
     """
 
-    # Connect to the SQLite database
-    connection = sqlite3.connect(database_path)
-
     sql_query = '''
     SELECT ns.show_id, ns.type, ns.title, ns.director, ns.cast, ns.country, ns.date_added, ns.release_year, r.name as rating, ns.duration, ns.listed_in, ns.description
     FROM NETFLIX_SHOWS AS ns
     LEFT JOIN RATINGS AS r
     ON ns.rating_id = r.id
     '''
-    # Join tables
-    netflix_shows_ratings = pd.read_sql_query(sql_query, connection, index_col='show_id')
 
-    # Write data into tables
-    netflix_shows_ratings.to_sql(new_table, connection, if_exists="replace", index=True, index_label='show_id')
+    if incremental and table_exists(connection, new_table):
+        # Replace only the rows of changed shows
+        connection.execute(f'DELETE FROM {new_table} WHERE show_id IN (SELECT show_id FROM CHANGED_SHOWS)')
+        connection.execute(f'''
+        INSERT INTO {new_table} (show_id, type, title, director, cast, country, date_added, release_year, rating, duration, listed_in, description)
+        {sql_query}
+        WHERE ns.show_id IN (SELECT show_id FROM CHANGED_SHOWS WHERE change_type = 'upsert')
+        ''')
+        show_data_from_table(connection, new_table)
+        return
+
+    if batch_size:
+        # Stream the joined rows into the table, with the show_id index `to_sql` creates for the index column
+        joined_batches = iterate_typed_sql(sql_query, connection, chunk_size=batch_size)
+        joined_rows = sum(len(batch) for batch in write_typed_batches(joined_batches, new_table, connection))
+        connection.execute(f'CREATE INDEX "ix_{new_table}_show_id" ON "{new_table}" ("show_id")')
+        print(f'Joined {joined_rows} shows in batches of {batch_size} rows')
+        show_data_from_table(connection, new_table)
+        return
+
+    # Join tables, with the compact dtypes of the typed loading layer
+    netflix_shows_ratings = read_typed_sql(sql_query, connection, index_col='show_id')
 
-    # Commit the changes
-    connection.commit()
+    # Write data into tables
+    write_typed_sql(netflix_shows_ratings, new_table, connection, if_exists="replace", index=True,
+                    index_label='show_id')
 
     # Check if data was inserted into tables
     show_data_from_table(connection, new_table)
 
-    # Close the connection
-    connection.close()
-
 
-def create_view(database_path, new_view):
+def create_view(connection, new_view):
     """
     Create a new view.
         Args:
-    - database_path (str): Path to the SQLite database.
+    - connection (sqlite3.Connection): Open connection to the SQLite database.
     - new_view (str): Name of the new view to be created.
     
     Returns:
     None
     """
-    # Connect to the SQLite database
-    connection = sqlite3.connect(database_path)
-
     # Create a new view
     sql_query = '''
     CREATE VIEW IF NOT EXISTS {} AS
@@ -170,24 +588,45 @@ def create_view(database_path, new_view):
     # Create a new view
     connection.execute(sql_query)
 
-    # Commit the changes
-    connection.commit()
+    show_data_from_table(connection, new_view)
+
+
+def clean_netflix_data(view_data):
+    """
+    Apply the cleaning operations of `clean_and_create_table` to a DataFrame loaded from the view.
+
+    Parameters:
+    - view_data (pd.DataFrame): Rows of the view with Netflix shows and their ratings, read by `read_typed_sql`.
+
+    Returns:
+    - pd.DataFrame: The cleaned rows, with the dtypes of CATALOG_DTYPES.
+    """
+    # Remove rows where "cast" is empty
+    view_data = view_data[view_data['cast'].notna() & (view_data['cast'] != '')]
+
+    # Replace missing values in "country" with 'unknown'
+    view_data['country'] = fill_missing(view_data['country'], 'unknown')
+
+    # Replace multiple countries in "country" with 'many'
+    view_data['country'] = replace_multiple_countries(view_data['country'])
+
+    # Remove "|TITLE|" from "title"
+    view_data['title'] = view_data['title'].str.replace('|TITLE|', '')
 
-    sql_query = '''SELECT show_id, rating FROM {}'''.format(new_view)
-    view_data = pd.read_sql_query(sql_query, connection)
-    print(view_data)
+    # Add a new column "release_2000_or_newer"
+    view_data['release_2000_or_newer'] = pd.Categorical(flag_release_2000_or_newer(view_data['release_year']))
 
-    # Close the connection
-    connection.close()
+    return view_data
 
 
-def clean_and_create_table(database_path, view):
+def clean_and_create_table(connection, view, incremental=False, keep_versions=KEPT_VERSIONS, batch_size=None):
     """
     Function: clean_and_create_table
 
     Description:
-    This function connects to an SQLite database specified by the `database_path`, loads data from the specified `view`,
-    applies various cleaning operations on the data, and creates a new table named NETFLIX_COMBINED_CLEANED in the same database.
+    This function uses the SQLite database behind `connection`, loads data from the specified `view`,
+    applies various cleaning operations on the data, and publishes a new version of NETFLIX_COMBINED_CLEANED in the same
+    database (see `swap_table_version`), so readers of the table are not interrupted.
 
     Cleaning Operations:
     1. Removes rows where the "cast" column is empty.
@@ -197,33 +636,91 @@ def clean_and_create_table(database_path, view):
     5. Adds a new column "release_2000_or_newer" indicating whether the movie was released in 2000 or later.
 
     Parameters:
-    - database_path: Path to the SQLite database.
+    - connection: Open connection to the SQLite database.
     - view: The name of the view from which data will be loaded.
+    - incremental: Only clean the shows listed in CHANGED_SHOWS and replace their rows in a copy of the table.
+    - keep_versions: Number of previous versions of the table kept for rollbacks.
+    - batch_size: Clean the shows `batch_size` rows at a time, each batch read from the view with `fetchmany` and
+      appended to the table, so the catalog never has to fit in memory; None to clean them all at once.
 
     Usage Example:
-    clean_and_create_table('your_database.db', 'your_view_name')
+    clean_and_create_table(connection, 'your_view_name')
     """
 
-    connection = sqlite3.connect(database_path)
-    # Load data from the VIEW into a pandas DataFrame
-    view_data = pd.read_sql_query(f'SELECT * FROM {view}', connection)
+    if incremental and table_exists(connection, 'NETFLIX_COMBINED_CLEANED'):
+        # Load only the changed shows from the VIEW
+        view_data = read_typed_sql(
+            f'SELECT * FROM {view} WHERE show_id IN (SELECT show_id FROM CHANGED_SHOWS)', connection)
+        view_data = clean_netflix_data(view_data)
+
+        # Replace the rows of the changed shows in a copy of the published version
+        shadow_table, version = new_table_version(connection, 'NETFLIX_COMBINED_CLEANED', copy_published=True)
+        connection.execute(f'DELETE FROM {shadow_table} WHERE show_id IN (SELECT show_id FROM CHANGED_SHOWS)')
+        write_typed_sql(view_data, shadow_table, connection, if_exists='append', index=False)
+    elif batch_size:
+        # Stream the VIEW through the cleaning operations into a new version of the table, one batch at a time
+        shadow_table, version = new_table_version(connection, 'NETFLIX_COMBINED_CLEANED')
+        cleaned_batches = (clean_netflix_data(batch) for batch in
+                           iterate_typed_sql(f'SELECT * FROM {view}', connection, chunk_size=batch_size))
+        cleaned_rows = sum(len(batch) for batch in write_typed_batches(cleaned_batches, shadow_table, connection))
+        print(f'Cleaned {cleaned_rows} shows in batches of {batch_size} rows')
+    else:
+        # Load data from the VIEW into a pandas DataFrame
+        view_data = read_typed_sql(f'SELECT * FROM {view}', connection)
+        view_data = clean_netflix_data(view_data)
+
+        # Write data to a new version of the table
+        shadow_table, version = new_table_version(connection, 'NETFLIX_COMBINED_CLEANED')
+        write_typed_sql(view_data, shadow_table, connection, if_exists='replace', index=False, index_label='show_id')
+
+    swap_table_version(connection, 'NETFLIX_COMBINED_CLEANED', version, keep_versions=keep_versions)
+    show_data_from_table(connection, 'NETFLIX_COMBINED_CLEANED')
 
-    # Remove rows where "cast" is empty
-    view_data = view_data[view_data['cast'].notna() & (view_data['cast'] != '')]
 
-    # Replace missing values in "country" with 'unknown'
-    view_data['country'].fillna('unknown', inplace=True)
+def clean_and_filter_kids_friendly_in_sql(connection, view, new_table='NETFLIX_KIDS_FRIENDLY',
+                                          excluded_ratings=KIDS_EXCLUDED_RATINGS,
+                                          excluded_queries=KIDS_EXCLUDED_QUERIES):
+    """
+    Clean the shows and filter the kids-friendly ones with a single CREATE TABLE ... AS SELECT statement.
 
-    # Replace multiple countries in "country" with 'many'
-    view_data['country'] = view_data['country'].apply(lambda x: 'many' if ',' in str(x) else x)
+    This is the SQL-native counterpart of `clean_and_create_table` followed by
+    `filter_kids_friendly_movies_from_sql`: the same cleaning operations, the rating exclusion list
+    and the full-text content filter run inside SQLite, without intermediate DataFrames. The
+    pandas path stays available to compare the output with.
 
-    # Remove "|TITLE|" from "title"
-    view_data['title'] = view_data['title'].str.replace('|TITLE|', '')
+    Args:
+    - connection (sqlite3.Connection): Open connection to the SQLite database.
+    - view (str): Name of the view with Netflix shows and their ratings.
+    - new_table (str): Name of the table with the kids-friendly shows.
+    - excluded_ratings (tuple): Ratings which are not suitable for kids.
+    - excluded_queries (tuple): FTS5 queries over SHOWS_FTS; shows matching one of them are removed.
 
-    # Add a new column "release_2000_or_newer"
-    view_data['release_2000_or_newer'] = view_data['release_year'].apply(lambda year: 'yes' if year >= 2000 else 'no')
+    Returns:
+    pd.DataFrame: The kids-friendly shows, in the shape returned by `filter_kids_friendly_movies_from_sql`.
+    """
+    rating_placeholders = ', '.join('?' * len(excluded_ratings))
+    query_condition, query_params = excluded_shows_condition('v.show_id', excluded_queries)
+    sql_query = f'''
+    CREATE TABLE {new_table} AS
+    SELECT v.show_id, v.type,
+           replace(v.title, '|TITLE|', '') AS title,
+           v.director, v.cast,
+           CASE
+               WHEN v.country IS NULL THEN 'unknown'
+               WHEN instr(v.country, ',') > 0 THEN 'many'
+               ELSE v.country
+           END AS country,
+           v.date_added, v.release_year, v.rating, v.duration, v.listed_in, v.description,
+           CASE WHEN v.release_year >= 2000 THEN 'yes' ELSE 'no' END AS release_2000_or_newer
+    FROM {view} AS v
+    WHERE v.cast IS NOT NULL AND v.cast != ''
+      AND v.rating NOT IN ({rating_placeholders}){query_condition}
+    '''
 
-    # Write data to a new table
-    view_data.to_sql('NETFLIX_COMBINED_CLEANED', connection, if_exists='replace', index=False, index_label='show_id')
-    show_data_from_table(connection, 'NETFLIX_COMBINED_CLEANED')
-    connection.close()
+    connection.execute(f'DROP TABLE IF EXISTS {new_table}')
+    connection.execute(sql_query, (*excluded_ratings, *query_params))
+
+    kids_friendly_data = read_typed_sql(f'SELECT * FROM {new_table}', connection)
+
+    show_dataframe(new_table, kids_friendly_data)
+    return kids_friendly_data
@@ -1,4 +1,8 @@
-import pandas as pd
+import csv
+import hashlib
+from program.helper_functions import lazy_import
+
+pd = lazy_import('pandas')
 
 
 def get_unique_countries(csv_file_path):
@@ -28,3 +32,122 @@ def get_unique_countries(csv_file_path):
     unique_countries = [country for country in unique_countries if country]
 
     return unique_countries
+
+
+def iterate_csv_chunks(csv_file_path, chunk_size=10000, delimiter=';'):
+    """
+    Read a CSV file lazily and yield its rows in fixed-size chunks.
+
+    Parameters:
+    - csv_file_path (str): The path to the CSV file.
+    - chunk_size (int): The maximum number of rows per chunk.
+    - delimiter (str): The field delimiter of the CSV file.
+
+    Yields:
+    - list: A list of at most `chunk_size` row tuples. The header row is skipped and
+      empty fields are returned as None, so they end up as NULL in SQL tables.
+    """
+    with open(csv_file_path, newline='', encoding='utf-8') as csv_file:
+        reader = csv.reader(csv_file, delimiter=delimiter)
+        next(reader, None)
+
+        chunk = []
+        for row in reader:
+            chunk.append(tuple(value if value != '' else None for value in row))
+            if len(chunk) >= chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+
+class SourceReader:
+    """
+    Parse a ';'-delimited source CSV once and publish what the pipeline stages need from it.
+
+    The loader consumes the row stream from `iterate_chunks`, and the distinct values of the
+    `collected_columns` are gathered on the way, so the unique countries come without a second parse.
+    When they are asked for before or without the stream being consumed, the file is parsed then,
+    still only once.
+
+    Parameters:
+    - csv_file_path (str): The path to the CSV file.
+    - chunk_size (int): The maximum number of rows per chunk.
+    - delimiter (str): The field delimiter of the CSV file.
+    - collected_columns (list): Comma-separated columns whose distinct values are collected.
+    """
+
+    def __init__(self, csv_file_path, chunk_size=10000, delimiter=';', collected_columns=('country',)):
+        self.csv_file_path = csv_file_path
+        self.chunk_size = chunk_size
+        self.delimiter = delimiter
+        self.collected_columns = list(collected_columns)
+        self.distinct_values = {column: {} for column in self.collected_columns}
+        self.row_count = 0
+        self.consumed = False
+        self.complete = False
+
+    def read_header(self):
+        with open(self.csv_file_path, newline='', encoding='utf-8') as csv_file:
+            return next(csv.reader(csv_file, delimiter=self.delimiter))
+
+    def iterate_chunks(self):
+        """
+        Yield the rows of the file in chunks, like `iterate_csv_chunks`, collecting the distinct values.
+
+        Raises:
+        - RuntimeError: The file was already read during this run.
+        """
+        if self.consumed:
+            raise RuntimeError(f'{self.csv_file_path} was already read during this run')
+        self.consumed = True
+        header = self.read_header()
+        collected = [(header.index(column), self.distinct_values[column]) for column in self.collected_columns]
+
+        for chunk in iterate_csv_chunks(self.csv_file_path, chunk_size=self.chunk_size, delimiter=self.delimiter):
+            for index, values in collected:
+                for value in dict.fromkeys(row[index] for row in chunk):
+                    if value is not None:
+                        for item in value.split(','):
+                            item = item.strip()
+                            if item:
+                                values[item] = None
+            self.row_count += len(chunk)
+            yield chunk
+        self.complete = True
+
+    def unique_values(self, column):
+        """
+        Get the distinct values of a collected column, in order of first appearance.
+        """
+        if not self.consumed:
+            for _ in self.iterate_chunks():
+                pass
+        elif not self.complete:
+            raise RuntimeError(f'{self.csv_file_path} was not read to the end')
+        return list(self.distinct_values[column])
+
+    def unique_countries(self):
+        """
+        Get a list of all unique countries, like `get_unique_countries`.
+        """
+        return self.unique_values('country')
+
+
+def hash_file(file_path, block_size=1 << 20, algorithm='sha256'):
+    """
+    Compute the hash of a file (SHA-256 by default) without loading it into memory.
+
+    Parameters:
+    - file_path (str): The path to the file.
+    - block_size (int): The number of bytes read at a time.
+    - algorithm (str): Name of the `hashlib` algorithm, e.g. 'md5' to compare with Cloud Storage.
+
+    Returns:
+    - str: The hexadecimal digest of the file content.
+    """
+    digest = hashlib.new(algorithm)
+    with open(file_path, 'rb') as file:
+        for block in iter(lambda: file.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
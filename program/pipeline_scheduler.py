@@ -0,0 +1,310 @@
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from program.instrumentation import instrument_stage, count_rows, measure_in_worker
+from program.sql_session import stage_transaction
+from program.stage_cache import forget_cached_outputs
+
+STAGE_KINDS = ['io', 'cpu', 'db']
+
+
+class Stage:
+    """
+    A named pipeline stage with the artifacts it reads and writes.
+
+    Parameters:
+    - name (str): Name of the stage, used by --only/--from and in the run metrics.
+    - function (callable): Called with `args`; a returned dict holds in-memory artifacts (e.g. a DataFrame)
+      which are added to the artifacts of the run, other return values are ignored.
+    - kind (str): 'io' stages run in a thread pool, 'cpu' stages in a process pool (the function and its
+      args must be picklable), 'db' stages one at a time on the scheduler thread, inside a transaction of
+      the shared connection.
+    - inputs (list): Artifacts read by the stage: table names, files or in-memory values.
+    - outputs (list): Artifacts written by the stage.
+    - args (tuple): Positional arguments of `function`.
+    - skip_if (callable): Called with the artifacts of the run before the stage starts; when it returns
+      True the stage and everything downstream of it is skipped.
+    - cacheable (bool): The outputs only depend on the inputs, `params` and the code, so the stage can be
+      skipped when they have not changed (see StageCache).
+    - params (dict): Parameters of the stage which change its outputs, part of its fingerprint.
+    """
+
+    def __init__(self, name, function, kind='db', inputs=(), outputs=(), args=(), skip_if=None, cacheable=False,
+                 params=None):
+        if kind not in STAGE_KINDS:
+            raise ValueError(f"Unknown stage kind '{kind}', expected one of {STAGE_KINDS}")
+        self.name = name
+        self.function = function
+        self.kind = kind
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.args = tuple(args)
+        self.skip_if = skip_if
+        self.cacheable = cacheable
+        self.params = params or {}
+
+
+def stage_dependencies(stages):
+    """
+    Derive the dependencies of each stage from the artifacts it reads.
+
+    A stage depends on the stages which write one of its inputs. Inputs written by no stage are
+    expected to exist before the run.
+
+    Returns:
+    - dict: The names of the upstream stages by stage name.
+    """
+    producers = {}
+    for stage in stages:
+        for output in stage.outputs:
+            if output in producers:
+                raise ValueError(f"'{output}' is written by both {producers[output]} and {stage.name}")
+            producers[output] = stage.name
+
+    dependencies = {stage.name: {producers[name] for name in stage.inputs if name in producers} - {stage.name}
+                    for stage in stages}
+
+    # Reject cycles, which would leave stages waiting forever
+    visited, visiting = set(), set()
+
+    def visit(name):
+        if name in visiting:
+            raise ValueError(f'The stages have a dependency cycle through {name}')
+        if name not in visited:
+            visiting.add(name)
+            for upstream in dependencies[name]:
+                visit(upstream)
+            visiting.remove(name)
+            visited.add(name)
+
+    for name in dependencies:
+        visit(name)
+    return dependencies
+
+
+def downstream_stages(dependencies, names):
+    # The given stages and every stage depending on them, directly or not
+    selected = set(names)
+    changed = True
+    while changed:
+        changed = False
+        for name, upstream in dependencies.items():
+            if name not in selected and upstream & selected:
+                selected.add(name)
+                changed = True
+    return selected
+
+
+def select_stages(stages, only=None, from_stage=None):
+    """
+    Select the stages to run.
+
+    Parameters:
+    - stages (list): All stages of the pipeline.
+    - only (list): Run only these stages; the artifacts they read must already exist.
+    - from_stage (str): Run this stage and everything downstream of it.
+
+    Returns:
+    - list: The selected stages, in declaration order.
+    """
+    names = [stage.name for stage in stages]
+    for name in [*(only or []), *([from_stage] if from_stage else [])]:
+        if name not in names:
+            raise ValueError(f"Unknown stage '{name}', expected one of {names}")
+
+    selected = set(names)
+    if from_stage:
+        selected = downstream_stages(stage_dependencies(stages), [from_stage])
+    if only:
+        selected &= set(only)
+    return [stage for stage in stages if stage.name in selected]
+
+
+def critical_path(durations, dependencies):
+    """
+    Find the longest chain of dependent stages, which bounds the wall time of a concurrent run.
+
+    Parameters:
+    - durations (dict): Wall time of each stage which ran, in seconds.
+    - dependencies (dict): Upstream stages by stage name, from `stage_dependencies`.
+
+    Returns:
+    - tuple: The length of the critical path in seconds and the names of its stages.
+    """
+    longest = {}
+
+    def path_to(name):
+        if name not in longest:
+            upstream = [path_to(dependency) for dependency in dependencies[name] if dependency in durations]
+            seconds, path = max(upstream, default=(0.0, []))
+            longest[name] = (seconds + durations[name], [*path, name])
+        return longest[name]
+
+    return max((path_to(name) for name in durations), default=(0.0, []))
+
+
+def record_result(record, result, connection=None, tables=()):
+    # Rows of the output tables, or else of the first in-memory output such as a DataFrame or a list
+    record['rows_out'] = count_rows(connection, tables)
+    sized = [value for value in (result or {}).values() if hasattr(value, '__len__')]
+    if record['rows_out'] is None and sized:
+        record['rows_out'] = len(sized[0])
+
+
+def run_stage(stage, run_metrics, connection, artifacts, process_pool=None):
+    """
+    Run one stage with its instrumentation; 'db' stages also get a transaction of `connection`.
+    """
+    if stage.kind == 'db':
+        with instrument_stage(run_metrics, stage.name, connection, tables_in=stage.inputs,
+                              tables_out=stage.outputs) as record, stage_transaction(connection):
+            result = stage.function(*stage.args)
+            result = result if isinstance(result, dict) else None
+            record_result(record, result, connection, stage.outputs)
+    else:
+        with instrument_stage(run_metrics, stage.name) as record:
+            if stage.kind == 'cpu':
+                result, record['worker_metrics'] = process_pool.submit(
+                    measure_in_worker, stage.function, *stage.args).result()
+            else:
+                result = stage.function(*stage.args)
+            result = result if isinstance(result, dict) else None
+            record_result(record, result)
+
+    if result:
+        artifacts.update(result)
+    return result
+
+
+def run_stages(stages, run_metrics, connection, artifacts=None, only=None, from_stage=None, max_io_workers=4,
+               max_cpu_workers=2, stage_cache=None):
+    """
+    Run the pipeline stages as a dependency graph, starting each stage as soon as its inputs are written.
+
+    'io' stages (downloads, API calls) run in a thread pool and 'cpu' stages in a process pool, while
+    'db' stages run one at a time on this thread, since the SQLite connection is shared and a database
+    has a single writer. When a stage fails, no new stage is started, the running ones are awaited and
+    the error is raised. At the end the critical path of the run is printed against the serial total.
+
+    Parameters:
+    - stages (list): The Stage objects of the pipeline.
+    - run_metrics (dict): The run metrics from `start_run_metrics`.
+    - connection (sqlite3.Connection): The shared pipeline connection.
+    - artifacts (dict): In-memory artifacts of the run, filled with the values returned by the stages.
+    - only (list): Run only these stages.
+    - from_stage (str): Run this stage and everything downstream of it.
+    - max_io_workers (int): Number of threads for 'io' stages; 'cpu' stages also wait in one of them.
+    - max_cpu_workers (int): Number of processes for 'cpu' stages.
+    - stage_cache (StageCache): Cache of the cacheable stages, None to run every stage.
+
+    Returns:
+    - dict: The artifacts of the run.
+    """
+    artifacts = {} if artifacts is None else artifacts
+    dependencies = stage_dependencies(stages)
+    selected = select_stages(stages, only=only, from_stage=from_stage)
+    # Stages which are not selected count as done, their artifacts are read from a previous run
+    pending = {stage.name: stage for stage in selected}
+    done = {stage.name for stage in stages} - set(pending)
+    skipped = set()
+    durations = {}
+    fingerprints = {}
+    running = {}
+    failure = None
+    start_time = time.perf_counter()
+
+    def stage_fingerprint(stage):
+        if stage_cache is None:
+            return None
+        input_fingerprints = {name: fingerprints[name] if name in fingerprints
+                              else stage_cache.artifact_fingerprint(name) for name in stage.inputs}
+        return stage_cache.fingerprint(stage, input_fingerprints)
+
+    def finish(stage, fingerprint, result, seconds, cached=False):
+        done.add(stage.name)
+        durations[stage.name] = seconds
+        for output in stage.outputs:
+            # Files written by stages which are not cached are fingerprinted by their content
+            if stage.cacheable or not os.path.isfile(output):
+                fingerprints[output] = fingerprint
+        if stage.cacheable and stage_cache is not None:
+            if not cached:
+                stage_cache.store(stage, fingerprint, result)
+        else:
+            # Incremental runs and stages which are not cacheable rewrite tables the cache may have recorded
+            with stage_transaction(connection):
+                forget_cached_outputs(connection, stage.outputs)
+
+    process_pool = ProcessPoolExecutor(max_workers=max_cpu_workers) if any(
+        stage.kind == 'cpu' for stage in selected) else None
+    thread_pool = ThreadPoolExecutor(max_workers=max_io_workers, thread_name_prefix='stage')
+    try:
+        while (pending and failure is None) or running:
+            ready = [stage for name, stage in pending.items()
+                     if failure is None and dependencies[name] <= done | skipped]
+            db_stage = None
+            for stage in ready:
+                if stage.kind == 'db' and db_stage is not None:
+                    # The other ready 'db' stages start after this one
+                    continue
+                del pending[stage.name]
+                if dependencies[stage.name] & skipped or (stage.skip_if and stage.skip_if(artifacts)):
+                    print(f'Skipping {stage.name}')
+                    skipped.add(stage.name)
+                    continue
+
+                fingerprint = stage_fingerprint(stage)
+                if stage.cacheable and stage_cache is not None:
+                    stage_start = time.perf_counter()
+                    cached = stage_cache.lookup(stage, fingerprint)
+                    if cached is not None:
+                        with instrument_stage(run_metrics, stage.name) as record:
+                            record['status'] = 'cached'
+                            artifacts.update(cached)
+                        print(f'{stage.name}: inputs unchanged, reusing the cached outputs')
+                        finish(stage, fingerprint, cached, time.perf_counter() - stage_start, cached=True)
+                        continue
+
+                if stage.kind != 'db':
+                    running[thread_pool.submit(run_stage, stage, run_metrics, connection, artifacts,
+                                               process_pool)] = (stage, fingerprint, time.perf_counter())
+                else:
+                    db_stage = (stage, fingerprint)
+            if db_stage is not None:
+                stage, fingerprint = db_stage
+                stage_start = time.perf_counter()
+                try:
+                    result = run_stage(stage, run_metrics, connection, artifacts)
+                    finish(stage, fingerprint, result, time.perf_counter() - stage_start)
+                except Exception as error:
+                    failure = failure or error
+            if ready:
+                continue
+
+            if not running:
+                if pending and failure is None:
+                    raise RuntimeError(f'Stages {sorted(pending)} wait for inputs no stage writes')
+                break
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                stage, fingerprint, stage_start = running.pop(future)
+                try:
+                    result = future.result()
+                    finish(stage, fingerprint, result, time.perf_counter() - stage_start)
+                except Exception as error:
+                    failure = failure or error
+    finally:
+        thread_pool.shutdown(wait=True)
+        if process_pool is not None:
+            process_pool.shutdown(wait=True)
+
+    if failure is not None:
+        raise failure
+
+    if stage_cache is not None:
+        stage_cache.evict()
+    wall_time = time.perf_counter() - start_time
+    critical_seconds, critical_stages = critical_path(durations, dependencies)
+    print(f'Ran {len(durations)} stages in {wall_time:.2f} s: serial total {sum(durations.values()):.2f} s, '
+          f'critical path {critical_seconds:.2f} s ({" -> ".join(critical_stages)})')
+    return artifacts
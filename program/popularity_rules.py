@@ -0,0 +1,177 @@
+import json
+import os
+import pickle
+from pathlib import Path
+from program.helper_functions import lazy_import
+
+np = lazy_import('numpy')
+pd = lazy_import('pandas')
+
+# Rules scoring the popularity of the shows, shipped with the code, and where they are kept compiled
+POPULARITY_RULES_PATH = str(Path(__file__).resolve().parent / 'popularity_rules.json')
+COMPILED_RULES_PATH = 'program/database/popularity_rules.pkl'
+# How a value rule takes the value of a show from its values of the field, e.g. the GDP of its countries:
+# - single: the value of its only country, shows with several are never matched
+# - mean: the mean of its values found in the lookup
+AGGREGATES = ('single', 'mean')
+RULE_TYPES = ('in_list', 'value_below')
+
+# Compiled rules by rule file, with the modification times they were compiled from
+compiled_rules_by_path = {}
+
+
+def read_rules(rules_path):
+    """
+    Read and check a popularity rule file.
+
+    The file holds a `default_popularity` and a list of `rules`, tried in order; the first rule matching a
+    show gives its `popularity`. Each rule reads a comma-separated `field` of NETFLIX_SHOWS and a `lookup`
+    CSV file (`path`, `key` column, optional `delimiter`):
+    - in_list: matches shows with one of their values in the `key` column, e.g. a popular director;
+    - value_below: matches shows whose value, taken from the `value` column of the lookup with `aggregate`
+      (see AGGREGATES), is below `threshold`, e.g. a low GDP per capita.
+
+    Parameters:
+    - rules_path (str): Path of the JSON rule file.
+
+    Returns:
+    - dict: The rules.
+    """
+    with open(rules_path) as rules_file:
+        rules = json.load(rules_file)
+    if 'default_popularity' not in rules or not isinstance(rules.get('rules'), list):
+        raise ValueError(f'{rules_path} needs a default_popularity and a list of rules')
+    for rule in rules['rules']:
+        name = rule.get('name', rule.get('field'))
+        required = ['type', 'field', 'lookup', 'popularity']
+        if rule.get('type') == 'value_below':
+            required += ['aggregate', 'threshold']
+        missing = [key for key in required if key not in rule] + \
+            [f'lookup.{key}' for key in ['path', 'key'] if key not in rule.get('lookup', {})]
+        if missing:
+            raise ValueError(f"Rule '{name}' of {rules_path} is missing {missing}")
+        if rule['type'] not in RULE_TYPES:
+            raise ValueError(f"Unknown type '{rule['type']}' of rule '{name}', expected one of {list(RULE_TYPES)}")
+        if rule['type'] == 'value_below' and rule['aggregate'] not in AGGREGATES:
+            raise ValueError(f"Unknown aggregate '{rule['aggregate']}' of rule '{name}', "
+                             f"expected one of {list(AGGREGATES)}")
+        if rule['type'] == 'value_below' and 'value' not in rule['lookup']:
+            raise ValueError(f"Rule '{name}' of {rules_path} is missing lookup.value")
+    return rules
+
+
+def split_field(values):
+    """
+    Split a comma-separated column into one row per value, stripped, without blanks or repeats.
+
+    Parameters:
+    - values (pd.Series): The column, e.g. the directors of the shows.
+
+    Returns:
+    - pd.Series: The values, indexed by the index of the row they come from.
+    """
+    split_values = values.dropna().str.split(',').explode().str.strip()
+    split_values = split_values[split_values.notna() & (split_values != '')]
+    return split_values[~split_values.reset_index().duplicated().to_numpy()]
+
+
+def compile_rule(rule):
+    # Read the lookup of a rule once into a set of keys, or a map of values and the set of keys below the threshold
+    lookup = rule['lookup']
+    lookup_data = pd.read_csv(lookup['path'], delimiter=lookup.get('delimiter', ','))
+    compiled_rule = {key: rule[key] for key in ['type', 'field', 'popularity']}
+    if rule['type'] == 'in_list':
+        # A line of the lookup can list several keys, e.g. the directors of a show
+        compiled_rule['keys'] = frozenset(split_field(lookup_data[lookup['key']].dropna().astype(str)))
+    else:
+        values = lookup_data.dropna(subset=[lookup['value']])
+        compiled_rule['values'] = dict(zip(values[lookup['key']], values[lookup['value']].astype(float)))
+        compiled_rule['keys'] = frozenset(key for key, value in compiled_rule['values'].items()
+                                          if value < rule['threshold'])
+        compiled_rule.update(aggregate=rule['aggregate'], threshold=rule['threshold'])
+    return compiled_rule
+
+
+def source_versions(paths):
+    return {path: [os.stat(path).st_mtime_ns, os.stat(path).st_size] for path in paths}
+
+
+def compile_rules(rules_path=POPULARITY_RULES_PATH, cache_path=COMPILED_RULES_PATH):
+    """
+    Compile a rule file and its lookup files into sets and maps, reusing the last compilation while none of
+    the files changed.
+
+    The compiled rules are kept in memory and pickled to `cache_path`, along with the modification time
+    and size of each file they were compiled from.
+
+    Parameters:
+    - rules_path (str): Path of the JSON rule file, see `read_rules`.
+    - cache_path (str): Path of the pickled compiled rules, None to only keep them in memory.
+
+    Returns:
+    - dict: The default popularity and the compiled rules.
+    """
+    cached = compiled_rules_by_path.get(rules_path)
+    if cached is None and cache_path is not None and os.path.isfile(cache_path):
+        with open(cache_path, 'rb') as cache_file:
+            cached = pickle.load(cache_file)
+    if cached is not None and cached['rules_path'] == rules_path:
+        try:
+            if source_versions(cached['sources']) == cached['sources']:
+                compiled_rules_by_path[rules_path] = cached
+                return cached
+        except OSError:
+            pass
+
+    rules = read_rules(rules_path)
+    compiled = {
+        'rules_path': rules_path,
+        'sources': source_versions([rules_path, *dict.fromkeys(rule['lookup']['path'] for rule in rules['rules'])]),
+        'default_popularity': rules['default_popularity'],
+        'rules': [compile_rule(rule) for rule in rules['rules']],
+    }
+    print(f'Compiled {len(compiled["rules"])} popularity rules from {rules_path}')
+    compiled_rules_by_path[rules_path] = compiled
+    if cache_path is not None:
+        os.makedirs(os.path.dirname(cache_path) or '.', exist_ok=True)
+        with open(cache_path, 'wb') as cache_file:
+            pickle.dump(compiled, cache_file, protocol=pickle.HIGHEST_PROTOCOL)
+    return compiled
+
+
+def apply_rules(shows, compiled, aggregate=None):
+    """
+    Score the popularity of shows with compiled rules, in one vectorized pass.
+
+    Each field read by the rules is split once, then each rule gives a mask of the shows it matches, and
+    the first matching rule of each show gives its popularity.
+
+    Parameters:
+    - shows (pd.DataFrame): The shows, with the fields read by the rules as comma-separated strings.
+    - compiled (dict): The compiled rules from `compile_rules`.
+    - aggregate (str): Aggregate of the value_below rules replacing the one of the rule file, e.g. 'mean'.
+
+    Returns:
+    - pd.Series: The popularity of each show, aligned with `shows`.
+    """
+    shows = shows.reset_index(drop=True)
+    split_fields = {field: split_field(shows[field]) for field in dict.fromkeys(
+        rule['field'] for rule in compiled['rules'])}
+
+    masks = []
+    for rule in compiled['rules']:
+        values = split_fields[rule['field']]
+        if rule['type'] == 'in_list':
+            matched = values.index[values.isin(rule['keys'])]
+        elif (aggregate or rule['aggregate']) == 'single':
+            counts = values.index.value_counts()
+            matched = values.index[values.isin(rule['keys'])]
+            matched = matched[counts.reindex(matched).to_numpy() == 1]
+        else:
+            means = values.map(rule['values']).groupby(level=0).mean()
+            matched = means.index[means < rule['threshold']]
+        masks.append(shows.index.isin(matched))
+
+    popularity = np.select(masks, [rule['popularity'] for rule in compiled['rules']],
+                           default=compiled['default_popularity'])
+    return pd.Series(popularity, index=shows.index)
@@ -0,0 +1,277 @@
+import argparse
+import inspect
+import json
+import os
+import queue
+import sqlite3
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+from program.table_publishing import published_version
+
+RECOMMENDATION_TABLE = 'SHOWS_FOR_KIDS_RECOMMENDATION'
+MAX_PAGE_SIZE = 100
+# Query parameters of `query_recommendations` and how they are parsed from a URL
+QUERY_PARAMETERS = {'country': str, 'genre': str, 'min_popularity': int, 'min_sentiment': float, 'after': str,
+                    'limit': int}
+
+
+def format_after(popularity, show_id):
+    return f'{popularity}:{show_id}'
+
+
+def parse_after(after):
+    popularity, separator, show_id = after.partition(':')
+    if not separator or not popularity.lstrip('-').isdigit():
+        raise ValueError(f"Invalid page key '{after}', expected the next_after of the previous page")
+    return int(popularity), show_id
+
+
+def query_recommendations(connection, country=None, genre=None, min_popularity=None, min_sentiment=None,
+                          after=None, limit=20):
+    """
+    Read one page of kids recommendations, the most popular first.
+
+    Pages use keyset pagination: `after` is the `next_after` of the previous page, i.e. the popularity and
+    show_id of its last show, so each page is a range of the (popularity, show_id) index however deep it is.
+    Country and genre filters are index searches of SHOW_COUNTRY and SHOW_GENRE.
+
+    Parameters:
+    - connection (sqlite3.Connection): Open connection to the pipeline database.
+    - country (str): Only shows from this country, one of their countries for shows from several.
+    - genre (str): Only shows listed in this genre, e.g. "Kids' TV".
+    - min_popularity (int): Only shows with at least this popularity.
+    - min_sentiment (float): Only shows whose description has at least this sentiment score.
+    - after (str): Key of the page to read, None for the first page.
+    - limit (int): Number of shows per page, at most MAX_PAGE_SIZE.
+
+    Returns:
+    - dict: 'shows', a list of dicts with show_id, title, popularity and sentiment_score, and 'next_after',
+      the key of the next page or None on the last page.
+    """
+    if not 1 <= limit <= MAX_PAGE_SIZE:
+        raise ValueError(f'limit must be between 1 and {MAX_PAGE_SIZE}, got {limit}')
+
+    conditions, params = [], []
+    if country is not None:
+        conditions.append('r.show_id IN (SELECT show_id FROM SHOW_COUNTRY WHERE country = ?)')
+        params.append(country)
+    if genre is not None:
+        conditions.append('r.show_id IN (SELECT show_id FROM SHOW_GENRE WHERE genre = ?)')
+        params.append(genre)
+    if min_popularity is not None:
+        conditions.append('r.popularity >= ?')
+        params.append(min_popularity)
+    if min_sentiment is not None:
+        conditions.append('r.sentiment_score >= ?')
+        params.append(min_sentiment)
+    if after is not None:
+        popularity, show_id = parse_after(after)
+        conditions.append('(r.popularity < ? OR (r.popularity = ? AND r.show_id > ?))')
+        params += [popularity, popularity, show_id]
+
+    # One more row than asked tells if there is a next page
+    rows = connection.execute(f'''
+    SELECT r.show_id, r.title, r.popularity, r.sentiment_score
+    FROM {RECOMMENDATION_TABLE} AS r
+    {'WHERE ' + ' AND '.join(conditions) if conditions else ''}
+    ORDER BY r.popularity DESC, r.show_id
+    LIMIT ?
+    ''', (*params, limit + 1)).fetchall()
+
+    shows = [{'show_id': show_id, 'title': title, 'popularity': popularity, 'sentiment_score': sentiment_score}
+             for show_id, title, popularity, sentiment_score in rows[:limit]]
+    next_after = format_after(shows[-1]['popularity'], shows[-1]['show_id']) if len(rows) > limit else None
+    return {'shows': shows, 'next_after': next_after}
+
+
+def query_key(query):
+    # Queries which only differ by defaults given explicitly, e.g. limit=20, read the same page
+    arguments = inspect.signature(query_recommendations).bind(None, **query)
+    arguments.apply_defaults()
+    return tuple((name, value) for name, value in arguments.arguments.items() if name != 'connection')
+
+
+class RecommendationService:
+    """
+    Serve `query_recommendations` to concurrent readers, with an LRU cache of the pages read.
+
+    Readers borrow one of a pool of at most `max_connections` read-only connections, so they do not wait on
+    each other nor on a running pipeline (the database is in WAL mode), and the number of open connections
+    does not grow with the threads of the server. Cached pages belong to the version of
+    SHOWS_FOR_KIDS_RECOMMENDATION in TABLE_VERSIONS they were read from; the version is checked in the
+    same read transaction as the query, and the cache is emptied when a new version was published or
+    rolled back to (see `swap_table_version`).
+
+    Parameters:
+    - database_path (str): Path of the pipeline database.
+    - cache_size (int): Number of pages kept, 0 disables the cache.
+    - max_connections (int): Number of connections open at most, further readers wait for one.
+    """
+
+    def __init__(self, database_path, cache_size=1024, max_connections=8):
+        self.database_path = database_path
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.cache_version = None
+        self.lock = threading.Lock()
+        self.connection_slots = threading.BoundedSemaphore(max_connections)
+        self.idle_connections = queue.LifoQueue()
+        self.hits = 0
+        self.misses = 0
+
+    @contextmanager
+    def connection(self):
+        # Borrow a connection of the pool, opened on first use and returned to the pool afterwards
+        with self.connection_slots:
+            try:
+                connection = self.idle_connections.get_nowait()
+            except queue.Empty:
+                # Autocommit, so the read transactions below are explicit; used by one thread at a time
+                connection = sqlite3.connect(f'file:{self.database_path}?mode=ro', uri=True, isolation_level=None,
+                                             check_same_thread=False)
+            try:
+                yield connection
+            finally:
+                self.idle_connections.put(connection)
+
+    def close(self):
+        # Close the connections of the pool, once no reader uses them
+        while True:
+            try:
+                self.idle_connections.get_nowait().close()
+            except queue.Empty:
+                break
+
+    def cached_page(self, version, key):
+        with self.lock:
+            if version != self.cache_version:
+                self.cache.clear()
+                self.cache_version = version
+            page = self.cache.get(key)
+            if page is None:
+                self.misses += 1
+                return None
+            self.cache.move_to_end(key)
+            self.hits += 1
+            return page
+
+    def cache_page(self, version, key, page):
+        with self.lock:
+            # A newer version may have been published while the page was read
+            if self.cache_size and version == self.cache_version:
+                self.cache[key] = page
+                if len(self.cache) > self.cache_size:
+                    self.cache.popitem(last=False)
+
+    def recommendations(self, **query):
+        """
+        Read a page of recommendations, see `query_recommendations` for the parameters.
+
+        The returned page may be shared with other callers and must not be modified.
+        """
+        key = query_key(query)
+        with self.connection() as connection:
+            connection.execute('BEGIN')
+            try:
+                version = published_version(connection, RECOMMENDATION_TABLE)
+                page = self.cached_page(version, key)
+                if page is None:
+                    page = query_recommendations(connection, **query)
+                    self.cache_page(version, key, page)
+            finally:
+                connection.execute('COMMIT')
+        return page
+
+    def stats(self):
+        with self.lock:
+            return {'version': self.cache_version, 'cached_pages': len(self.cache), 'hits': self.hits,
+                    'misses': self.misses}
+
+
+def parse_query(query_string):
+    # URL query string -> keyword arguments of `query_recommendations`
+    query = {}
+    for name, values in parse_qs(query_string).items():
+        if name not in QUERY_PARAMETERS:
+            raise ValueError(f"Unknown parameter '{name}', expected one of {list(QUERY_PARAMETERS)}")
+        try:
+            query[name] = QUERY_PARAMETERS[name](values[-1])
+        except ValueError:
+            raise ValueError(f"Invalid value '{values[-1]}' of parameter '{name}'") from None
+    return query
+
+
+def create_server(service, host='127.0.0.1', port=8000):
+    """
+    Create an HTTP server answering GET /recommendations?country=...&genre=...&after=... with the JSON
+    page of `RecommendationService.recommendations`, and GET /stats with the cache statistics.
+
+    Parameters:
+    - service (RecommendationService): The service queried by the requests.
+    - host (str): Address to listen on, local only by default.
+    - port (int): Port to listen on.
+
+    Returns:
+    - ThreadingHTTPServer: The server, run it with `serve_forever()`.
+    """
+
+    class RecommendationHandler(BaseHTTPRequestHandler):
+        def send_json(self, status, body):
+            payload = json.dumps(body).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            if url.path == '/stats':
+                self.send_json(200, service.stats())
+            elif url.path == '/recommendations':
+                try:
+                    self.send_json(200, service.recommendations(**parse_query(url.query)))
+                except ValueError as error:
+                    self.send_json(400, {'error': str(error)})
+                except sqlite3.Error as error:
+                    self.send_json(500, {'error': str(error)})
+            else:
+                self.send_json(404, {'error': f'Unknown path {url.path}, expected /recommendations or /stats'})
+
+        def log_message(self, format, *args):
+            # Requests are not logged, the load script measures them
+            pass
+
+    return ThreadingHTTPServer((host, port), RecommendationHandler)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve the kids recommendations over HTTP.')
+    parser.add_argument('--database', default='program/database/netflix_database.db',
+                        help='database written by main.py')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--cache-size', type=int, default=1024, help='number of pages cached, 0 to disable')
+    parser.add_argument('--max-connections', type=int, default=8,
+                        help='number of database connections shared by the request threads')
+    args = parser.parse_args()
+    if not os.path.isfile(args.database):
+        parser.error(f'{args.database} does not exist, run main.py first')
+
+    service = RecommendationService(args.database, cache_size=args.cache_size, max_connections=args.max_connections)
+    server = create_server(service, args.host, args.port)
+    print(f'Serving http://{args.host}:{server.server_port}/recommendations from {args.database}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+import hashlib
+import os
+from concurrent.futures import ProcessPoolExecutor
+from program.helper_functions import lazy_import
+
+# nltk and its VADER lexicon are only loaded once descriptions are scored
+sentiment = lazy_import('nltk.sentiment')
+
+# Analyzer of the current worker process, created once by `init_worker`
+worker_analyzer = None
+
+
+def init_worker():
+    global worker_analyzer
+    worker_analyzer = sentiment.SentimentIntensityAnalyzer()
+
+
+def score_chunk(descriptions):
+    return [worker_analyzer.polarity_scores(description)['compound'] for description in descriptions]
+
+
+def score_descriptions_serial(descriptions):
+    """
+    Score descriptions one at a time with a single analyzer (baseline).
+
+    Parameters:
+    - descriptions (list): The descriptions to score.
+
+    Returns:
+    - list: The VADER compound score of every description.
+    """
+    sia = sentiment.SentimentIntensityAnalyzer()
+    return [sia.polarity_scores(description)['compound'] for description in descriptions]
+
+
+def score_descriptions_parallel(descriptions, max_workers=None, chunk_size=1000):
+    """
+    Split the descriptions into chunks and score them in a process pool, with one analyzer per worker.
+
+    Parameters:
+    - descriptions (list): The descriptions to score.
+    - max_workers (int): Number of worker processes, defaults to the number of CPUs; 1 scores in the current
+      process, e.g. one which is itself a worker.
+    - chunk_size (int): Number of descriptions sent to a worker at a time. Inputs of a single chunk
+      are scored in the current process to avoid the pool start-up cost.
+
+    Returns:
+    - list: The VADER compound score of every description, in input order.
+    """
+    if len(descriptions) <= chunk_size or max_workers == 1:
+        return score_descriptions_serial(descriptions)
+
+    chunks = [descriptions[start:start + chunk_size] for start in range(0, len(descriptions), chunk_size)]
+    max_workers = min(max_workers or os.cpu_count() or 1, len(chunks))
+    with ProcessPoolExecutor(max_workers=max_workers, initializer=init_worker) as executor:
+        return [score for chunk_scores in executor.map(score_chunk, chunks) for score in chunk_scores]
+
+
+def hash_description(description):
+    return hashlib.sha1(description.encode('utf-8')).hexdigest()
+
+
+def create_sentiment_cache(connection):
+    # Scores by the hash of their description, see `score_descriptions`
+    connection.execute("""
+    CREATE TABLE IF NOT EXISTS SENTIMENT_CACHE (
+        description_hash CHAR(40) PRIMARY KEY,
+        compound FLOAT
+    );
+    """)
+
+
+def score_descriptions(descriptions, connection, max_workers=None):
+    """
+    Score descriptions, reusing the scores cached in the SENTIMENT_CACHE table.
+
+    Scores are cached by a hash of the description, so unchanged shows are never scored twice.
+    Only the descriptions missing from the cache are scored, in a process pool, then added to it.
+
+    Parameters:
+    - descriptions (list): The descriptions to score.
+    - connection (sqlite3.Connection): Connection to the database holding the cache.
+    - max_workers (int): Number of worker processes.
+
+    Returns:
+    - list: The VADER compound score of every description, in input order.
+    """
+    create_sentiment_cache(connection)
+    connection.execute('CREATE TEMP TABLE IF NOT EXISTS REQUESTED_HASHES (description_hash CHAR(40) PRIMARY KEY)')
+    connection.execute('DELETE FROM temp.REQUESTED_HASHES')
+
+    hashes = [hash_description(description) for description in descriptions]
+    connection.executemany('INSERT OR IGNORE INTO temp.REQUESTED_HASHES VALUES (?)', [(h,) for h in hashes])
+    cached_scores = dict(connection.execute("""
+    SELECT c.description_hash, c.compound
+    FROM SENTIMENT_CACHE AS c
+    JOIN temp.REQUESTED_HASHES AS r
+    ON c.description_hash = r.description_hash
+    """).fetchall())
+
+    missing = {}
+    for description_hash, description in zip(hashes, descriptions):
+        if description_hash not in cached_scores:
+            missing[description_hash] = description
+
+    if missing:
+        new_scores = score_descriptions_parallel(list(missing.values()), max_workers=max_workers)
+        cached_scores.update(zip(missing.keys(), new_scores))
+        connection.executemany('INSERT OR REPLACE INTO SENTIMENT_CACHE VALUES (?, ?)',
+                               [(description_hash, cached_scores[description_hash]) for description_hash in missing])
+    connection.execute('DELETE FROM temp.REQUESTED_HASHES')
+
+    print(f'Sentiment scores: {len(set(hashes)) - len(missing)} distinct descriptions from cache, '
+          f'{len(missing)} newly scored.')
+    return [cached_scores[description_hash] for description_hash in hashes]
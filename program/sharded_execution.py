@@ -0,0 +1,271 @@
+import heapq
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from program.interaction_with_SQL import KIDS_EXCLUDED_RATINGS, KIDS_EXCLUDED_QUERIES, clean_netflix_data
+from program.table_publishing import KEPT_VERSIONS, new_table_version, swap_table_version
+from program.sentiment_scoring import create_sentiment_cache
+from program.popularity_rules import POPULARITY_RULES_PATH, compile_rules
+from program.typed_loading import TYPED_CHUNK_SIZE, iterate_typed_sql, write_typed_batches
+from program.sql_session import open_connection
+from program.data_transformation import RECOMMENDATION_TABLE_COLUMNS, RECOMMENDATION_EXPORT_COLUMNS, \
+    kids_friendly_query, score_recommendations, export_recommendations_in_batches, publish_recommendations
+
+# Table of a shard's staging database holding its rows of each output table; the names differ from the
+# output tables, which the unqualified statements of the worker would otherwise find in the catalog
+SHARD_TABLES = {
+    'NETFLIX_COMBINED_CLEANED': 'SHARD_CLEANED',
+    'SHOWS_FOR_KIDS_RECOMMENDATION': 'SHARD_RECOMMENDATIONS',
+}
+# A staging database is rebuilt from scratch by every run, it needs neither a journal nor syncs
+STAGING_PRAGMAS = {'journal_mode': 'OFF', 'synchronous': 'OFF'}
+# Rows inserted at a time when the shards are merged
+MERGE_CHUNK_SIZE = 10000
+
+
+def shard_ranges(connection, shards):
+    """
+    Split the shows into `shards` ranges of show_id holding about the same number of shows.
+
+    The bounds are read from the primary key index of NETFLIX_SHOWS, and each worker reads its range of
+    the view through that index, so no worker scans the shows of the others.
+
+    Parameters:
+    - connection (sqlite3.Connection): Open connection to the SQLite database.
+    - shards (int): Number of shards.
+
+    Returns:
+    - list: A (first, end) pair of show_id per shard, the range first <= show_id < end; None leaves the range
+      open on that side.
+    """
+    (shows,) = connection.execute('SELECT count(*) FROM NETFLIX_SHOWS').fetchone()
+    bounds = [connection.execute('SELECT show_id FROM NETFLIX_SHOWS ORDER BY show_id LIMIT 1 OFFSET ?',
+                                 (shows * shard // shards,)).fetchone() for shard in range(1, shards)]
+    bounds = [None, *(bound[0] if bound else None for bound in bounds), None]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def shard_condition(show_id_range):
+    # WHERE clause and parameters selecting a range of `shard_ranges`
+    first, end = show_id_range
+    conditions, params = [], []
+    if first is not None:
+        conditions.append('show_id >= ?')
+        params.append(first)
+    if end is not None:
+        conditions.append('show_id < ?')
+        params.append(end)
+    return (' WHERE ' + ' AND '.join(conditions) if conditions else ''), tuple(params)
+
+
+def shard_staging_path(database_path, shard):
+    # Next to the database, e.g. program/database/netflix_database.shard0.db
+    root, extension = os.path.splitext(database_path)
+    return f'{root}.shard{shard}{extension}'
+
+
+def remove_staging_database(staging_path):
+    for path in (staging_path, f'{staging_path}-wal', f'{staging_path}-shm'):
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def open_shard_connection(staging_path, database_path):
+    # The staging database is the main one, the catalog is attached and only read
+    connection = open_connection(staging_path, pragmas=STAGING_PRAGMAS)
+    connection.execute('ATTACH DATABASE ? AS catalog', (database_path,))
+    return connection
+
+
+def recommend_shard(shard, show_id_range, database_path, view, batch_size=TYPED_CHUNK_SIZE, sentiment_mode='cached',
+                    gdp_scoring=None, rules_path=POPULARITY_RULES_PATH, excluded_ratings=KIDS_EXCLUDED_RATINGS,
+                    excluded_queries=KIDS_EXCLUDED_QUERIES):
+    """
+    Clean, filter and score the shows of one shard, in a worker process.
+
+    The shows of the shard are read from `view` `batch_size` rows at a time and go through the steps of the
+    'batch' execution mode: `clean_netflix_data`, the kids-friendly query and `score_recommendations`. The
+    rows are written to the staging database of the shard (see `shard_staging_path`), with the catalog
+    attached and only read, so the workers never wait for each other's writes. The descriptions are scored
+    in the worker itself, through a copy of SENTIMENT_CACHE whose new scores are merged back by
+    `clean_and_recommend_in_shards`.
+
+    Parameters:
+    - shard (int): The shard, from 0 to the number of shards - 1.
+    - show_id_range (tuple): The range of show_id of the shard, see `shard_ranges`.
+    - database_path (str): Path to the SQLite database of the catalog.
+    - view (str): Name of the view with Netflix shows and their ratings.
+    - batch_size (int): Number of shows read, cleaned and scored at a time.
+    - sentiment_mode (str): 'cached' or 'serial', see `create_shows_for_kids_recommendation_table`.
+    - gdp_scoring (str): How the GDP of a show is taken from its countries, see `score_popularity`.
+    - rules_path (str): Path of the JSON rule file scoring the popularity, see `score_popularity`.
+    - excluded_ratings (tuple): Ratings which are not suitable for kids.
+    - excluded_queries (tuple): FTS5 queries over SHOWS_FTS, by default about war or violence.
+
+    Returns:
+    - tuple: The number of cleaned shows and of recommended shows of the shard.
+    """
+    staging_path = shard_staging_path(database_path, shard)
+    remove_staging_database(staging_path)
+    connection = open_shard_connection(staging_path, database_path)
+    try:
+        if sentiment_mode == 'cached':
+            create_sentiment_cache(connection)
+            if connection.execute("SELECT 1 FROM catalog.sqlite_schema WHERE name = 'SENTIMENT_CACHE'").fetchone():
+                connection.execute('INSERT INTO main.SENTIMENT_CACHE SELECT * FROM catalog.SENTIMENT_CACHE')
+
+        condition, params = shard_condition(show_id_range)
+        shard_rows = iterate_typed_sql(f'SELECT * FROM {view}{condition}', connection, params=params,
+                                       chunk_size=batch_size)
+        cleaned_batches = write_typed_batches((clean_netflix_data(batch) for batch in shard_rows),
+                                              SHARD_TABLES['NETFLIX_COMBINED_CLEANED'], connection)
+        cleaned_shows = sum(len(batch) for batch in cleaned_batches)
+
+        query, query_params = kids_friendly_query(excluded_ratings=excluded_ratings, excluded_queries=excluded_queries,
+                                                  table=SHARD_TABLES['NETFLIX_COMBINED_CLEANED'])
+        kids_friendly_batches = iterate_typed_sql(query, connection, params=query_params, chunk_size=batch_size)
+        recommendation_batches = (score_recommendations(batch, connection, sentiment_mode=sentiment_mode,
+                                                        gdp_scoring=gdp_scoring, rules_path=rules_path,
+                                                        sentiment_workers=1)
+                                  for batch in kids_friendly_batches)
+        recommended_batches = write_typed_batches(recommendation_batches,
+                                                  SHARD_TABLES['SHOWS_FOR_KIDS_RECOMMENDATION'], connection,
+                                                  columns=RECOMMENDATION_TABLE_COLUMNS)
+        recommended_shows = sum(len(batch) for batch in recommended_batches)
+        connection.commit()
+    finally:
+        connection.close()
+    return cleaned_shows, recommended_shows
+
+
+def merge_shards(connection, database_path, staging_paths, table):
+    """
+    Merge the rows of an output table from the staging database of every shard into a new version of it.
+
+    The shards are merged in the order of NETFLIX_SHOWS, the order of the view they were read from, so the
+    new version holds the same rows in the same order as when the shows are not sharded. Each shard is read
+    in that order and the shards are merged as they are read, so no shard is held in memory.
+
+    Parameters:
+    - connection (sqlite3.Connection): Open connection to the SQLite database.
+    - database_path (str): Path to the SQLite database, attached by the connections to the shards.
+    - staging_paths (list): Paths of the staging databases of the shards.
+    - table (str): Name of the output table, one of `SHARD_TABLES`.
+
+    Returns:
+    - tuple: The name of the new version of the table and its version, to be published.
+    """
+    shard_table = SHARD_TABLES[table]
+    shard_connections = [open_shard_connection(staging_path, database_path) for staging_path in staging_paths]
+    try:
+        # The new version is created like the shard tables, which `to_sql` typed from the rows of the shard;
+        # a shard without rows has no typed columns, so the first shard with rows is used
+        row_counts = [shard_connection.execute(f'SELECT count(*) FROM {shard_table}').fetchone()[0]
+                      for shard_connection in shard_connections]
+        typed_shard = next((index for index, rows in enumerate(row_counts) if rows), 0)
+        (create_statement,) = shard_connections[typed_shard].execute(
+            'SELECT sql FROM main.sqlite_schema WHERE name = ?', (shard_table,)).fetchone()
+        shadow_table, version = new_table_version(connection, table)
+        connection.execute(create_statement.replace(f'"{shard_table}"', f'"{shadow_table}"', 1))
+
+        shard_rows = [shard_connection.execute(f'''
+        SELECT ns.rowid, t.*
+        FROM {shard_table} AS t
+        JOIN catalog.NETFLIX_SHOWS AS ns
+        ON ns.show_id = t.show_id
+        ORDER BY ns.rowid
+        ''') for shard_connection in shard_connections]
+        merged_rows = (row[1:] for row in heapq.merge(*shard_rows, key=lambda row: row[0]))
+        placeholders = ', '.join('?' * (len(shard_rows[0].description) - 1))
+        while chunk := [row for _, row in zip(range(MERGE_CHUNK_SIZE), merged_rows)]:
+            connection.executemany(f'INSERT INTO "{shadow_table}" VALUES ({placeholders})', chunk)
+    finally:
+        for shard_connection in shard_connections:
+            shard_connection.close()
+    print(f'Merged {sum(row_counts)} rows of {table} from {len(staging_paths)} shards')
+    return shadow_table, version
+
+
+def merge_sentiment_caches(connection, staging_paths):
+    # Add the scores of the descriptions newly scored by the shards to SENTIMENT_CACHE
+    create_sentiment_cache(connection)
+    for staging_path in staging_paths:
+        shard_connection = open_connection(staging_path, pragmas=STAGING_PRAGMAS)
+        try:
+            connection.executemany('INSERT OR IGNORE INTO SENTIMENT_CACHE VALUES (?, ?)',
+                                   shard_connection.execute('SELECT * FROM SENTIMENT_CACHE'))
+        finally:
+            shard_connection.close()
+
+
+def clean_and_recommend_in_shards(connection, database_path, view, shards=None, batch_size=TYPED_CHUNK_SIZE,
+                                  sentiment_mode='cached', export_format='csv', gdp_scoring=None,
+                                  keep_versions=KEPT_VERSIONS, rules_path=POPULARITY_RULES_PATH,
+                                  excluded_ratings=KIDS_EXCLUDED_RATINGS, excluded_queries=KIDS_EXCLUDED_QUERIES):
+    """
+    Clean, filter and score the shows in worker processes, one per shard of the catalog.
+
+    This is the multi-process counterpart of `clean_and_create_table` followed by
+    `create_shows_for_kids_recommendation_table_in_batches`. The shows are split into `shards` ranges of
+    show_id (see `shard_ranges`), and each shard is cleaned, filtered and scored by `recommend_shard` in its
+    own process, with its own connection and staging database. The shards are then merged in the order of
+    NETFLIX_SHOWS into new versions of NETFLIX_COMBINED_CLEANED and SHOWS_FOR_KIDS_RECOMMENDATION, which are
+    published, and the recommendations exported, the same as without shards.
+
+    Parameters:
+    - connection (sqlite3.Connection): Open connection to the SQLite database, on the file `database_path`.
+    - database_path (str): Path to the SQLite database, opened by the worker processes.
+    - view (str): Name of the view with Netflix shows and their ratings.
+    - shards (int): Number of shards and of worker processes, defaults to the number of CPUs.
+    - batch_size (int): Number of shows read, cleaned and scored at a time by each worker.
+    - sentiment_mode (str): 'cached' or 'serial', see `create_shows_for_kids_recommendation_table`.
+    - export_format (str): 'csv' or 'parquet', format of the exported file.
+    - gdp_scoring (str): How the GDP of a show is taken from its countries, see `score_popularity`.
+    - keep_versions (int): Number of previous versions of the tables kept for rollbacks.
+    - rules_path (str): Path of the JSON rule file scoring the popularity, see `score_popularity`.
+    - excluded_ratings (tuple): Ratings which are not suitable for kids.
+    - excluded_queries (tuple): FTS5 queries over SHOWS_FTS, by default about war or violence.
+
+    Returns:
+    - int: The number of recommended shows.
+    """
+    shards = shards or os.cpu_count() or 1
+    staging_paths = [shard_staging_path(database_path, shard) for shard in range(shards)]
+    # Compiled once here, so the workers load the pickled rules rather than all compiling and writing them
+    compile_rules(rules_path)
+    # The workers read the catalog through their own connections, which only see committed rows; within a
+    # pipeline stage the commit is deferred (see `stage_transaction`), the stages before this one committed theirs
+    connection.commit()
+    show_id_ranges = shard_ranges(connection, shards)
+
+    print(f'Cleaning and scoring the shows in {shards} shards...')
+    try:
+        # Spawned rather than forked, so the workers do not inherit the SQLite state of this process
+        with ProcessPoolExecutor(max_workers=shards, mp_context=multiprocessing.get_context('spawn')) as executor:
+            futures = [executor.submit(recommend_shard, shard, show_id_ranges[shard], database_path, view,
+                                       batch_size=batch_size, sentiment_mode=sentiment_mode, gdp_scoring=gdp_scoring,
+                                       rules_path=rules_path, excluded_ratings=excluded_ratings,
+                                       excluded_queries=excluded_queries)
+                       for shard in range(shards)]
+            shard_counts = [future.result() for future in futures]
+        for shard, (cleaned_shows, recommended_shows) in enumerate(shard_counts):
+            print(f'Shard {shard}: {cleaned_shows} cleaned shows, {recommended_shows} recommended')
+
+        shadow_table, version = merge_shards(connection, database_path, staging_paths, 'NETFLIX_COMBINED_CLEANED')
+        swap_table_version(connection, 'NETFLIX_COMBINED_CLEANED', version, keep_versions=keep_versions)
+        if sentiment_mode == 'cached':
+            merge_sentiment_caches(connection, staging_paths)
+
+        shadow_table, version = merge_shards(connection, database_path, staging_paths,
+                                             'SHOWS_FOR_KIDS_RECOMMENDATION')
+        print(f'Saving the recommendations batch by batch as a {export_format} file shows_for_kids_recommendation...')
+        recommendations = iterate_typed_sql(f'SELECT {", ".join(RECOMMENDATION_EXPORT_COLUMNS)} FROM {shadow_table} '
+                                            f'ORDER BY rowid', connection, chunk_size=batch_size)
+        recommended_shows = export_recommendations_in_batches(recommendations, export_format)
+        publish_recommendations(connection, shadow_table, version, keep_versions=keep_versions)
+    finally:
+        for staging_path in staging_paths:
+            remove_staging_database(staging_path)
+
+    print(f'Recommended {recommended_shows} shows from {shards} shards')
+    return recommended_shows
@@ -0,0 +1,131 @@
+import os
+import sqlite3
+from contextlib import contextmanager
+
+# Pragmas applied to every pipeline connection, tuned for bulk loads
+DEFAULT_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'cache_size': -64000,  # negative values are KiB, i.e. a 64 MB page cache
+    'temp_store': 'MEMORY',
+    'mmap_size': 268435456,  # 256 MB
+}
+
+
+class PipelineConnection(sqlite3.Connection):
+    """
+    Connection whose commits are deferred to the end of the stage running on it, see `stage_transaction`.
+
+    pandas `to_sql` commits after every write, and helpers such as `swap_table_version` commit so they can be
+    called on their own; within a stage their commits leave the stage transaction open, so a stage which
+    fails after them is still rolled back as a whole.
+    """
+    in_stage = False
+
+    def commit(self):
+        if not self.in_stage:
+            super().commit()
+
+
+def apply_pragmas(connection, pragmas):
+    for name, value in pragmas.items():
+        connection.execute(f'PRAGMA {name} = {value}')
+
+
+def open_connection(database_path, pragmas=None, in_memory=False):
+    """
+    Open the connection shared by all pipeline steps.
+
+    Parameters:
+    - database_path (str): Path to the SQLite database.
+    - pragmas (dict): Pragmas overriding `DEFAULT_PRAGMAS`.
+    - in_memory (bool): Work on an in-memory copy of the database; call `close_connection` to
+      snapshot it back to `database_path`.
+
+    Returns:
+    - sqlite3.Connection: The open connection.
+    """
+    pragmas = {**DEFAULT_PRAGMAS, **(pragmas or {})}
+
+    if in_memory:
+        connection = sqlite3.connect(':memory:', factory=PipelineConnection)
+        # Start from the existing database, so incremental state and caches are kept
+        if os.path.exists(database_path):
+            source = sqlite3.connect(database_path)
+            source.backup(connection)
+            source.close()
+        # An in-memory database has no journal file to configure
+        pragmas.pop('journal_mode', None)
+        pragmas.pop('mmap_size', None)
+    else:
+        connection = sqlite3.connect(database_path, factory=PipelineConnection)
+
+    apply_pragmas(connection, pragmas)
+    return connection
+
+
+@contextmanager
+def stage_transaction(connection):
+    """
+    Run a pipeline stage inside an explicit transaction.
+
+    The transaction is committed when the stage succeeds and rolled back when it raises. On a connection of
+    `open_connection` it is the only commit of the stage: the commits made while it is open, e.g. by pandas
+    `to_sql`, are deferred to its end (see `PipelineConnection`). A transaction opened within another one is
+    part of it.
+
+    Parameters:
+    - connection (sqlite3.Connection): The shared pipeline connection.
+    """
+    if getattr(connection, 'in_stage', False):
+        yield connection
+        return
+    if not connection.in_transaction:
+        connection.execute('BEGIN')
+    deferring_commits = isinstance(connection, PipelineConnection)
+    if deferring_commits:
+        connection.in_stage = True
+    try:
+        yield connection
+    except Exception:
+        connection.rollback()
+        raise
+    else:
+        if deferring_commits:
+            connection.in_stage = False
+        connection.commit()
+    finally:
+        if deferring_commits:
+            connection.in_stage = False
+
+
+def snapshot_to_disk(connection, database_path):
+    """
+    Copy a database to disk with the SQLite backup API.
+
+    Parameters:
+    - connection (sqlite3.Connection): Connection to the database to copy, e.g. an in-memory one.
+    - database_path (str): Path of the database file to write.
+    """
+    destination = sqlite3.connect(database_path)
+    connection.backup(destination)
+    destination.close()
+    print(f'Snapshot of the in-memory database saved to {database_path}')
+
+
+def close_connection(connection, database_path, in_memory=False, snapshot=True):
+    """
+    Close the shared connection, first snapshotting it to `database_path` in in-memory mode.
+
+    Parameters:
+    - connection (sqlite3.Connection): The shared pipeline connection.
+    - database_path (str): Path of the database file.
+    - in_memory (bool): The connection is an in-memory copy of the database, see `open_connection`.
+    - snapshot (bool): Copy the in-memory database to `database_path`; False after a failed run, so the file
+      keeps the database of the last successful one.
+    """
+    if in_memory and snapshot:
+        snapshot_to_disk(connection, database_path)
+    elif in_memory:
+        print(f'The run failed, {database_path} keeps the database of the last successful run')
+    connection.close()
@@ -0,0 +1,262 @@
+import hashlib
+import json
+import os
+import pickle
+import time
+from pathlib import Path
+from program.helper_functions import table_exists
+from program.interaction_with_csv import hash_file
+
+PROGRAM_DIR = Path(__file__).resolve().parent
+
+
+def code_version(source_paths=None):
+    """
+    Hash the source of the pipeline, so that any code change invalidates the cached stages.
+
+    Parameters:
+    - source_paths (list): Source files to hash, by default the program package and main.py.
+
+    Returns:
+    - str: Hex digest of the sources.
+    """
+    if source_paths is None:
+        source_paths = [*sorted(PROGRAM_DIR.glob('*.py')), PROGRAM_DIR.parent / 'main.py']
+    digest = hashlib.sha256()
+    for source_path in source_paths:
+        if os.path.exists(source_path):
+            with open(source_path, 'rb') as source_file:
+                digest.update(source_file.read())
+    return digest.hexdigest()
+
+
+def table_checksum(connection, table):
+    # Hash of the columns and every row of a table or view, in the order SQLite returns them
+    digest = hashlib.sha256()
+    cursor = connection.execute(f'SELECT * FROM {table}')
+    digest.update(repr([column[0] for column in cursor.description]).encode('utf-8'))
+    for row in cursor:
+        digest.update(repr(row).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def forget_cached_outputs(connection, outputs):
+    """
+    Delete the cache entries which recorded one of these tables or files as an output.
+
+    Called when a stage run outside the cache (incremental runs, stages which are not cacheable, rollbacks)
+    writes them, so that no entry refers to content it did not produce. The caller commits.
+
+    Parameters:
+    - connection (sqlite3.Connection): The connection holding STAGE_CACHE.
+    - outputs (list): Names of the tables and paths of the files written.
+    """
+    if not table_exists(connection, 'STAGE_CACHE'):
+        return
+    outputs = set(outputs)
+    for fingerprint, recorded, artifact_path in connection.execute(
+            'SELECT fingerprint, outputs, artifact_path FROM STAGE_CACHE').fetchall():
+        recorded = json.loads(recorded)
+        if outputs & (set(recorded['tables']) | set(recorded['files'])):
+            if artifact_path and os.path.exists(artifact_path):
+                os.remove(artifact_path)
+            connection.execute('DELETE FROM STAGE_CACHE WHERE fingerprint = ?', (fingerprint,))
+
+
+class StageCache:
+    """
+    Memoize pipeline stages by a fingerprint of everything they read.
+
+    The fingerprint of a stage hashes its name, the code version, its parameters and the fingerprints of
+    its inputs: the hash of input files, and for tables or in-memory values the fingerprint of the stage
+    which wrote them. A stage whose fingerprint is in the STAGE_CACHE table is skipped, provided its
+    output tables still have the recorded content checksum, its output files the recorded size and
+    modification time, and its in-memory outputs are found pickled in `cache_dir`.
+
+    Parameters:
+    - connection (sqlite3.Connection): The shared pipeline connection, holding STAGE_CACHE.
+    - cache_dir (str): Directory of the pickled in-memory outputs.
+    - max_entries (int): Number of cache entries kept, the least recently used are evicted first.
+    - max_bytes (int): Total size of the pickled outputs kept.
+    - force (bool): Run every stage, the cache is only written.
+    """
+
+    def __init__(self, connection, cache_dir, max_entries=200, max_bytes=512 * 1024 * 1024, force=False):
+        self.connection = connection
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.force = force
+        self.code_version = code_version()
+        self.file_hashes = {}
+        self.table_checksums = {}
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(cache_dir, exist_ok=True)
+        connection.execute("""
+        CREATE TABLE IF NOT EXISTS STAGE_CACHE (
+            fingerprint CHAR(64) PRIMARY KEY,
+            stage VARCHAR(100),
+            outputs TEXT,
+            artifact_path TEXT,
+            size_bytes INTEGER,
+            created_at FLOAT,
+            last_used_at FLOAT
+        );
+        """)
+        connection.commit()
+
+    def hash_file(self, file_path):
+        # Files are hashed once per run and size/modification time
+        stat = os.stat(file_path)
+        key = (file_path, stat.st_size, stat.st_mtime_ns)
+        if key not in self.file_hashes:
+            self.file_hashes[key] = hash_file(file_path)
+        return self.file_hashes[key]
+
+    def table_checksum(self, table):
+        # Tables are hashed once until the connection writes a row, another connection commits or the schema
+        # changes, which covers the views being pointed at a new version
+        write_state = (self.connection.total_changes,
+                       self.connection.execute('PRAGMA data_version').fetchone()[0],
+                       self.connection.execute('PRAGMA schema_version').fetchone()[0])
+        key = (table, write_state)
+        if key not in self.table_checksums:
+            self.table_checksums[key] = table_checksum(self.connection, table)
+        return self.table_checksums[key]
+
+    def artifact_fingerprint(self, artifact):
+        """
+        Fingerprint an artifact which was not written by a stage of this run.
+
+        Files are hashed, tables take the fingerprint of the cached stage which produced their current
+        content, found by its recorded checksum, or that checksum when no cached stage did. In-memory
+        values of an earlier run are unknown, so None.
+        """
+        if os.path.isfile(artifact):
+            return self.hash_file(artifact)
+        if table_exists(self.connection, artifact):
+            checksum = self.table_checksum(artifact)
+            for fingerprint, outputs in self.connection.execute(
+                    'SELECT fingerprint, outputs FROM STAGE_CACHE ORDER BY created_at DESC'):
+                if json.loads(outputs)['tables'].get(artifact) == checksum:
+                    return fingerprint
+            return checksum
+        return None
+
+    def fingerprint(self, stage, input_fingerprints):
+        """
+        Fingerprint a stage from its parameters and the fingerprints of its inputs.
+
+        Returns:
+        - str or None: Hex digest, None when an input cannot be fingerprinted.
+        """
+        if any(input_fingerprints.get(name) is None for name in stage.inputs):
+            return None
+        description = {
+            'stage': stage.name,
+            'code_version': self.code_version,
+            'params': stage.params,
+            'inputs': {name: input_fingerprints[name] for name in stage.inputs},
+        }
+        return hashlib.sha256(json.dumps(description, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+    def describe_outputs(self, stage, result):
+        # Outputs are tables, files, or in-memory values returned by the stage
+        outputs = {'tables': {}, 'files': {}, 'values': sorted((result or {}).keys())}
+        for output in stage.outputs:
+            if os.path.isfile(output):
+                stat = os.stat(output)
+                outputs['files'][output] = [stat.st_size, stat.st_mtime_ns]
+            elif table_exists(self.connection, output):
+                outputs['tables'][output] = self.table_checksum(output)
+        return outputs
+
+    def outputs_are_valid(self, outputs):
+        # Entries of earlier versions recorded row counts, which never match a checksum
+        for table, checksum in outputs['tables'].items():
+            if not table_exists(self.connection, table) or self.table_checksum(table) != checksum:
+                return False
+        for file_path, (size, mtime_ns) in outputs['files'].items():
+            if not os.path.isfile(file_path):
+                return False
+            stat = os.stat(file_path)
+            if [stat.st_size, stat.st_mtime_ns] != [size, mtime_ns]:
+                return False
+        return True
+
+    def lookup(self, stage, fingerprint):
+        """
+        Find the outputs of a stage with this fingerprint.
+
+        Returns:
+        - dict or None: The in-memory outputs of the cached run (possibly empty), None on a miss.
+        """
+        if self.force or fingerprint is None:
+            self.misses += 1
+            return None
+        entry = self.connection.execute('SELECT outputs, artifact_path FROM STAGE_CACHE WHERE fingerprint = ?',
+                                        (fingerprint,)).fetchone()
+        result = None
+        if entry is not None and self.outputs_are_valid(json.loads(entry[0])):
+            if entry[1] is None:
+                result = {}
+            elif os.path.isfile(entry[1]):
+                with open(entry[1], 'rb') as artifact_file:
+                    result = pickle.load(artifact_file)
+        if result is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        with self.connection:
+            self.connection.execute('UPDATE STAGE_CACHE SET last_used_at = ? WHERE fingerprint = ?',
+                                    (time.time(), fingerprint))
+        return result
+
+    def store(self, stage, fingerprint, result):
+        """
+        Record the outputs of a stage which just ran, pickling its in-memory outputs.
+        """
+        if fingerprint is None:
+            return
+        outputs = self.describe_outputs(stage, result)
+        # Tables and files hold a single version, the entries which recorded them before, of this stage or of
+        # another one writing the same outputs, no longer match them
+        forget_cached_outputs(self.connection, [*outputs['tables'], *outputs['files']])
+        artifact_path, size_bytes = None, 0
+        if result:
+            artifact_path = os.path.join(self.cache_dir, f'{fingerprint}.pkl')
+            with open(artifact_path, 'wb') as artifact_file:
+                pickle.dump(result, artifact_file, protocol=pickle.HIGHEST_PROTOCOL)
+            size_bytes = os.path.getsize(artifact_path)
+
+        now = time.time()
+        with self.connection:
+            self.connection.execute('INSERT OR REPLACE INTO STAGE_CACHE VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                    (fingerprint, stage.name, json.dumps(outputs), artifact_path, size_bytes, now,
+                                     now))
+
+    def delete_entry(self, fingerprint):
+        artifact_path = os.path.join(self.cache_dir, f'{fingerprint}.pkl')
+        if os.path.exists(artifact_path):
+            os.remove(artifact_path)
+        self.connection.execute('DELETE FROM STAGE_CACHE WHERE fingerprint = ?', (fingerprint,))
+
+    def evict(self):
+        """
+        Evict the least recently used entries beyond `max_entries` or `max_bytes`.
+        """
+        entries = self.connection.execute(
+            'SELECT fingerprint, size_bytes FROM STAGE_CACHE ORDER BY last_used_at DESC').fetchall()
+        kept_entries, kept_bytes, evicted = 0, 0, 0
+        with self.connection:
+            for fingerprint, size_bytes in entries:
+                if kept_entries < self.max_entries and kept_bytes + size_bytes <= self.max_bytes:
+                    kept_entries += 1
+                    kept_bytes += size_bytes
+                else:
+                    self.delete_entry(fingerprint)
+                    evicted += 1
+        print(f'Stage cache: {self.hits} hits, {self.misses} misses, {evicted} evicted, '
+              f'{kept_entries} entries ({kept_bytes / 1024 / 1024:.1f} MB) kept')
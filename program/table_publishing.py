@@ -0,0 +1,220 @@
+import argparse
+import os
+import re
+import sqlite3
+from program.helper_functions import table_exists
+from program.sql_session import stage_transaction
+from program.stage_cache import forget_cached_outputs
+
+# Output tables read while the pipeline runs, published as a view over their latest version
+PUBLISHED_TABLES = ['NETFLIX_COMBINED_CLEANED', 'SHOWS_FOR_KIDS_RECOMMENDATION']
+# Number of versions kept before the published one, for rollbacks
+KEPT_VERSIONS = 2
+# State of the incremental loads, describing the shows of the published output tables
+INCREMENTAL_STATE_TABLES = ['LOAD_STATE', 'LOAD_WATERMARK', 'CHANGED_SHOWS']
+
+
+def create_table_versions(cursor):
+    """
+    Create the TABLE_VERSIONS table, holding the published version of each output table.
+
+    Parameters:
+    - cursor (sqlite3.Cursor or sqlite3.Connection): Cursor of the SQLite database.
+    """
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS TABLE_VERSIONS (
+        table_name VARCHAR(100) PRIMARY KEY,
+        version INTEGER,
+        published_at TIMESTAMP
+    );
+    """)
+
+
+def version_table(table, version):
+    return f'{table}__v{version}'
+
+
+def published_version(connection, table):
+    # Version published by the last pipeline run which wrote the table, 0 before the first one
+    row = connection.execute('SELECT version FROM TABLE_VERSIONS WHERE table_name = ?', (table,)).fetchone()
+    return row[0] if row else 0
+
+
+def table_versions(connection, table):
+    """
+    List the versions of an output table found in the database, published or not.
+
+    Returns:
+    - list: The version numbers, oldest first.
+    """
+    pattern = re.compile(re.escape(table) + r'__v(\d+)')
+    names = [name for (name,) in connection.execute("SELECT name FROM sqlite_schema WHERE type = 'table'")]
+    return sorted(int(match.group(1)) for match in map(pattern.fullmatch, names) if match)
+
+
+def publish_table_version(connection, table, version=None):
+    """
+    Record the published version of an output table.
+
+    Readers such as `RecommendationService` compare the version with the one they cached their results
+    for, and drop those results when it changed.
+
+    Parameters:
+    - connection (sqlite3.Connection): Open connection to the SQLite database.
+    - table (str): Name of the output table.
+    - version (int): The published version, None to increment the current one.
+
+    Returns:
+    - int: The published version of the table.
+    """
+    if version is None:
+        version = published_version(connection, table) + 1
+    connection.execute("""
+    INSERT INTO TABLE_VERSIONS VALUES (?, ?, datetime('now'))
+    ON CONFLICT(table_name) DO UPDATE SET version = excluded.version, published_at = excluded.published_at
+    """, (table, version))
+    return version
+
+
+def new_table_version(connection, table, copy_published=False):
+    """
+    Name the shadow table the next version of an output table is written to.
+
+    Readers keep reading the published version through the `table` view while the shadow table is
+    written, and only see it once `swap_table_version` publishes it.
+
+    Parameters:
+    - connection (sqlite3.Connection): Open connection to the SQLite database.
+    - table (str): Name of the output table.
+    - copy_published (bool): Create the shadow table as a copy of the published version, for incremental
+      runs which only replace some of its rows.
+
+    Returns:
+    - tuple: The name of the shadow table and its version.
+    """
+    # Versions left by a failed run or above a rolled back one are skipped, and dropped on the next swap
+    version = max([published_version(connection, table), *table_versions(connection, table)]) + 1
+    shadow_table = version_table(table, version)
+    if copy_published:
+        connection.execute(f'CREATE TABLE {shadow_table} AS SELECT * FROM {table}')
+    return shadow_table, version
+
+
+def point_view_at(connection, table, version):
+    # A table with the name of the view was written before versions were published, it is kept as one
+    schema_type = connection.execute('SELECT type FROM sqlite_schema WHERE name = ?', (table,)).fetchone()
+    if schema_type == ('table',):
+        legacy_table = version_table(table, published_version(connection, table))
+        connection.execute(f'ALTER TABLE {table} RENAME TO {legacy_table}')
+    elif schema_type == ('view',):
+        connection.execute(f'DROP VIEW {table}')
+    connection.execute(f'CREATE VIEW {table} AS SELECT * FROM {version_table(table, version)}')
+    publish_table_version(connection, table, version)
+
+
+def swap_table_version(connection, table, version, keep_versions=KEPT_VERSIONS):
+    """
+    Publish a version of an output table written by `new_table_version`.
+
+    The `table` view is pointed at the new version and TABLE_VERSIONS updated in one short transaction,
+    so readers see either the previous version or the new one, never a missing or half-written table.
+    With the WAL journal, readers are not blocked by the swap, and those which started reading before it
+    finish on the previous version. Versions older than the `keep_versions` before the new one are
+    then dropped.
+
+    Parameters:
+    - connection (sqlite3.Connection): Open connection to the SQLite database.
+    - table (str): Name of the output table.
+    - version (int): The version to publish.
+    - keep_versions (int): Number of previous versions kept for `rollback_table_version`.
+    """
+    # Commit the writes of the shadow table first, so the swap transaction only holds the schema change; within
+    # a pipeline stage both are part of the stage transaction, see `stage_transaction`
+    connection.commit()
+    with stage_transaction(connection):
+        point_view_at(connection, table, version)
+
+    older_versions = [kept for kept in table_versions(connection, table) if kept != version]
+    with stage_transaction(connection):
+        for old_version in older_versions[:max(0, len(older_versions) - keep_versions)]:
+            connection.execute(f'DROP TABLE {version_table(table, old_version)}')
+    print(f'Published version {version} of {table}, {min(len(older_versions), keep_versions)} previous kept')
+
+
+def reset_incremental_state(connection):
+    # The next --incremental run then finds every show changed and rebuilds the output tables in full
+    for state_table in INCREMENTAL_STATE_TABLES:
+        if table_exists(connection, state_table):
+            connection.execute(f'DELETE FROM {state_table}')
+
+
+def rollback_table_version(connection, table, version=None):
+    """
+    Publish a previous version of an output table again.
+
+    The rolled back version no longer holds the shows the incremental state (LOAD_STATE) describes: shows
+    deleted or changed since would be missed by an incremental update of it. The state is reset, so the next
+    run of main.py rebuilds the output tables in full, with or without --incremental.
+
+    Parameters:
+    - connection (sqlite3.Connection): Open connection to the SQLite database.
+    - table (str): Name of the output table.
+    - version (int): The version to publish, by default the one before the published version.
+
+    Returns:
+    - int: The published version.
+    """
+    current_version = published_version(connection, table)
+    versions = table_versions(connection, table)
+    if version is None:
+        previous_versions = [kept for kept in versions if kept < current_version]
+        if not previous_versions:
+            raise ValueError(f'{table} has no version before {current_version} to roll back to')
+        version = previous_versions[-1]
+    elif version not in versions:
+        raise ValueError(f'Version {version} of {table} was not kept, expected one of {versions}')
+
+    with stage_transaction(connection):
+        point_view_at(connection, table, version)
+        # Cached stages which wrote the table no longer match it, nor do the stages reading it
+        forget_cached_outputs(connection, [table])
+        reset_incremental_state(connection)
+    print(f'Rolled {table} back from version {current_version} to version {version}')
+    return version
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='List or roll back the published versions of the output tables.',
+        epilog='A rollback resets the state of the incremental loads, so the next run of main.py, even with '
+               '--incremental, rebuilds the output tables in full.')
+    parser.add_argument('command', choices=['list', 'rollback'],
+                        help='list the kept versions, or publish a previous one again')
+    parser.add_argument('--table', choices=PUBLISHED_TABLES, default=None,
+                        help='table to roll back, or to list (all by default)')
+    parser.add_argument('--version', type=int, default=None,
+                        help='version to roll back to, by default the one before the published version')
+    parser.add_argument('--database', default='program/database/netflix_database.db',
+                        help='database written by main.py')
+    args = parser.parse_args()
+    if not os.path.isfile(args.database):
+        parser.error(f'{args.database} does not exist, run main.py first')
+    if args.command == 'rollback' and args.table is None:
+        parser.error('rollback needs --table')
+
+    connection = sqlite3.connect(args.database)
+    try:
+        if args.command == 'rollback':
+            rollback_table_version(connection, args.table, args.version)
+        else:
+            for table in [args.table] if args.table else PUBLISHED_TABLES:
+                print(f'{table}: published version {published_version(connection, table)}, '
+                      f'kept versions {table_versions(connection, table)}')
+    except (ValueError, sqlite3.OperationalError) as error:
+        parser.error(str(error))
+    finally:
+        connection.close()
+
+
+if __name__ == '__main__':
+    main()
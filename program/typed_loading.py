@@ -0,0 +1,229 @@
+import importlib.util
+from program.helper_functions import lazy_import
+
+np = lazy_import('numpy')
+pd = lazy_import('pandas')
+
+# Low-cardinality columns, held as categoricals: each distinct value is stored once and each row as a small code
+CATEGORY_COLUMNS = ['type', 'country', 'rating', 'duration', 'listed_in', 'release_2000_or_newer']
+# Free-text columns, held as strings in one buffer per column rather than a Python object per value; "show_id"
+# stays a Python string, as a key it is hashed by `isin` and `map`, which is faster on Python objects
+TEXT_COLUMNS = ['title', 'director', 'cast', 'description']
+# Integer columns, nullable so a missing value does not turn them into floats
+INTEGER_COLUMNS = ['release_year', 'rating_id']
+# Format of "date_added" in the source CSV and in the tables, e.g. 'September 25, 2021'
+DATE_ADDED_FORMAT = '%B %d, %Y'
+# Rows read from SQLite and converted at a time, so only one chunk is held as Python strings; also the default
+# batch size of the out-of-core execution mode
+TYPED_CHUNK_SIZE = 100000
+
+
+# Arrow-backed strings need pyarrow, without it the pandas string dtype still keeps pd.NA for missing values;
+# the dtype is named rather than built, so pandas is only imported once a catalog is read
+TEXT_STORAGE = 'pyarrow' if importlib.util.find_spec('pyarrow') else 'python'
+TEXT_DTYPE = f'string[{TEXT_STORAGE}]'
+pa = lazy_import('pyarrow') if TEXT_STORAGE == 'pyarrow' else None
+
+# Dtype of each column of the catalog DataFrames; "date_added" is parsed with DATE_ADDED_FORMAT
+CATALOG_DTYPES = {
+    **{column: 'category' for column in CATEGORY_COLUMNS},
+    **{column: TEXT_DTYPE for column in TEXT_COLUMNS},
+    **{column: 'Int64' for column in INTEGER_COLUMNS},
+    'date_added': 'datetime64[ns]',
+}
+
+
+def parse_date_added(date_added):
+    """
+    Parse the "date_added" column, e.g. 'September 25, 2021'.
+
+    Parameters:
+    - date_added (pd.Series): The column as strings.
+
+    Returns:
+    - pd.Series: The dates, NaT for missing values or values in another format.
+    """
+    # Shows are added on a few thousand distinct days, each of them is parsed once
+    values = date_added.astype('category')
+    distinct_dates = pd.to_datetime(values.cat.categories.astype(str).str.strip(), format=DATE_ADDED_FORMAT,
+                                    errors='coerce')
+    dates = pd.Series(distinct_dates.take(values.cat.codes.to_numpy(), allow_fill=True, fill_value=pd.NaT),
+                      index=date_added.index, name=date_added.name)
+    unparsed_dates = int((dates.isna() & date_added.notna()).sum())
+    if unparsed_dates:
+        print(f'{unparsed_dates} values of date_added are not dates like {DATE_ADDED_FORMAT}, they are left empty')
+    return dates
+
+
+def format_date_added(date_added):
+    # Written back in the format of the source, with the day not zero-padded, e.g. 'September 5, 2021'
+    day = date_added.dt.day.astype('Int64').astype(TEXT_DTYPE)
+    year = date_added.dt.year.astype('Int64').astype(TEXT_DTYPE)
+    return date_added.dt.month_name().astype(TEXT_DTYPE) + ' ' + day + ', ' + year
+
+
+def apply_catalog_dtypes(frame):
+    """
+    Convert the catalog columns of a DataFrame to their dtypes in CATALOG_DTYPES.
+
+    Columns which already have their dtype, and columns which are not in CATALOG_DTYPES, are left as they are.
+
+    Parameters:
+    - frame (pd.DataFrame): Rows read from NETFLIX_SHOWS or a table derived from it.
+
+    Returns:
+    - pd.DataFrame: The same DataFrame, with its columns converted.
+    """
+    for column in frame.columns.intersection(list(CATALOG_DTYPES)):
+        if frame[column].dtype == CATALOG_DTYPES[column]:
+            continue
+        if column == 'date_added':
+            frame[column] = parse_date_added(frame[column])
+        else:
+            frame[column] = frame[column].astype(CATALOG_DTYPES[column])
+    return frame
+
+
+def iterate_typed_sql(query, connection, params=None, chunk_size=TYPED_CHUNK_SIZE):
+    """
+    Read the result of a query in DataFrames of `chunk_size` rows, with the dtypes of CATALOG_DTYPES.
+
+    The rows are fetched from the cursor with `fetchmany` as the DataFrames are consumed, so only one
+    chunk is in memory at a time. An empty result gives one empty DataFrame with the columns of the query.
+
+    Parameters:
+    - query (str): The SQL query.
+    - connection (sqlite3.Connection): Open connection to the SQLite database.
+    - params (tuple): Parameters of the query.
+    - chunk_size (int): Number of rows per DataFrame.
+
+    Yields:
+    - pd.DataFrame: The rows of the chunk.
+    """
+    cursor = connection.execute(query, params or ())
+    columns = [description[0] for description in cursor.description]
+    rows = cursor.fetchmany(chunk_size)
+    yield apply_catalog_dtypes(pd.DataFrame.from_records(rows, columns=columns))
+    while rows := cursor.fetchmany(chunk_size):
+        yield apply_catalog_dtypes(pd.DataFrame.from_records(rows, columns=columns))
+
+
+def concat_typed(chunks):
+    """
+    Concatenate typed DataFrames, keeping their categorical columns categorical.
+
+    pandas only keeps a categorical column when every chunk has the same categories, so each column is
+    given the sorted union of the categories of all chunks first.
+
+    Parameters:
+    - chunks (list): DataFrames read by `iterate_typed_sql`.
+
+    Returns:
+    - pd.DataFrame: The rows of all chunks, with a new index.
+    """
+    categories = {column: pd.CategoricalDtype(pd.api.types.union_categoricals(
+        [chunk[column] for chunk in chunks], sort_categories=True).categories)
+        for column in chunks[0].columns.intersection(CATEGORY_COLUMNS)}
+    frame = pd.concat([chunk.astype(categories) for chunk in chunks], ignore_index=True)
+    if TEXT_STORAGE == 'pyarrow':
+        # A concatenated Arrow column keeps one array per chunk, which makes selecting rows slower; a column
+        # over the 2 GB of the 32-bit offsets of Arrow strings stays in chunks
+        for column in frame.columns.intersection(TEXT_COLUMNS):
+            if frame[column].array.nbytes < 2 ** 31:
+                text = pa.array(frame[column])
+                if isinstance(text, pa.ChunkedArray):
+                    text = text.combine_chunks()
+                frame[column] = pd.Series(pd.arrays.ArrowStringArray(text), index=frame.index)
+    return frame
+
+
+def read_typed_sql(query, connection, params=None, index_col=None, chunk_size=TYPED_CHUNK_SIZE):
+    """
+    Read the result of a query into a DataFrame with the dtypes of CATALOG_DTYPES.
+
+    The rows are read and converted `chunk_size` at a time, so the whole result is never held as Python
+    objects. Every stage reading the catalog goes through this function, so filters such as `isin` on the
+    rating compare small integer codes instead of strings.
+
+    Parameters:
+    - query (str): The SQL query.
+    - connection (sqlite3.Connection): Open connection to the SQLite database.
+    - params (tuple): Parameters of the query.
+    - index_col (str): Column to use as the index.
+    - chunk_size (int): Number of rows read and converted at a time.
+
+    Returns:
+    - pd.DataFrame: The typed rows.
+    """
+    frame = concat_typed(list(iterate_typed_sql(query, connection, params=params, chunk_size=chunk_size)))
+    return frame.set_index(index_col) if index_col else frame
+
+
+def write_typed_sql(frame, table, connection, **to_sql_options):
+    """
+    Write a typed DataFrame to a table, with "date_added" in the format of the source.
+
+    Parameters:
+    - frame (pd.DataFrame): The typed rows.
+    - table (str): Name of the table.
+    - connection (sqlite3.Connection): Open connection to the SQLite database.
+    - to_sql_options: Options of `pd.DataFrame.to_sql`, e.g. if_exists='append'.
+    """
+    if 'date_added' in frame.columns and pd.api.types.is_datetime64_any_dtype(frame['date_added']):
+        frame = frame.copy(deep=False)
+        frame['date_added'] = format_date_added(frame['date_added'])
+    frame.to_sql(table, connection, **to_sql_options)
+
+
+def write_typed_batches(batches, table, connection, columns=None):
+    """
+    Write typed DataFrames to a table one after the other, replacing the table.
+
+    The table is dropped before the first batch is read: SQLite cannot drop a table while a query of
+    `iterate_typed_sql` is still reading on the same connection.
+
+    Parameters:
+    - batches (iterable): The typed DataFrames, e.g. from `iterate_typed_sql`.
+    - table (str): Name of the table.
+    - connection (sqlite3.Connection): Open connection to the SQLite database.
+    - columns (list): Columns written to the table, None for all of them.
+
+    Yields:
+    - pd.DataFrame: Each batch, once it is written.
+    """
+    connection.execute(f'DROP TABLE IF EXISTS "{table}"')
+    for batch in batches:
+        write_typed_sql(batch if columns is None else batch[columns], table, connection, if_exists='append',
+                        index=False)
+        yield batch
+
+
+def fill_missing(values, value):
+    """
+    Fill the missing values of a column, adding `value` to the categories of a categorical column.
+    """
+    if isinstance(values.dtype, pd.CategoricalDtype) and value not in values.cat.categories:
+        values = values.cat.add_categories([value])
+    return values.fillna(value)
+
+
+def map_categories(values, function):
+    """
+    Apply a vectorized function to the categories of a categorical column, rather than to each of its rows.
+
+    Parameters:
+    - values (pd.Series): The categorical column.
+    - function (callable): Maps an Index of categories to an array of new values, several of them may map
+      to the same value.
+
+    Returns:
+    - pd.Series: The categorical column of the new values, missing values stay missing.
+    """
+    if len(values.cat.categories) == 0:
+        return values
+    mapped = pd.Index(function(values.cat.categories))
+    categories = mapped.unique().sort_values()
+    category_codes = categories.get_indexer(mapped)
+    codes = values.cat.codes.to_numpy()
+    codes = np.where(codes >= 0, category_codes[codes], -1)
+    return pd.Series(pd.Categorical.from_codes(codes, categories), index=values.index, name=values.name)
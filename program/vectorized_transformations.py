@@ -0,0 +1,55 @@
+import re
+from program.helper_functions import lazy_import
+from program.typed_loading import map_categories
+
+np = lazy_import('numpy')
+pd = lazy_import('pandas')
+
+# Genres of shows for children and families
+KEYWORDS_FOR_KIDS = ['Children & Family Movies', "Kids' TV"]
+KEYWORDS_FOR_KIDS_PATTERN = re.compile('|'.join(re.escape(keyword) for keyword in KEYWORDS_FOR_KIDS))
+
+
+def replace_multiple_countries(country):
+    """
+    Replace every value listing more than one country with 'many'.
+
+    Parameters:
+    - country (pd.Series): The "country" column without missing values.
+
+    Returns:
+    - np.ndarray: The column with comma-separated countries replaced by 'many', or a categorical pd.Series
+      for a categorical column, whose categories are replaced instead of its rows.
+    """
+    if isinstance(country.dtype, pd.CategoricalDtype):
+        return map_categories(country, lambda categories: replace_multiple_countries(categories.to_series()))
+    return np.where(country.str.contains(',', regex=False), 'many', country)
+
+
+def flag_release_2000_or_newer(release_year):
+    """
+    Flag the shows released in 2000 or later.
+
+    Parameters:
+    - release_year (pd.Series): The "release_year" column.
+
+    Returns:
+    - np.ndarray: 'yes' for shows released in 2000 or later, otherwise 'no'.
+    """
+    # A missing year of a nullable integer column compares as pd.NA, and is not 2000 or later
+    return np.where((release_year >= 2000).fillna(False), 'yes', 'no')
+
+
+def is_listed_for_kids(listed_in):
+    """
+    Check which shows are listed in one of the genres for kids.
+
+    For a categorical column, pandas searches each category once rather than each row.
+
+    Parameters:
+    - listed_in (pd.Series): The "listed_in" column.
+
+    Returns:
+    - pd.Series: A boolean mask, True for shows listed in one of `KEYWORDS_FOR_KIDS`.
+    """
+    return listed_in.str.contains(KEYWORDS_FOR_KIDS_PATTERN, na=False)